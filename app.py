@@ -24,13 +24,20 @@ import numpy as np
 import tempfile
 import os
 import zipfile
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('Agg')
 import io
+import json
+import struct
+import shapely
 from shapely.geometry import Polygon, Point, LineString, mapping, box
 from shapely.validation import make_valid
+try:
+    from shapely import contains_xy as contiene_xy
+except ImportError:
+    from shapely.vectorized import contains as contiene_xy
 import math
 import warnings
 from io import BytesIO
@@ -38,6 +45,7 @@ import requests
 import re
 import folium
 from streamlit_folium import folium_static
+import streamlit.components.v1 as components
 from folium.plugins import Fullscreen, MeasureControl, MiniMap
 from branca.colormap import LinearColormap
 import plotly.graph_objects as go
@@ -45,8 +53,11 @@ import plotly.express as px
 from plotly.subplots import make_subplots
 import cv2
 from PIL import Image
-from scipy.spatial import KDTree
-from scipy.interpolate import Rbf
+from scipy.spatial import KDTree, Delaunay
+from scipy.spatial.distance import pdist
+from scipy.optimize import curve_fit
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import base64
 import time
 import shutil
@@ -82,6 +93,14 @@ except ImportError:
     if not RASTERIO_OK:
         st.warning("⚠️ pyhdf tampoco está instalado. No se podrán leer archivos HDF4.")
 
+# ===== TESELAS VECTORIALES (opcional) =====
+try:
+    import mapbox_vector_tile
+    from folium.plugins import VectorGridProtobuf
+    MVT_OK = True
+except ImportError:
+    MVT_OK = False
+
 # ===== CONFIGURACIÓN DE MERCADO PAGO =====
 MERCADOPAGO_ACCESS_TOKEN = os.environ.get("MERCADOPAGO_ACCESS_TOKEN")
 if not MERCADOPAGO_ACCESS_TOKEN:
@@ -436,10 +455,14 @@ def init_session_state():
         'fecha_fin': datetime.now(),
         'cultivo_seleccionado': 'Trigo',
         'textura_suelo': {},
-        'textura_por_bloque': [],
-        'datos_fertilidad': [],
+        'textura_por_bloque': None,
+        'datos_fertilidad': None,
+        'muestras_laboratorio': None,
+        'validacion_muestras': None,   # validación LOO de las muestras interpoladas
         'analisis_suelo': True,
         'curvas_nivel': None,
+        'dem_terreno': None,           # (dem, transform) del último análisis
+        'fuente_terreno': None,        # 'SRTM' o 'Simulado'
         'demo_mode': False,
         'payment_intent': False,
         'modelo_yolo': None,          # modelo YOLO global
@@ -1376,269 +1399,1458 @@ def generar_datos_climaticos_simulados(gdf, fecha_inicio, fecha_fin):
             'fuente': 'Simulado (fallback)'
         }
 
+# ===== PRONÓSTICO METEOROLÓGICO Y VENTANAS DE APLICACIÓN =====
+URL_PRONOSTICO_OPENMETEO = os.environ.get("OPENMETEO_FORECAST_URL", "https://api.open-meteo.com/v1/forecast")
+CICLO_MODELO_HORAS = 6          # corridas 00/06/12/18 UTC
+LATENCIA_MODELO_HORAS = 4       # demora típica hasta que la corrida está publicada
+RESOLUCION_CELDA_PRONOSTICO = 0.1  # grados; bloques en la misma celda comparten descarga
+
+# Umbrales para aplicación de nitrógeno (urea al voleo / pulverización)
+UMBRALES_APLICACION = {
+    'viento_ideal': 10.0,        # km/h
+    'viento_max': 20.0,          # km/h
+    'temp_ideal': 22.0,          # °C
+    'temp_max': 32.0,            # °C (volatilización)
+    'lluvia_aplicacion_max': 0.2,  # mm/h en la hora de aplicación
+    'horas_incorporacion': 48,   # ventana posterior para incorporar la urea
+    'lluvia_incorporacion_min': 5.0,   # mm acumulados deseados
+    'lluvia_lavado_max': 30.0,   # mm acumulados que implican lavado/escurrimiento
+}
+
+def ciclo_modelo_actual(ahora=None):
+    """
+    Devuelve el identificador (UTC) de la última corrida de modelo publicada.
+    Se usa como parte de la clave de caché para no descargar dos veces la misma corrida.
+    """
+    ahora = ahora or datetime.now(timezone.utc)
+    disponible = ahora - timedelta(hours=LATENCIA_MODELO_HORAS)
+    hora = (disponible.hour // CICLO_MODELO_HORAS) * CICLO_MODELO_HORAS
+    return disponible.replace(hour=hora, minute=0, second=0, microsecond=0).strftime('%Y-%m-%dT%HZ')
+
+@st.cache_data(ttl=CICLO_MODELO_HORAS * 3600, max_entries=512, show_spinner=False)
+def _descargar_pronostico_celda(lat_celda, lon_celda, ciclo, dias, url=URL_PRONOSTICO_OPENMETEO):
+    """Descarga el pronóstico horario de una celda. Cacheado por celda y corrida de modelo."""
+    params = {
+        "latitude": lat_celda,
+        "longitude": lon_celda,
+        "hourly": ["precipitation", "wind_speed_10m", "temperature_2m"],
+        "forecast_days": dias,
+        "wind_speed_unit": "kmh",
+        "timezone": "UTC"
+    }
+    response = requests.get(url, params=params, timeout=30)
+    response.raise_for_status()
+    data = response.json()
+    if "hourly" not in data:
+        raise ValueError("No se recibieron datos horarios")
+    horario = data["hourly"]
+    return {
+        'tiempo': horario["time"],
+        'precipitacion': [p if p is not None else 0.0 for p in horario["precipitation"]],
+        'viento': [w if w is not None else np.nan for w in horario["wind_speed_10m"]],
+        'temperatura': [t if t is not None else np.nan for t in horario["temperature_2m"]]
+    }
+
+def generar_pronostico_simulado(n_bloques, dias=7):
+    horas = dias * 24
+    rng = np.random.default_rng(42)
+    t = np.arange(horas)
+    base_viento = 12 + 6 * np.sin(2 * np.pi * (t - 15) / 24)
+    base_temp = 22 + 7 * np.sin(2 * np.pi * (t - 9) / 24)
+    lluvia = rng.exponential(1.5, horas) * (rng.random(horas) > 0.93)
+    ruido = rng.normal(0, 1, (n_bloques, 1))
+    inicio = np.datetime64(datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0, tzinfo=None), 'm')
+    return {
+        'tiempo': inicio + t.astype('timedelta64[h]'),
+        'precipitacion': np.tile(lluvia, (n_bloques, 1)),
+        'viento': np.clip(base_viento + ruido, 0, None),
+        'temperatura': base_temp + 0.5 * ruido,
+        'ciclo': 'simulado',
+        'fuente': 'Pronóstico simulado (DEMO)'
+    }
+
+def obtener_pronostico_bloques(gdf, dias=7, url=URL_PRONOSTICO_OPENMETEO):
+    """
+    Obtiene el pronóstico horario para todos los bloques de la parcela.
+    Los centroides se agrupan en celdas de RESOLUCION_CELDA_PRONOSTICO; se descarga una
+    vez por celda y corrida de modelo, y el resultado se expande a matrices (bloques x horas).
+    """
+    centroides = gdf.geometry.centroid
+    celdas = np.column_stack((
+        np.round(centroides.y.values / RESOLUCION_CELDA_PRONOSTICO) * RESOLUCION_CELDA_PRONOSTICO,
+        np.round(centroides.x.values / RESOLUCION_CELDA_PRONOSTICO) * RESOLUCION_CELDA_PRONOSTICO
+    )).round(4)
+    celdas_unicas, inverso = np.unique(celdas, axis=0, return_inverse=True)
+    ciclo = ciclo_modelo_actual()
+    
+    series = []
+    for lat_celda, lon_celda in celdas_unicas:
+        try:
+            series.append(_descargar_pronostico_celda(float(lat_celda), float(lon_celda), ciclo, dias, url))
+        except Exception as e:
+            st.warning(f"Error en pronóstico Open-Meteo ({lat_celda:.1f}, {lon_celda:.1f}): {str(e)[:100]}")
+            return None
+    
+    n_horas = min(len(s['tiempo']) for s in series)
+    if n_horas == 0:
+        return None
+    def matriz(clave):
+        return np.array([s[clave][:n_horas] for s in series], dtype=np.float64)[inverso.ravel()]
+    
+    return {
+        'tiempo': np.array(series[0]['tiempo'][:n_horas], dtype='datetime64[m]'),
+        'precipitacion': matriz('precipitacion'),
+        'viento': matriz('viento'),
+        'temperatura': matriz('temperatura'),
+        'ciclo': ciclo,
+        'fuente': f'Open-Meteo Forecast (corrida {ciclo})'
+    }
+
+def calcular_ventanas_aplicacion(pronostico, umbrales=UMBRALES_APLICACION):
+    """
+    Puntaje de aptitud (0-1) para aplicar nitrógeno en cada hora y bloque.
+    Combina viento, temperatura, lluvia en la hora de aplicación y lluvia acumulada
+    en las horas siguientes (incorporación sin lavado). Todo vectorizado sobre (bloques, horas).
+    """
+    P = np.nan_to_num(pronostico['precipitacion'], nan=0.0)
+    V = pronostico['viento']
+    T = pronostico['temperatura']
+    n_horas = P.shape[1]
+    
+    acumulado = np.concatenate([np.zeros((P.shape[0], 1)), np.cumsum(P, axis=1)], axis=1)
+    fin = np.minimum(np.arange(n_horas) + 1 + umbrales['horas_incorporacion'], n_horas)
+    lluvia_posterior = acumulado[:, fin] - acumulado[:, 1:n_horas + 1]
+    
+    with np.errstate(invalid='ignore'):
+        p_viento = np.clip((umbrales['viento_max'] - V) / (umbrales['viento_max'] - umbrales['viento_ideal']), 0, 1)
+        p_temp = np.clip((umbrales['temp_max'] - T) / (umbrales['temp_max'] - umbrales['temp_ideal']), 0, 1)
+    p_seco = (P <= umbrales['lluvia_aplicacion_max']).astype(np.float64)
+    p_incorporacion = np.where(
+        lluvia_posterior > umbrales['lluvia_lavado_max'], 0.0,
+        np.clip(0.4 + 0.6 * lluvia_posterior / umbrales['lluvia_incorporacion_min'], 0, 1)
+    )
+    return np.nan_to_num(p_viento * p_temp * p_seco * p_incorporacion, nan=0.0)
+
+def resumir_ventanas_diarias(pronostico, puntaje, ids_bloque):
+    """Mejor puntaje y hora de aplicación por bloque y día."""
+    n_dias = puntaje.shape[1] // 24
+    if n_dias == 0:
+        return pd.DataFrame()
+    por_dia = puntaje[:, :n_dias * 24].reshape(puntaje.shape[0], n_dias, 24)
+    mejor_hora = por_dia.argmax(axis=2)
+    mejor_puntaje = por_dia.max(axis=2)
+    tiempo = pronostico['tiempo'][:n_dias * 24].reshape(n_dias, 24)
+    inicio_ventana = tiempo[np.arange(n_dias)[None, :], mejor_hora]
+    return pd.DataFrame({
+        'id_bloque': np.repeat(np.asarray(ids_bloque), n_dias),
+        'fecha': np.tile(tiempo[:, 0].astype('datetime64[D]'), len(ids_bloque)),
+        'mejor_hora_utc': pd.to_datetime(inicio_ventana.ravel()).strftime('%H:%M'),
+        'puntaje': np.round(mejor_puntaje.ravel(), 2)
+    })
+
 # ===== FUNCIÓN PARA GRÁFICOS CLIMÁTICOS =====
-def crear_graficos_climaticos_completos(datos_climaticos):
-    longitudes = []
-    if 'precipitacion' in datos_climaticos and 'diaria' in datos_climaticos['precipitacion']:
-        longitudes.append(len(datos_climaticos['precipitacion']['diaria']))
-    if 'temperatura' in datos_climaticos and 'diaria' in datos_climaticos['temperatura']:
-        longitudes.append(len(datos_climaticos['temperatura']['diaria']))
-    if 'radiacion' in datos_climaticos and 'diaria' in datos_climaticos['radiacion']:
-        longitudes.append(len(datos_climaticos['radiacion']['diaria']))
-    if 'viento' in datos_climaticos and 'diaria' in datos_climaticos['viento']:
-        longitudes.append(len(datos_climaticos['viento']['diaria']))
+MAX_PUNTOS_GRAFICO = 400
+
+def reducir_serie_lttb(x, y, n_puntos=MAX_PUNTOS_GRAFICO):
+    """
+    Reduce una serie temporal con Largest-Triangle-Three-Buckets (LTTB).
+    Conserva picos y forma de la curva; devuelve (x, y) con a lo sumo n_puntos.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if n_puntos >= n or n_puntos < 3:
+        return x, y
     
+    indices = np.empty(n_puntos, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    limites = np.linspace(1, n - 1, n_puntos - 1).astype(np.int64)
+    a = 0
+    for i in range(n_puntos - 2):
+        ini, fin = limites[i], limites[i + 1]
+        sig_ini, sig_fin = limites[i + 1], limites[i + 2] if i + 2 < len(limites) else n
+        prom_x = x[sig_ini:sig_fin].mean()
+        prom_y = y[sig_ini:sig_fin].mean()
+        areas = np.abs((x[a] - prom_x) * (y[ini:fin] - y[a]) - (x[a] - x[ini:fin]) * (prom_y - y[a]))
+        a = ini + int(np.argmax(areas))
+        indices[i + 1] = a
+    return x[indices], y[indices]
+
+def _serie_diaria(datos_climaticos, clave, n_dias):
+    serie = np.array(datos_climaticos[clave]['diaria'][:n_dias], dtype=np.float64)
+    mask_nan = np.isnan(serie)
+    if np.any(mask_nan) and not np.all(mask_nan):
+        serie = serie.copy()
+        serie[mask_nan] = np.nanmean(serie)
+    return serie
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def crear_graficos_climaticos_completos(datos_climaticos, max_puntos=MAX_PUNTOS_GRAFICO):
+    """
+    Construye los cuatro paneles climáticos como figura interactiva de Plotly.
+    Memoizado sobre el contenido de los datos y las opciones del gráfico;
+    las series largas se reducen con LTTB antes de graficar.
+    """
+    longitudes = [len(datos_climaticos[k]['diaria']) for k in ('precipitacion', 'temperatura', 'radiacion', 'viento')
+                  if k in datos_climaticos and 'diaria' in datos_climaticos[k]]
     if not longitudes:
-        st.warning("No hay datos climáticos suficientes para graficar.")
         return None
     
     n_dias = min(longitudes)
-    dias = list(range(1, n_dias + 1))
+    dias = np.arange(1, n_dias + 1)
     
-    fig, axes = plt.subplots(2, 2, figsize=(15, 10))
+    paneles = [
+        ('radiacion', 'Radiación Solar', 'Radiación (MJ/m²/día)', 'orange', 'red', 'MJ/m²', 1, 1),
+        ('precipitacion', 'Precipitación', 'Precipitación (mm)', 'blue', None, 'mm', 1, 2),
+        ('viento', 'Velocidad del Viento', 'Viento (m/s)', 'green', 'red', 'm/s', 2, 1),
+        ('temperatura', 'Temperatura Diaria', 'Temperatura (°C)', 'red', 'blue', '°C', 2, 2),
+    ]
+    titulos = []
+    for clave, titulo, _, _, _, _, _, _ in paneles:
+        if clave == 'precipitacion' and datos_climaticos.get(clave, {}).get('diaria'):
+            precip = np.array(datos_climaticos[clave]['diaria'][:n_dias], dtype=np.float64)
+            total_precip = datos_climaticos[clave].get('total', np.nansum(precip))
+            titulo = f"Precipitación (Total: {total_precip:.1f} mm)"
+        titulos.append(titulo)
     
-    if 'radiacion' in datos_climaticos and datos_climaticos['radiacion'].get('diaria'):
-        rad = np.array(datos_climaticos['radiacion']['diaria'][:n_dias], dtype=np.float64)
-        mask_nan = np.isnan(rad)
-        if np.any(mask_nan):
-            rad_filled = rad.copy()
-            rad_filled[mask_nan] = np.nanmean(rad)
-        else:
-            rad_filled = rad
-        ax1 = axes[0, 0]
-        ax1.plot(dias, rad_filled, 'o-', color='orange', linewidth=2, markersize=4)
-        ax1.fill_between(dias, rad_filled, alpha=0.3, color='orange')
-        if 'promedio' in datos_climaticos['radiacion']:
-            prom_rad = datos_climaticos['radiacion']['promedio']
-            ax1.axhline(y=prom_rad, color='red', linestyle='--', 
-                       label=f"Promedio: {prom_rad} MJ/m²")
-        ax1.set_xlabel('Día')
-        ax1.set_ylabel('Radiación (MJ/m²/día)')
-        ax1.set_title('Radiación Solar', fontweight='bold')
-        ax1.legend()
-        ax1.grid(True, alpha=0.3)
-    else:
-        axes[0, 0].text(0.5, 0.5, "Datos no disponibles", ha='center', va='center')
-        axes[0, 0].set_title('Radiación', fontweight='bold')
-    
-    if 'precipitacion' in datos_climaticos and datos_climaticos['precipitacion'].get('diaria'):
-        precip = np.array(datos_climaticos['precipitacion']['diaria'][:n_dias], dtype=np.float64)
-        ax2 = axes[0, 1]
-        ax2.bar(dias, precip, color='blue', alpha=0.7)
-        ax2.set_xlabel('Día')
-        ax2.set_ylabel('Precipitación (mm)')
-        total_precip = datos_climaticos['precipitacion'].get('total', np.sum(precip))
-        ax2.set_title(f"Precipitación (Total: {total_precip:.1f} mm)", fontweight='bold')
-        ax2.grid(True, alpha=0.3, axis='y')
-    else:
-        axes[0, 1].text(0.5, 0.5, "Datos no disponibles", ha='center', va='center')
-        axes[0, 1].set_title('Precipitación', fontweight='bold')
-    
-    if 'viento' in datos_climaticos and datos_climaticos['viento'].get('diaria'):
-        wind = np.array(datos_climaticos['viento']['diaria'][:n_dias], dtype=np.float64)
-        mask_nan = np.isnan(wind)
-        if np.any(mask_nan):
-            wind_filled = wind.copy()
-            wind_filled[mask_nan] = np.nanmean(wind)
-        else:
-            wind_filled = wind
-        ax3 = axes[1, 0]
-        ax3.plot(dias, wind_filled, 's-', color='green', linewidth=2, markersize=4)
-        ax3.fill_between(dias, wind_filled, alpha=0.3, color='green')
-        if 'promedio' in datos_climaticos['viento']:
-            prom_wind = datos_climaticos['viento']['promedio']
-            ax3.axhline(y=prom_wind, color='red', linestyle='--',
-                       label=f"Promedio: {prom_wind} m/s")
-        ax3.set_xlabel('Día')
-        ax3.set_ylabel('Viento (m/s)')
-        ax3.set_title('Velocidad del Viento', fontweight='bold')
-        ax3.legend()
-        ax3.grid(True, alpha=0.3)
-    else:
-        axes[1, 0].text(0.5, 0.5, "Datos no disponibles", ha='center', va='center')
-        axes[1, 0].set_title('Viento', fontweight='bold')
-    
-    if 'temperatura' in datos_climaticos and datos_climaticos['temperatura'].get('diaria'):
-        temp = np.array(datos_climaticos['temperatura']['diaria'][:n_dias], dtype=np.float64)
-        mask_nan = np.isnan(temp)
-        if np.any(mask_nan):
-            temp_filled = temp.copy()
-            temp_filled[mask_nan] = np.nanmean(temp)
+    fig = make_subplots(rows=2, cols=2, subplot_titles=titulos, vertical_spacing=0.12, horizontal_spacing=0.08)
+    for clave, titulo, eje_y, color, color_prom, unidad, fila, col in paneles:
+        if not datos_climaticos.get(clave, {}).get('diaria'):
+            fig.add_annotation(text="Datos no disponibles", showarrow=False, xref='x domain', yref='y domain',
+                               x=0.5, y=0.5, row=fila, col=col)
+            continue
+        serie = _serie_diaria(datos_climaticos, clave, n_dias)
+        x_red, y_red = reducir_serie_lttb(dias, serie, max_puntos)
+        if clave == 'precipitacion':
+            fig.add_trace(go.Bar(x=x_red, y=y_red, marker_color=color, opacity=0.7, name=titulo), row=fila, col=col)
         else:
-            temp_filled = temp
-        ax4 = axes[1, 1]
-        ax4.plot(dias, temp_filled, '^-', color='red', linewidth=2, markersize=4)
-        ax4.fill_between(dias, temp_filled, alpha=0.3, color='red')
-        if 'promedio' in datos_climaticos['temperatura']:
-            prom_temp = datos_climaticos['temperatura']['promedio']
-            ax4.axhline(y=prom_temp, color='blue', linestyle='--',
-                       label=f"Promedio: {prom_temp}°C")
-        ax4.set_xlabel('Día')
-        ax4.set_ylabel('Temperatura (°C)')
-        ax4.set_title('Temperatura Diaria', fontweight='bold')
-        ax4.legend()
-        ax4.grid(True, alpha=0.3)
-    else:
-        axes[1, 1].text(0.5, 0.5, "Datos no disponibles", ha='center', va='center')
-        axes[1, 1].set_title('Temperatura', fontweight='bold')
+            fig.add_trace(go.Scatter(x=x_red, y=y_red, mode='lines+markers' if len(x_red) <= 120 else 'lines',
+                                     line=dict(color=color, width=2), marker=dict(size=4),
+                                     fill='tozeroy', name=titulo), row=fila, col=col)
+            if color_prom and 'promedio' in datos_climaticos[clave]:
+                prom = datos_climaticos[clave]['promedio']
+                fig.add_hline(y=prom, line_dash='dash', line_color=color_prom,
+                              annotation_text=f"Promedio: {prom} {unidad}", row=fila, col=col)
+        fig.update_xaxes(title_text='Día', row=fila, col=col)
+        fig.update_yaxes(title_text=eje_y, row=fila, col=col)
     
     fuente = datos_climaticos.get('fuente', 'Desconocido')
-    plt.suptitle(f"Datos Climáticos - {fuente}", fontsize=16, fontweight='bold', y=1.02)
-    plt.tight_layout()
+    fig.update_layout(title_text=f"Datos Climáticos - {fuente}", title_font_size=18,
+                      height=700, showlegend=False, hovermode='x unified')
     return fig
 
+# ===== GENERADOR ALEATORIO POR BLOQUE =====
+def _splitmix64(x):
+    """Mezclador splitmix64 sobre arrays uint64 (aritmética módulo 2^64)."""
+    with np.errstate(over='ignore'):
+        z = np.asarray(x, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+def claves_bloques(gdf, decimales=6):
+    """Clave uint64 estable por bloque derivada de su centroide cuantizado (no depende del orden)."""
+    q = np.round(centroides_bloques(gdf) * 10 ** decimales).astype(np.int64).view(np.uint64)
+    return _splitmix64(q[:, 0] ^ _splitmix64(q[:, 1]))
+
+def uniformes_por_bloque(claves, n, flujo=0):
+    """
+    Matriz (bloques, n) de uniformes en [0, 1) de un generador basado en contador: cada valor
+    es splitmix64(clave del bloque ^ contador), sin estado global, así que es determinista
+    por bloque y seguro entre hilos y sesiones. `flujo` separa secuencias independientes.
+    """
+    contador = np.arange(n, dtype=np.uint64) + np.uint64(flujo) * np.uint64(1 << 32)
+    bits = _splitmix64(np.asarray(claves, dtype=np.uint64)[:, None] ^ _splitmix64(contador)[None, :])
+    return (bits >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
 # ===== ANÁLISIS DE TEXTURA DE SUELO =====
+CARACTERISTICAS_SUELO = {
+    'Franco Arcilloso': {
+        'arena': 35, 'limo': 25, 'arcilla': 30,
+        'textura': 'Media', 'drenaje': 'Moderado',
+        'CIC': 'Alto (15-25)', 'ret_agua': 'Alta',
+        'recomendacion': 'Ideal para cultivos'
+    },
+    'Franco Arcilloso Arenoso': {
+        'arena': 45, 'limo': 20, 'arcilla': 25,
+        'textura': 'Media-ligera', 'drenaje': 'Bueno',
+        'CIC': 'Medio (10-15)', 'ret_agua': 'Moderada',
+        'recomendacion': 'Requiere riego'
+    },
+    'Arenoso Franco': {
+        'arena': 55, 'limo': 15, 'arcilla': 20,
+        'textura': 'Ligera', 'drenaje': 'Excelente',
+        'CIC': 'Bajo (5-10)', 'ret_agua': 'Baja',
+        'recomendacion': 'Fertilización fraccionada'
+    },
+    'Arcilloso': {
+        'arena': 25, 'limo': 20, 'arcilla': 40,
+        'textura': 'Pesada', 'drenaje': 'Limitado',
+        'CIC': 'Muy alto (25-35)', 'ret_agua': 'Muy alta',
+        'recomendacion': 'Drenaje y labranza'
+    },
+    'Arcilloso Pesado': {
+        'arena': 20, 'limo': 15, 'arcilla': 50,
+        'textura': 'Muy pesada', 'drenaje': 'Muy limitado',
+        'CIC': 'Extremo (>35)', 'ret_agua': 'Extrema',
+        'recomendacion': 'Drenaje intensivo'
+    },
+    'Franco': {
+        'arena': 40, 'limo': 40, 'arcilla': 20,
+        'textura': 'Media', 'drenaje': 'Bueno',
+        'CIC': 'Medio (10-20)', 'ret_agua': 'Media',
+        'recomendacion': 'Manejo estándar'
+    },
+    'Arenoso': {
+        'arena': 70, 'limo': 15, 'arcilla': 15,
+        'textura': 'Ligera', 'drenaje': 'Excelente',
+        'CIC': 'Muy bajo (<5)', 'ret_agua': 'Muy baja',
+        'recomendacion': 'Riego frecuente'
+    }
+}
+# (latitud mínima, suelo dominante, suelo alternativo), de norte a sur
+SUELOS_POR_LATITUD = [
+    (10, 'Franco Arcilloso', 'Arcilloso'),
+    (7, 'Franco Arcilloso Arenoso', 'Franco'),
+    (4, 'Arenoso Franco', 'Arenoso'),
+    (-np.inf, 'Franco Arcilloso', 'Arcilloso Pesado'),
+]
+PROBABILIDAD_SUELO_DOMINANTE = 0.7
+# Clase textural USDA -> suelo de CARACTERISTICAS_SUELO con el mismo comportamiento
+SUELO_POR_CLASE_USDA = {
+    'Arenoso': 'Arenoso', 'Arenoso Franco': 'Arenoso Franco', 'Franco Arenoso': 'Arenoso Franco',
+    'Franco': 'Franco', 'Franco Limoso': 'Franco', 'Limoso': 'Franco',
+    'Franco Arcillo Arenoso': 'Franco Arcilloso Arenoso', 'Franco Arcilloso': 'Franco Arcilloso',
+    'Franco Arcillo Limoso': 'Franco Arcilloso', 'Arcillo Arenoso': 'Arcilloso',
+    'Arcillo Limoso': 'Arcilloso', 'Arcilloso': 'Arcilloso',
+}
+ARCILLA_SUELO_PESADO = 60
+
+def clasificar_textura_usda(arena, limo, arcilla):
+    """Clase del triángulo textural USDA (nombres en español) para arrays de porcentajes."""
+    arena, limo, arcilla = (np.asarray(v, dtype=np.float64) for v in (arena, limo, arcilla))
+    condiciones = [
+        (limo + 1.5 * arcilla < 15),
+        (limo + 2 * arcilla < 30),
+        (arcilla >= 40) & (limo >= 40),
+        (arcilla >= 35) & (arena > 45),
+        (arcilla >= 40),
+        (arcilla >= 27) & (arena <= 20),
+        (arcilla >= 27) & (arena <= 45),
+        (arcilla >= 20) & (limo < 28) & (arena > 45),
+        (limo >= 80) & (arcilla < 12),
+        (limo >= 50),
+        (arcilla >= 7) & (limo >= 28) & (arena <= 52),
+    ]
+    clases = ['Arenoso', 'Arenoso Franco', 'Arcillo Limoso', 'Arcillo Arenoso', 'Arcilloso',
+              'Franco Arcillo Limoso', 'Franco Arcilloso', 'Franco Arcillo Arenoso', 'Limoso',
+              'Franco Limoso', 'Franco']
+    return np.select(condiciones, clases, default='Franco Arenoso')
+
 def analizar_textura_suelo_venezuela_por_bloque(gdf_dividido):
-    resultados = []
+    """
+    Textura por bloque como DataFrame (índice de gdf_dividido, sin geometría).
+    Si el almacén SoilGrids local cubre la parcela, la composición medida (0-30 cm), el
+    carbono orgánico y el pH reemplazan a la estimación en los bloques cubiertos.
+    La estimación usa uniformes_por_bloque, así que cada bloque obtiene siempre los mismos
+    valores sin tocar el estado global de np.random. 'tipo_suelo' es siempre un suelo de
+    CARACTERISTICAS_SUELO y 'clase_usda' la clase del triángulo textural de la composición.
+    """
     try:
-        centroide_global = gdf_dividido.geometry.unary_union.centroid
-        lat_base = centroide_global.y
-        if lat_base > 10:
-            base = 'Franco Arcilloso'
-            alt_base = 'Arcilloso'
-        elif lat_base > 7:
-            base = 'Franco Arcilloso Arenoso'
-            alt_base = 'Franco'
-        elif lat_base > 4:
-            base = 'Arenoso Franco'
-            alt_base = 'Arenoso'
-        else:
-            base = 'Franco Arcilloso'
-            alt_base = 'Arcilloso Pesado'
+        lat_base = gdf_dividido.geometry.unary_union.centroid.y
+        base, alt_base = next((b, a) for lat_min, b, a in SUELOS_POR_LATITUD if lat_base > lat_min)
         
-        caracteristicas = {
-            'Franco Arcilloso': {
-                'arena': 35, 'limo': 25, 'arcilla': 30,
-                'textura': 'Media', 'drenaje': 'Moderado',
-                'CIC': 'Alto (15-25)', 'ret_agua': 'Alta',
-                'recomendacion': 'Ideal para cultivos'
-            },
-            'Franco Arcilloso Arenoso': {
-                'arena': 45, 'limo': 20, 'arcilla': 25,
-                'textura': 'Media-ligera', 'drenaje': 'Bueno',
-                'CIC': 'Medio (10-15)', 'ret_agua': 'Moderada',
-                'recomendacion': 'Requiere riego'
-            },
-            'Arenoso Franco': {
-                'arena': 55, 'limo': 15, 'arcilla': 20,
-                'textura': 'Ligera', 'drenaje': 'Excelente',
-                'CIC': 'Bajo (5-10)', 'ret_agua': 'Baja',
-                'recomendacion': 'Fertilización fraccionada'
-            },
-            'Arcilloso': {
-                'arena': 25, 'limo': 20, 'arcilla': 40,
-                'textura': 'Pesada', 'drenaje': 'Limitado',
-                'CIC': 'Muy alto (25-35)', 'ret_agua': 'Muy alta',
-                'recomendacion': 'Drenaje y labranza'
-            },
-            'Arcilloso Pesado': {
-                'arena': 20, 'limo': 15, 'arcilla': 50,
-                'textura': 'Muy pesada', 'drenaje': 'Muy limitado',
-                'CIC': 'Extremo (>35)', 'ret_agua': 'Extrema',
-                'recomendacion': 'Drenaje intensivo'
-            },
-            'Franco': {
-                'arena': 40, 'limo': 40, 'arcilla': 20,
-                'textura': 'Media', 'drenaje': 'Bueno',
-                'CIC': 'Medio (10-20)', 'ret_agua': 'Media',
-                'recomendacion': 'Manejo estándar'
-            },
-            'Arenoso': {
-                'arena': 70, 'limo': 15, 'arcilla': 15,
-                'textura': 'Ligera', 'drenaje': 'Excelente',
-                'CIC': 'Muy bajo (<5)', 'ret_agua': 'Muy baja',
-                'recomendacion': 'Riego frecuente'
-            }
-        }
+        u = uniformes_por_bloque(claves_bloques(gdf_dividido), 4)
+        tipos = np.where(u[:, 0] < PROBABILIDAD_SUELO_DOMINANTE, base, alt_base)
+        tabla = pd.DataFrame.from_dict(CARACTERISTICAS_SUELO, orient='index')
+        carac = tabla.loc[tipos]
         
-        for idx, row in gdf_dividido.iterrows():
-            centroid = row.geometry.centroid
-            semilla = abs(int(centroid.x * 1000 + centroid.y * 1000)) % (2**32)
-            np.random.seed(semilla)
-            r = np.random.random()
-            if r < 0.7:
-                tipo = base
-            else:
-                tipo = alt_base
-            carac = caracteristicas.get(tipo, caracteristicas['Franco Arcilloso'])
-            arena = carac['arena'] + np.random.randint(-5, 6)
-            limo = carac['limo'] + np.random.randint(-5, 6)
-            arcilla = carac['arcilla'] + np.random.randint(-5, 6)
-            total = arena + limo + arcilla
-            arena = int(arena / total * 100)
-            limo = int(limo / total * 100)
-            arcilla = 100 - arena - limo
-            resultados.append({
-                'id_bloque': row.get('id_bloque', idx+1),
-                'tipo_suelo': tipo,
-                'arena': arena,
-                'limo': limo,
-                'arcilla': arcilla,
-                'textura': carac['textura'],
-                'drenaje': carac['drenaje'],
-                'CIC': carac['CIC'],
-                'ret_agua': carac['ret_agua'],
-                'recomendacion': carac['recomendacion'],
-                'geometria': row.geometry
-            })
-        return resultados
+        composicion = carac[['arena', 'limo', 'arcilla']].to_numpy(dtype=np.int64)
+        composicion = composicion + np.floor(u[:, 1:4] * 11).astype(np.int64) - 5
+        total = composicion.sum(axis=1)
+        arena = (composicion[:, 0] * 100 // total).astype(int)
+        limo = (composicion[:, 1] * 100 // total).astype(int)
+        
+        if 'id_bloque' in gdf_dividido.columns:
+            ids = gdf_dividido['id_bloque'].values
+        else:
+            ids = np.arange(1, len(gdf_dividido) + 1)
+        df = pd.DataFrame({
+            'id_bloque': ids,
+            'tipo_suelo': tipos,
+            'clase_usda': clasificar_textura_usda(arena, limo, 100 - arena - limo).astype(object),
+            'arena': arena,
+            'limo': limo,
+            'arcilla': 100 - arena - limo,
+            'textura': carac['textura'].values,
+            'drenaje': carac['drenaje'].values,
+            'CIC': carac['CIC'].values,
+            'ret_agua': carac['ret_agua'].values,
+            'recomendacion': carac['recomendacion'].values,
+            'fuente': 'Estimado'
+        }, index=gdf_dividido.index)
+        
+        medido = propiedades_suelo_por_bloque(gdf_dividido)
+        if medido is None:
+            return df
+        for columna in ('COS_g_kg', 'pH_suelo'):
+            if columna in medido:
+                df[columna] = medido[columna].round(1)
+        if not {'arena', 'limo', 'arcilla'} <= set(medido.columns):
+            return df
+        composicion = medido[['arena', 'limo', 'arcilla']].to_numpy()
+        cubiertos = np.isfinite(composicion).all(axis=1) & (composicion.sum(axis=1) > 0)
+        if cubiertos.any():
+            composicion = composicion[cubiertos] * 100.0 / composicion[cubiertos].sum(axis=1, keepdims=True)
+            clases = clasificar_textura_usda(*composicion.T)
+            suelos = np.array([SUELO_POR_CLASE_USDA[c] for c in clases], dtype=object)
+            suelos[composicion[:, 2] >= ARCILLA_SUELO_PESADO] = 'Arcilloso Pesado'
+            carac = tabla.loc[suelos]
+            df = df.astype({'tipo_suelo': object, 'arena': float, 'limo': float, 'arcilla': float})
+            df.loc[cubiertos, 'tipo_suelo'] = suelos
+            df.loc[cubiertos, 'clase_usda'] = clases
+            df.loc[cubiertos, ['arena', 'limo', 'arcilla']] = np.round(composicion, 1)
+            for columna in ('textura', 'drenaje', 'CIC', 'ret_agua', 'recomendacion'):
+                df.loc[cubiertos, columna] = carac[columna].values
+            df.loc[cubiertos, 'fuente'] = 'SoilGrids'
+        return df
     except Exception as e:
         st.error(f"Error en análisis de textura: {e}")
-        return []
+        return None
 
 # ===== FERTILIDAD NPK =====
-def generar_mapa_fertilidad(gdf):
+UMBRALES_NDVI_FERTILIDAD = [0.75, 0.6]    # límites inferiores de las bandas alta y media
+# Rango simulado por banda de NDVI: (alta, media, baja)
+RANGOS_FERTILIDAD = {
+    'N_kg_ha': [(120, 180), (80, 120), (40, 80)],
+    'P_kg_ha': [(40, 70), (25, 40), (15, 25)],
+    'K_kg_ha': [(180, 250), (120, 180), (80, 120)],
+    'pH': [(5.8, 6.5), (5.2, 5.8), (4.8, 5.2)],
+    'MO_porcentaje': [(3.5, 5.0), (2.5, 3.5), (1.5, 2.5)],
+}
+DECIMALES_FERTILIDAD = {'N_kg_ha': 1, 'P_kg_ha': 1, 'K_kg_ha': 1, 'pH': 2, 'MO_porcentaje': 2}
+# Por cultivo y nutriente: (nivel de suficiencia, objetivo) en kg/ha de N, P2O5 y K2O
+OBJETIVOS_NUTRIENTES = {
+    'Trigo': {'N': (100, 120), 'P': (30, 50), 'K': (150, 200)},
+    'Maíz': {'N': (130, 160), 'P': (35, 60), 'K': (160, 220)},
+    'Soja': {'N': (60, 70), 'P': (35, 55), 'K': (170, 220)},
+    'Girasol': {'N': (90, 110), 'P': (25, 45), 'K': (150, 200)},
+}
+# Fertilizante y ley (fracción del nutriente) usados para cubrir cada déficit
+FERTILIZANTES = {'N': ('urea', 0.46), 'P': ('DAP', 0.46), 'K': ('KCl', 0.60)}
+COLUMNAS_NUTRIENTES = {'N': 'N_kg_ha', 'P': 'P_kg_ha', 'K': 'K_kg_ha'}
+# Código de recomendación: bit 1 = N, bit 2 = P, bit 4 = K
+CODIGOS_RECOMENDACION = ['Mantener', 'N', 'P', 'N+P', 'K', 'N+K', 'P+K', 'N+P+K']
+
+def recomendaciones_fertilizacion(df, cultivo='Trigo'):
+    """
+    Dosis por bloque (kg/ha de nutriente y de producto comercial) para los nutrientes por
+    debajo del nivel de suficiencia del cultivo, más un código categórico con los
+    nutrientes a aplicar. Todo en columnas, sin texto por fila.
+    """
+    objetivos = OBJETIVOS_NUTRIENTES.get(cultivo, OBJETIVOS_NUTRIENTES['Trigo'])
+    salida = {}
+    codigo = np.zeros(len(df), dtype=np.int8)
+    for bit, (nutriente, columna) in enumerate(COLUMNAS_NUTRIENTES.items()):
+        suficiencia, objetivo = objetivos[nutriente]
+        actual = df[columna].to_numpy(dtype=np.float64)
+        deficit = np.where(actual < suficiencia, np.clip(objetivo - actual, 0, None), 0.0)
+        producto, ley = FERTILIZANTES[nutriente]
+        salida[f'dosis_{nutriente}_kg_ha'] = np.round(deficit, 0)
+        salida[f'{producto}_kg_ha'] = np.round(deficit / ley, 0)
+        codigo |= (deficit > 0).astype(np.int8) << bit
+    salida['codigo_recomendacion'] = pd.Categorical.from_codes(codigo, CODIGOS_RECOMENDACION)
+    return pd.DataFrame(salida, index=df.index)
+
+def generar_mapa_fertilidad(gdf, cultivo='Trigo', muestras=None):
+    """
+    Fertilidad simulada por bloque según la banda de NDVI (np.select) y dosis para el
+    cultivo. Las extracciones salen de uniformes_por_bloque, así que son deterministas por
+    bloque. Con `muestras` de laboratorio, sus valores interpolados reemplazan a los
+    simulados en cada variable medida. Devuelve (DataFrame con el índice de gdf y sin
+    geometría, tabla de validación LOO por variable o None), o (None, None) si falla.
+    """
     try:
-        fertilidad_data = []
-        for idx, row in gdf.iterrows():
-            ndvi = row.get('ndvi_modis', 0.65)
-            if ndvi > 0.75:
-                N = np.random.uniform(120, 180)
-                P = np.random.uniform(40, 70)
-                K = np.random.uniform(180, 250)
-                pH = np.random.uniform(5.8, 6.5)
-                MO = np.random.uniform(3.5, 5.0)
-            elif ndvi > 0.6:
-                N = np.random.uniform(80, 120)
-                P = np.random.uniform(25, 40)
-                K = np.random.uniform(120, 180)
-                pH = np.random.uniform(5.2, 5.8)
-                MO = np.random.uniform(2.5, 3.5)
-            else:
-                N = np.random.uniform(40, 80)
-                P = np.random.uniform(15, 25)
-                K = np.random.uniform(80, 120)
-                pH = np.random.uniform(4.8, 5.2)
-                MO = np.random.uniform(1.5, 2.5)
-            
-            if N < 100:
-                rec_N = f"Aplicar {max(0, 120-N):.0f} kg/ha N (Urea: {max(0, (120-N)/0.46):.0f} kg/ha)"
-            else:
-                rec_N = "Mantener dosis actual"
-            if P < 30:
-                rec_P = f"Aplicar {max(0, 50-P):.0f} kg/ha P2O5 (DAP: {max(0, (50-P)/0.46):.0f} kg/ha)"
+        if 'ndvi_modis' in gdf.columns:
+            ndvi = gdf['ndvi_modis'].to_numpy(dtype=np.float64)
+        else:
+            ndvi = np.full(len(gdf), 0.65)
+        banda = np.select([ndvi > UMBRALES_NDVI_FERTILIDAD[0], ndvi > UMBRALES_NDVI_FERTILIDAD[1]], [0, 1], default=2)
+        u = uniformes_por_bloque(claves_bloques(gdf), len(RANGOS_FERTILIDAD), flujo=1)
+        
+        datos = {'id_bloque': gdf['id_bloque'].values if 'id_bloque' in gdf.columns else np.arange(1, len(gdf) + 1)}
+        for j, (columna, rangos) in enumerate(RANGOS_FERTILIDAD.items()):
+            limites = np.asarray(rangos, dtype=np.float64)[banda]
+            datos[columna] = np.round(limites[:, 0] + u[:, j] * (limites[:, 1] - limites[:, 0]),
+                                      DECIMALES_FERTILIDAD[columna])
+        df = pd.DataFrame(datos, index=gdf.index)
+        validacion = None
+        if muestras is not None and len(muestras):
+            medidos, validacion = interpolar_muestras_a_bloques(muestras, gdf)
+            for columna in medidos.columns:
+                valores = medidos[columna].round(DECIMALES_FERTILIDAD[columna])
+                df[columna] = valores.where(valores.notna(), df[columna])
+        df = pd.concat([df, recomendaciones_fertilizacion(df, cultivo)], axis=1)
+        df.attrs['cultivo'] = cultivo
+        return df, validacion
+    except Exception as e:
+        st.error(f"Error en análisis de fertilidad: {e}")
+        return None, None
+
+# ===== MUESTRAS DE LABORATORIO =====
+# Nombre normalizado (minúsculas, sin acentos ni espacios) -> columna de la app
+ALIAS_COLUMNAS_MUESTRAS = {
+    'n': 'N_kg_ha', 'n_kg_ha': 'N_kg_ha', 'nitrogeno': 'N_kg_ha',
+    'p': 'P_kg_ha', 'p_kg_ha': 'P_kg_ha', 'fosforo': 'P_kg_ha', 'p2o5': 'P_kg_ha',
+    'k': 'K_kg_ha', 'k_kg_ha': 'K_kg_ha', 'potasio': 'K_kg_ha', 'k2o': 'K_kg_ha',
+    'ph': 'pH', 'mo': 'MO_porcentaje', 'mo_porcentaje': 'MO_porcentaje', 'materia_organica': 'MO_porcentaje',
+    'om': 'MO_porcentaje', 'lon': 'x', 'longitud': 'x', 'long': 'x', 'x': 'x', 'este': 'x',
+    'lat': 'y', 'latitud': 'y', 'y': 'y', 'norte': 'y',
+}
+# Rango físicamente plausible de cada variable; fuera de él el valor se descarta
+RANGOS_VALIDOS_MUESTRAS = {
+    'N_kg_ha': (0, 600), 'P_kg_ha': (0, 400), 'K_kg_ha': (0, 1500), 'pH': (3.0, 10.0), 'MO_porcentaje': (0, 30),
+}
+VECINOS_MUESTRAS = 8           # vecinos del IDW que lleva las muestras a los bloques
+DECIMALES_COORD_MUESTRAS = 6   # muestras repetidas en el mismo punto (~0.1 m) se promedian
+
+def _normalizar_nombre_columna(nombre):
+    import unicodedata
+    texto = unicodedata.normalize('NFKD', str(nombre)).encode('ascii', 'ignore').decode()
+    return re.sub(r'[^a-z0-9]+', '_', texto.strip().lower()).strip('_')
+
+def coordenadas_locales(lon, lat, lat_ref):
+    """Proyección equirectangular local en metros, suficiente para vecinos dentro de un campo."""
+    return np.column_stack((np.asarray(lon) * 111320.0 * math.cos(math.radians(lat_ref)),
+                            np.asarray(lat) * 110540.0))
+
+def validar_muestras(df):
+    """
+    Validación vectorizada: convierte a número, descarta valores fuera de RANGOS_VALIDOS_MUESTRAS,
+    filas sin coordenadas o sin ninguna variable y promedia muestras repetidas en un mismo punto.
+    Devuelve (DataFrame limpio con x/y en grados, resumen de la validación).
+    """
+    variables = [c for c in RANGOS_VALIDOS_MUESTRAS if c in df.columns]
+    datos = df[['x', 'y'] + variables].apply(pd.to_numeric, errors='coerce')
+    resumen = {'filas': len(datos)}
+    fuera = {}
+    for columna in variables:
+        minimo, maximo = RANGOS_VALIDOS_MUESTRAS[columna]
+        invalidos = ~datos[columna].between(minimo, maximo) & datos[columna].notna()
+        fuera[columna] = int(invalidos.sum())
+        datos.loc[invalidos, columna] = np.nan
+    resumen['fuera_de_rango'] = fuera
+    coordenadas_ok = datos['x'].between(-180, 180) & datos['y'].between(-90, 90)
+    con_datos = datos[variables].notna().any(axis=1)
+    resumen['sin_coordenadas'] = int((~coordenadas_ok).sum())
+    resumen['sin_variables'] = int((coordenadas_ok & ~con_datos).sum())
+    datos = datos[coordenadas_ok & con_datos]
+    puntos = datos[['x', 'y']].round(DECIMALES_COORD_MUESTRAS)
+    datos = datos[variables].groupby([puntos['x'], puntos['y']]).mean().reset_index()
+    resumen['duplicadas'] = int(coordenadas_ok.sum() - resumen['sin_variables'] - len(datos))
+    resumen['validas'] = len(datos)
+    return datos, resumen
+
+def cargar_muestras_laboratorio(uploaded_file, crs_csv='EPSG:4326'):
+    """
+    Carga resultados de laboratorio puntuales desde CSV (columnas de coordenadas en `crs_csv`)
+    o GeoPackage/GeoJSON (CRS del archivo). Devuelve un GeoDataFrame de puntos en EPSG:4326 con
+    las columnas de fertilidad presentes y el resumen de validación en attrs, o None.
+    """
+    try:
+        contenido = uploaded_file.read()
+        ext = os.path.splitext(uploaded_file.name)[1].lower()
+        if ext == '.csv':
+            df = pd.read_csv(io.BytesIO(contenido), sep=None, engine='python')
+            df = df.rename(columns=lambda c: ALIAS_COLUMNAS_MUESTRAS.get(_normalizar_nombre_columna(c), c))
+            if not {'x', 'y'} <= set(df.columns):
+                st.error("❌ El CSV debe tener columnas de coordenadas (lon/lat o x/y)")
+                return None
+            x = pd.to_numeric(df['x'], errors='coerce').to_numpy()
+            y = pd.to_numeric(df['y'], errors='coerce').to_numpy()
+            puntos = gpd.GeoSeries(shapely.points(x, y), crs=crs_csv).to_crs('EPSG:4326')
+        elif ext in ('.gpkg', '.geojson'):
+            gdf = gpd.read_file(io.BytesIO(contenido))
+            if gdf.crs is None:
+                gdf = gdf.set_crs(crs_csv)
+            gdf = gdf.to_crs('EPSG:4326').explode(index_parts=False, ignore_index=True)
+            gdf = gdf[gdf.geometry.geom_type == 'Point']
+            df = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+            df = df.rename(columns=lambda c: ALIAS_COLUMNAS_MUESTRAS.get(_normalizar_nombre_columna(c), c))
+            df = df.drop(columns=[c for c in ('x', 'y') if c in df.columns])
+            puntos = gdf.geometry
+        else:
+            st.error(f"❌ Formato no soportado: {ext}. Use .csv, .gpkg o .geojson")
+            return None
+        
+        df = df.loc[:, ~df.columns.duplicated()].copy()
+        df['x'] = shapely.get_x(puntos.values)
+        df['y'] = shapely.get_y(puntos.values)
+        if not any(c in df.columns for c in RANGOS_VALIDOS_MUESTRAS):
+            st.error("❌ No se encontraron columnas N, P, K, pH o MO en el archivo")
+            return None
+        datos, resumen = validar_muestras(df)
+        if len(datos) == 0:
+            st.error("❌ Ninguna muestra pasó la validación")
+            return None
+        muestras = gpd.GeoDataFrame(datos.drop(columns=['x', 'y']),
+                                    geometry=gpd.points_from_xy(datos['x'], datos['y']), crs='EPSG:4326')
+        muestras.attrs['validacion'] = resumen
+        return muestras
+    except Exception as e:
+        st.error(f"❌ Error al cargar muestras: {str(e)[:200]}")
+        return None
+
+def validacion_cruzada_loo(puntos, valores, k=VECINOS_MUESTRAS, epsilon=1e-6):
+    """
+    Validación cruzada dejando uno afuera del IDW, sin reajustar n veces: una sola consulta
+    de k+1 vecinos por muestra y se descarta el propio punto (el primero, a distancia 0).
+    Devuelve las predicciones LOO.
+    """
+    k = min(k, len(puntos) - 1)
+    distancias, indices = KDTree(puntos).query(puntos, k=k + 1)
+    distancias, indices = distancias[:, 1:].reshape(len(puntos), k), indices[:, 1:].reshape(len(puntos), k)
+    pesos = 1.0 / (distancias + epsilon)
+    return np.einsum('mk,mk->m', pesos, valores[indices]) / pesos.sum(axis=1)
+
+def metricas_loo(observado, predicho):
+    error = predicho - observado
+    sst = np.sum((observado - observado.mean()) ** 2)
+    return {'n': len(observado), 'RMSE': float(np.sqrt(np.mean(error ** 2))),
+            'MAE': float(np.mean(np.abs(error))),
+            'R2': float(1.0 - np.sum(error ** 2) / sst) if sst > 0 else np.nan}
+
+def interpolar_muestras_a_bloques(muestras, gdf):
+    """
+    Lleva las muestras a los bloques con el motor de interpolación (plan IDW sobre la grilla
+    adaptativa de la parcela) y promedia los nodos de cada bloque con las estadísticas
+    zonales. Las variables con el mismo conjunto de muestras válidas comparten el plan.
+    Devuelve (DataFrame alineado con gdf, DataFrame de validación LOO por variable).
+    """
+    bounds = gdf.total_bounds
+    lat_ref = (bounds[1] + bounds[3]) / 2
+    nx, ny = resolucion_grilla_adaptativa(bounds)
+    a, e = (bounds[2] - bounds[0]) / (nx - 1), (bounds[1] - bounds[3]) / (ny - 1)
+    transform = (a, 0.0, bounds[0] - a / 2, 0.0, e, bounds[3] - e / 2)
+    zonas = rasterizar_zonas(gdf, (ny, nx), transform).ravel()
+    nodos_grados = crear_grilla_interpolacion(bounds, nx, ny)
+    centroides = centroides_bloques(gdf)
+    # Los bloques sin nodos (más chicos que una celda) se evalúan en su centroide
+    sin_nodos = np.bincount(zonas[zonas >= 0], minlength=len(gdf)) == 0
+    nodos = coordenadas_locales(*np.vstack((nodos_grados[zonas >= 0], centroides[sin_nodos])).T, lat_ref)
+    zonas_nodos = np.concatenate((zonas[zonas >= 0], np.flatnonzero(sin_nodos)))
+    
+    puntos_todos = coordenadas_locales(muestras.geometry.x.values, muestras.geometry.y.values, lat_ref)
+    resultado, validacion, planes = {}, {}, {}
+    for columna in RANGOS_VALIDOS_MUESTRAS:
+        if columna not in muestras.columns:
+            continue
+        valores = muestras[columna].to_numpy(dtype=np.float64)
+        validas = np.isfinite(valores)
+        if validas.sum() < 2:
+            continue
+        firma = hashlib.sha1(np.packbits(validas).tobytes()).hexdigest()
+        if firma not in planes:
+            planes[firma] = plan_idw(puntos_todos[validas], nodos, k=VECINOS_MUESTRAS)
+        en_nodos = aplicar_plan_interpolacion(planes[firma], valores[validas])
+        resultado[columna] = finalizar_zonal(acumular_zonal(None, en_nodos, zonas_nodos, len(gdf)))['media']
+        predicho = validacion_cruzada_loo(puntos_todos[validas], valores[validas])
+        validacion[columna] = metricas_loo(valores[validas], predicho)
+    return pd.DataFrame(resultado, index=gdf.index), pd.DataFrame(validacion).T
+
+# ===== PRESCRIPCIONES DE DOSIS VARIABLE =====
+PRODUCTOS_PRESCRIPCION = {'Urea': 'urea_kg_ha', 'DAP': 'DAP_kg_ha', 'KCl': 'KCl_kg_ha'}
+PASO_DOSIS_KG_HA = 25              # ancho de los rangos de dosis que se fusionan en una zona
+MAX_VERTICES_PRESCRIPCION = 20000  # presupuesto total de vértices del controlador
+VERTICES_POR_ZONA = 10             # vértices reservados por zona: fija el número máximo de zonas
+DDI_DOSIS_MASA = '0006'            # ISO 11783-11: Setpoint Mass Per Area Application Rate (mg/m²)
+PRJ_WGS84 = ('GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],'
+             'PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]]')
+
+def pares_adyacentes(geoms):
+    """Pares (i, j), i < j, de polígonos que comparten un tramo de borde (no solo un vértice)."""
+    geoms = np.asarray(geoms, dtype=object)
+    i, j = shapely.STRtree(geoms).query(geoms)
+    mantener = i < j
+    i, j = i[mantener], j[mantener]
+    # Interiores disjuntos y bordes que se cortan en una línea
+    comparten = shapely.relate_pattern(geoms[i], geoms[j], 'F***1****')
+    return i[comparten], j[comparten]
+
+def _componentes(n, i, j):
+    """Etiquetas 0..k-1 de las componentes conexas del grafo no dirigido (i, j) sobre n nodos."""
+    grafo = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(n, n))
+    return connected_components(grafo, directed=False)[1]
+
+def zonas_prescripcion(gdf, columna, paso=PASO_DOSIS_KG_HA, max_zonas=None):
+    """
+    Agrupa la dosis en rangos de `paso` kg/ha y forma zonas con los bloques contiguos (que
+    comparten borde) del mismo rango. Si hay más de `max_zonas`, las zonas más chicas se
+    funden en su vecina de mayor superficie (y toman su dosis) hasta que el número entra.
+    Una fila por zona con 'dosis' (kg/ha de producto).
+    """
+    geoms = np.asarray(gdf.geometry.values, dtype=object)
+    dosis = np.round(gdf[columna].fillna(0).to_numpy(dtype=np.float64) / paso) * paso
+    area = gdf.geometry.to_crs(gdf.geometry.estimate_utm_crs()).area.to_numpy()
+    i, j = pares_adyacentes(geoms)
+    n = len(geoms)
+    
+    while True:
+        misma = dosis[i] == dosis[j]
+        zona = _componentes(n, i[misma], j[misma])
+        n_zonas = int(zona.max()) + 1 if n else 0
+        if max_zonas is None or n_zonas <= max_zonas:
+            break
+        area_zona = np.bincount(zona, weights=area, minlength=n_zonas)
+        dosis_zona = np.empty(n_zonas)
+        dosis_zona[zona] = dosis
+        # Las (n_zonas - max_zonas) zonas más chicas pasan a su vecina de mayor superficie
+        chicas = np.zeros(n_zonas, dtype=bool)
+        chicas[np.argsort(area_zona, kind='stable')[:n_zonas - max_zonas]] = True
+        a = np.concatenate([zona[i[~misma]], zona[j[~misma]]])
+        b = np.concatenate([zona[j[~misma]], zona[i[~misma]]])
+        a, b = a[chicas[a]], b[chicas[a]]
+        if len(a) == 0:
+            break  # las zonas chicas restantes no tienen vecinas (partes aisladas del lote)
+        orden = np.lexsort((area_zona[b], a))
+        ultimo = np.r_[a[orden][1:] != a[orden][:-1], True]
+        origen, destino = a[orden][ultimo], b[orden][ultimo]
+        # Cadenas (una zona chica que va a otra chica) se resuelven por componentes: cada
+        # grupo toma la dosis de su zona de mayor superficie.
+        grupo = _componentes(n_zonas, origen, destino)
+        orden = np.lexsort((area_zona, grupo))
+        mayor = orden[np.r_[grupo[orden][1:] != grupo[orden][:-1], True]]
+        dosis = dosis_zona[mayor[grupo]][zona]
+    
+    base = gpd.GeoDataFrame({'zona': zona, 'dosis': dosis}, geometry=geoms, crs=gdf.crs)
+    try:
+        # Los bloques forman una cobertura: la unión por cobertura es mucho más rápida
+        zonas = base.dissolve(by='zona', aggfunc='first', as_index=False, method='coverage')
+    except Exception:
+        zonas = base.dissolve(by='zona', aggfunc='first', as_index=False)
+    zonas = zonas.explode(index_parts=False, ignore_index=True)
+    return zonas.loc[zonas.geometry.geom_type == 'Polygon', ['dosis', 'geometry']].reset_index(drop=True)
+
+def simplificar_a_presupuesto(geoms, max_vertices=MAX_VERTICES_PRESCRIPCION, tolerancia=None):
+    """
+    Duplica la tolerancia de simplificación hasta que el total de vértices entra en el
+    presupuesto, o hasta que deja de bajar. Las zonas forman una cobertura: coverage_simplify
+    mueve cada borde compartido una sola vez y deja fijo el contorno del lote, así que no
+    quedan huecos ni solapes y la superficie total no cambia. Sin coverage_simplify
+    (shapely < 2.1) solo se quitan los vértices colineales.
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    resultado = shapely.simplify(geoms, 0.0)
+    if shapely.get_num_coordinates(resultado).sum() <= max_vertices:
+        return resultado
+    if not hasattr(shapely, 'coverage_simplify'):
+        return resultado
+    if tolerancia is None:
+        # Un cuarto del lado típico de un bloque: por debajo no se quita ningún escalón
+        tolerancia = 0.25 * float(np.sqrt(np.median(shapely.area(geoms))))
+    anterior = shapely.get_num_coordinates(resultado).sum()
+    for _ in range(30):
+        candidato = shapely.coverage_simplify(geoms, tolerancia, simplify_boundary=False)
+        vertices = shapely.get_num_coordinates(candidato).sum()
+        if vertices >= anterior:
+            break
+        resultado, anterior = candidato, vertices
+        if vertices <= max_vertices:
+            break
+        tolerancia *= 2
+    return resultado
+
+def _anillos_shapefile(poligono):
+    """Anillos con la orientación de shapefile: exterior horario, huecos antihorarios."""
+    from shapely.geometry.polygon import orient
+    p = orient(poligono, sign=-1.0)
+    return [np.asarray(p.exterior.coords)[:, :2]] + [np.asarray(r.coords)[:, :2] for r in p.interiors]
+
+def _dbf(registros, campos):
+    """Tabla dBase III; campos = [(nombre, tipo 'N'/'C', largo, decimales)]."""
+    hoy = datetime.now()
+    largo_registro = 1 + sum(c[2] for c in campos)
+    cabecera = struct.pack('<BBBBIHH20x', 3, hoy.year - 1900, hoy.month, hoy.day, len(registros),
+                           32 + 32 * len(campos) + 1, largo_registro)
+    descriptores = b''.join(struct.pack('<11sc4xBB14x', nombre.encode('ascii'), tipo.encode('ascii'), largo, dec)
+                            for nombre, tipo, largo, dec in campos)
+    filas = []
+    for registro in registros:
+        fila = [b' ']
+        for (nombre, tipo, largo, dec), valor in zip(campos, registro):
+            if tipo == 'N':
+                texto = f"{valor:.{dec}f}".rjust(largo)
             else:
-                rec_P = "Mantener dosis actual"
-            if K < 150:
-                rec_K = f"Aplicar {max(0, 200-K):.0f} kg/ha K2O (KCl: {max(0, (200-K)/0.6):.0f} kg/ha)"
+                texto = str(valor).ljust(largo)
+            fila.append(texto[:largo].encode('latin-1', 'replace'))
+        filas.append(b''.join(fila))
+    return cabecera + descriptores + b'\r' + b''.join(filas) + b'\x1a'
+
+def escribir_shapefile_zip(zf, nombre, geoms, registros, campos):
+    """Escribe .shp/.shx/.dbf/.prj de polígonos (tipo 5) directamente en el ZIP abierto."""
+    contenidos, indices = [], []
+    offset = 50  # palabras de 16 bits tras la cabecera
+    limites = shapely.total_bounds(geoms)
+    for n, geom in enumerate(geoms, start=1):
+        anillos = _anillos_shapefile(geom)
+        puntos = np.concatenate(anillos)
+        partes = np.cumsum([0] + [len(a) for a in anillos[:-1]])
+        xmin, ymin = puntos.min(axis=0)
+        xmax, ymax = puntos.max(axis=0)
+        cuerpo = (struct.pack('<i4d2i', 5, xmin, ymin, xmax, ymax, len(anillos), len(puntos)) +
+                  np.asarray(partes, dtype='<i4').tobytes() + np.ascontiguousarray(puntos, dtype='<f8').tobytes())
+        contenidos.append(struct.pack('>2i', n, len(cuerpo) // 2) + cuerpo)
+        indices.append(struct.pack('>2i', offset, len(cuerpo) // 2))
+        offset += 4 + len(cuerpo) // 2
+    
+    def cabecera(largo_palabras):
+        return (struct.pack('>7i', 9994, 0, 0, 0, 0, 0, largo_palabras) +
+                struct.pack('<2i4d4d', 1000, 5, *limites, 0.0, 0.0, 0.0, 0.0))
+    zf.writestr(f"{nombre}.shp", cabecera(offset) + b''.join(contenidos))
+    zf.writestr(f"{nombre}.shx", cabecera(50 + 4 * len(indices)) + b''.join(indices))
+    zf.writestr(f"{nombre}.dbf", _dbf(registros, campos))
+    zf.writestr(f"{nombre}.prj", PRJ_WGS84)
+
+def escribir_isoxml_zip(zf, zonas, producto, nombre_lote='Lote'):
+    """
+    TASKDATA/TASKDATA.XML (ISO 11783-10) con una tarea planificada: una zona de tratamiento
+    por dosis (PDV con DDI 0006 en mg/m²) y sus polígonos; se escribe en streaming al ZIP.
+    """
+    from xml.sax.saxutils import quoteattr
+    def lsg(anillo, tipo):
+        puntos = ''.join(f'<PNT A="2" C="{lat:.9f}" D="{lon:.9f}"/>' for lon, lat in anillo)
+        return f'<LSG A="{tipo}">{puntos}</LSG>'
+    def pln(poligono, tipo):
+        anillos = [np.asarray(poligono.exterior.coords)] + [np.asarray(r.coords) for r in poligono.interiors]
+        return f'<PLN A="{tipo}">' + ''.join(lsg(a, 1 if i == 0 else 2) for i, a in enumerate(anillos)) + '</PLN>'
+    
+    area_m2 = int(round(zonas.to_crs(zonas.estimate_utm_crs()).area.sum()))
+    with zf.open('TASKDATA/TASKDATA.XML', 'w') as destino:
+        escribir = lambda texto: destino.write(texto.encode('utf-8'))
+        escribir('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<ISO11783_TaskData VersionMajor="4" VersionMinor="0" DataTransferOrigin="1" '
+                 'ManagementSoftwareManufacturer="DiagnosticoFertilidad" ManagementSoftwareVersion="1.0">\n')
+        escribir(f'<PDT A="PDT1" B={quoteattr(producto)}/>\n')
+        escribir(f'<PFD A="PFD1" C={quoteattr(nombre_lote)} D="{area_m2}">'
+                 + ''.join(pln(p, 1) for p in getattr(zonas.unary_union, 'geoms', [zonas.unary_union])
+                           if p.geom_type == 'Polygon')
+                 + '</PFD>\n')
+        escribir(f'<TSK A="TSK1" B={quoteattr("Prescripción " + producto)} E="PFD1" G="1" H="0">\n')
+        escribir('<TZN A="0" B="Fuera de zona"><PDV A="' + DDI_DOSIS_MASA + '" B="0" C="PDT1"/></TZN>\n')
+        for codigo, (dosis, grupo) in enumerate(zonas.groupby('dosis'), start=1):
+            # 1 kg/ha = 100 mg/m²
+            escribir(f'<TZN A="{codigo}" B="{dosis:.0f} kg/ha"><PDV A="{DDI_DOSIS_MASA}" B="{int(round(dosis * 100))}" C="PDT1"/>')
+            for poligono in grupo.geometry:
+                escribir(pln(poligono, 2))
+            escribir('</TZN>\n')
+        escribir('</TSK>\n</ISO11783_TaskData>\n')
+
+def exportar_prescripcion(gdf, producto, formato='Shapefile', paso=PASO_DOSIS_KG_HA,
+                          max_vertices=MAX_VERTICES_PRESCRIPCION):
+    """
+    Mapa de prescripción de `producto` (Urea, DAP o KCl) desde las columnas de fertilidad:
+    zonas por rango de dosis (las más chicas se funden en sus vecinas hasta que el número de
+    zonas entra en el presupuesto), simplificadas al presupuesto de vértices y escritas en un
+    ZIP en memoria (Shapefile o ISOXML). Devuelve (bytes, n_zonas, n_vertices), o None si no
+    se puede respetar el presupuesto.
+    """
+    try:
+        zonas = zonas_prescripcion(gdf, PRODUCTOS_PRESCRIPCION[producto], paso,
+                                   max_zonas=max(1, max_vertices // VERTICES_POR_ZONA))
+        geoms = simplificar_a_presupuesto(zonas.geometry.values, max_vertices)
+        zonas = zonas.set_geometry(gpd.GeoSeries(geoms, index=zonas.index, crs=zonas.crs))
+        zonas = zonas[~zonas.geometry.is_empty & (zonas.geometry.geom_type == 'Polygon')].reset_index(drop=True)
+        if len(zonas) == 0:
+            st.warning("No hay zonas para exportar.")
+            return None
+        n_vertices = int(shapely.get_num_coordinates(zonas.geometry.values).sum())
+        if n_vertices > max_vertices:
+            st.error(f"La prescripción necesita {n_vertices:,} vértices y el presupuesto es de {max_vertices:,}. "
+                     "Amplíe el rango de dosis o el máximo de vértices.")
+            return None
+        
+        buffer = BytesIO()
+        nombre = f"prescripcion_{producto.lower()}"
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+            if formato == 'ISOXML':
+                escribir_isoxml_zip(zf, zonas, producto)
             else:
-                rec_K = "Mantener dosis actual"
-            
-            fertilidad_data.append({
-                'id_bloque': row.get('id_bloque', idx+1),
-                'N_kg_ha': round(N, 1),
-                'P_kg_ha': round(P, 1),
-                'K_kg_ha': round(K, 1),
-                'pH': round(pH, 2),
-                'MO_porcentaje': round(MO, 2),
-                'recomendacion_N': rec_N,
-                'recomendacion_P': rec_P,
-                'recomendacion_K': rec_K,
-                'geometria': row.geometry
-            })
-        return fertilidad_data
-    except Exception:
+                areas = zonas.to_crs(zonas.estimate_utm_crs()).area.values / 10000.0
+                registros = [(i + 1, d, producto, a) for i, (d, a) in enumerate(zip(zonas['dosis'], areas))]
+                campos = [('ZONA', 'N', 10, 0), ('DOSIS', 'N', 12, 1), ('PRODUCTO', 'C', 10, 0), ('AREA_HA', 'N', 12, 3)]
+                escribir_shapefile_zip(zf, nombre, zonas.geometry.values, registros, campos)
+        return buffer.getvalue(), len(zonas), n_vertices
+    except Exception as e:
+        st.error(f"Error al generar la prescripción: {str(e)[:200]}")
+        return None
+
+# ===== MOTOR DE INTERPOLACIÓN =====
+TAM_CELDA_GRILLA_M = 5.0       # tamaño objetivo de celda del mapa de calor (m)
+RESOLUCION_GRILLA_MIN = 100
+RESOLUCION_GRILLA_MAX = 500
+RBF_VECINOS = 32               # centros por vecindario local
+RBF_SUAVIZADO = 0.1
+TAM_LOTE_INTERPOLACION = 2048  # nodos de grilla evaluados por lote
+KRIGING_VECINOS = 24
+KRIGING_MAX_PUNTOS_VARIOGRAMA = 2000
+
+def centroides_bloques(gdf):
+    """Coordenadas (x, y) de los centroides de los bloques como arreglo (n, 2)."""
+    centroides = gdf.geometry.centroid
+    return np.column_stack((centroides.x.values, centroides.y.values))
+
+def resolucion_grilla_adaptativa(bounds, tam_celda_m=TAM_CELDA_GRILLA_M,
+                                 minimo=RESOLUCION_GRILLA_MIN, maximo=RESOLUCION_GRILLA_MAX):
+    """
+    Elige (nx, ny) según el tamaño real de la parcela para mantener ~tam_celda_m por píxel,
+    respetando la relación de aspecto y acotando el lado mayor a [minimo, maximo].
+    """
+    minx, miny, maxx, maxy = bounds
+    lat_media = math.radians((miny + maxy) / 2)
+    ancho_m = max((maxx - minx) * 111320 * math.cos(lat_media), 1e-6)
+    alto_m = max((maxy - miny) * 110540, 1e-6)
+    lado_mayor = int(np.clip(math.ceil(max(ancho_m, alto_m) / tam_celda_m), minimo, maximo))
+    escala = lado_mayor / max(ancho_m, alto_m)
+    nx = max(int(round(ancho_m * escala)), 2)
+    ny = max(int(round(alto_m * escala)), 2)
+    return nx, ny
+
+def crear_grilla_interpolacion(bounds, nx, ny):
+    """
+    Nodos de la grilla (fila 0 = norte, como espera ImageOverlay) en un arreglo (ny*nx, 2).
+    """
+    minx, miny, maxx, maxy = bounds
+    xi = np.linspace(minx, maxx, nx)
+    yi = np.linspace(maxy, miny, ny)
+    XI, YI = np.meshgrid(xi, yi)
+    return np.column_stack((XI.ravel(), YI.ravel()))
+
+def plan_idw(puntos, nodos, k=8, epsilon=1e-6):
+    """Plan IDW: índices de los k vecinos de cada nodo y pesos normalizados."""
+    tree = KDTree(puntos)
+    k = min(k, len(puntos))
+    distancias, indices = tree.query(nodos, k=k)
+    if k == 1:
+        return {'indices': indices[:, None], 'pesos': np.ones((len(nodos), 1)), 'metodo': 'idw'}
+    pesos = 1.0 / (distancias + epsilon)
+    pesos /= np.sum(pesos, axis=1, keepdims=True)
+    return {'indices': indices, 'pesos': pesos, 'metodo': 'idw'}
+
+def _kernel_multicuadrico(r, epsilon):
+    # Multicuádrico con signo negativo (condicionalmente definido positivo), como scipy RBFInterpolator
+    return -np.sqrt(1.0 + (r / epsilon) ** 2)
+
+def plan_rbf_local(puntos, nodos, vecinos=RBF_VECINOS, suavizado=RBF_SUAVIZADO,
+                   tam_lote=TAM_LOTE_INTERPOLACION):
+    """
+    RBF multicuádrica limitada a vecindarios: cada nodo se ajusta sólo con sus `vecinos`
+    centros más cercanos (sistema (k+1)x(k+1) con término constante), resuelto en lotes.
+    Costo O(m·k³) en lugar de O(n³) + O(n·m) de la RBF global.
+    La predicción es lineal en los valores, así que se guardan los pesos de cada nodo.
+    """
+    n = len(puntos)
+    k = min(vecinos, n)
+    extension = np.ptp(puntos, axis=0)
+    epsilon = float(np.sqrt(max(extension[0] * extension[1], 1e-18) / n)) or 1e-6
+    tree = KDTree(puntos)
+    indices_plan = np.empty((len(nodos), k), dtype=np.int64)
+    pesos_plan = np.empty((len(nodos), k), dtype=np.float64)
+    
+    for ini in range(0, len(nodos), tam_lote):
+        lote = nodos[ini:ini + tam_lote]
+        distancias, indices = tree.query(lote, k=k)
+        vecinos_xy = puntos[indices]
+        d_centros = np.linalg.norm(vecinos_xy[:, :, None, :] - vecinos_xy[:, None, :, :], axis=-1)
+        m = len(lote)
+        sistema = np.zeros((m, k + 1, k + 1))
+        sistema[:, :k, :k] = _kernel_multicuadrico(d_centros, epsilon) + suavizado * np.eye(k)
+        sistema[:, :k, k] = 1.0
+        sistema[:, k, :k] = 1.0
+        lado_derecho = np.ones((m, k + 1, 1))
+        lado_derecho[:, :k, 0] = _kernel_multicuadrico(distancias, epsilon)
+        indices_plan[ini:ini + tam_lote] = indices
+        pesos_plan[ini:ini + tam_lote] = np.linalg.solve(sistema, lado_derecho)[:, :k, 0]
+    return {'indices': indices_plan, 'pesos': pesos_plan, 'metodo': 'rbf'}
+
+# Modelos de variograma: h = distancia; parámetros (pepita, meseta parcial, rango práctico)
+def _variograma_esferico(h, pepita, meseta, rango):
+    hr = np.minimum(h / rango, 1.0)
+    return pepita + meseta * (1.5 * hr - 0.5 * hr ** 3)
+
+def _variograma_exponencial(h, pepita, meseta, rango):
+    return pepita + meseta * (1.0 - np.exp(-3.0 * h / rango))
+
+def _variograma_gaussiano(h, pepita, meseta, rango):
+    return pepita + meseta * (1.0 - np.exp(-3.0 * (h / rango) ** 2))
+
+MODELOS_VARIOGRAMA = {
+    'esferico': _variograma_esferico,
+    'exponencial': _variograma_exponencial,
+    'gaussiano': _variograma_gaussiano
+}
+
+def evaluar_variograma(modelo, h):
+    gamma = MODELOS_VARIOGRAMA[modelo['tipo']](h, modelo['pepita'], modelo['meseta'], modelo['rango'])
+    return np.where(h > 0, gamma, 0.0)
+
+def variograma_empirico(puntos, valores, n_clases=15, max_puntos=KRIGING_MAX_PUNTOS_VARIOGRAMA, semilla=0):
+    """
+    Semivariograma empírico por clases de distancia, vectorizado con pdist + bincount.
+    Con muchos puntos se usa una submuestra fija para acotar los pares a ~max_puntos²/2.
+    Devuelve (distancia media, semivarianza, n° de pares) de las clases no vacías.
+    """
+    if len(puntos) > max_puntos:
+        seleccion = np.random.default_rng(semilla).choice(len(puntos), max_puntos, replace=False)
+        puntos, valores = puntos[seleccion], valores[seleccion]
+    h = pdist(puntos)
+    dz2 = pdist(np.asarray(valores, dtype=np.float64)[:, None], 'sqeuclidean')
+    h_max = h.max() / 2 if len(h) else 0.0
+    if h_max <= 0:
+        return np.array([]), np.array([]), np.array([])
+    clase = np.floor(h / h_max * n_clases).astype(np.int64)
+    validos = clase < n_clases
+    conteos = np.bincount(clase[validos], minlength=n_clases)
+    suma_h = np.bincount(clase[validos], weights=h[validos], minlength=n_clases)
+    suma_dz2 = np.bincount(clase[validos], weights=dz2[validos], minlength=n_clases)
+    ok = conteos > 0
+    return suma_h[ok] / conteos[ok], 0.5 * suma_dz2[ok] / conteos[ok], conteos[ok]
+
+def ajustar_variograma(puntos, valores):
+    """
+    Ajusta los modelos esférico, exponencial y gaussiano por mínimos cuadrados ponderados
+    por número de pares y devuelve el de menor error.
+    """
+    lags, gamma, conteos = variograma_empirico(puntos, valores)
+    if len(lags) < 3:
+        return None
+    p0 = [max(float(gamma.min()), 0.0), max(float(np.ptp(gamma)), 1e-12), float(lags.max()) / 2]
+    limites = ([0.0, 0.0, 1e-12], [np.inf, np.inf, np.inf])
+    mejor = None
+    for tipo, funcion in MODELOS_VARIOGRAMA.items():
+        try:
+            params, _ = curve_fit(funcion, lags, gamma, p0=p0, sigma=1.0 / np.sqrt(conteos),
+                                  bounds=limites, maxfev=5000)
+        except (RuntimeError, ValueError):
+            continue
+        error = float(np.sum(conteos * (funcion(lags, *params) - gamma) ** 2))
+        if mejor is None or error < mejor['error']:
+            mejor = {'tipo': tipo, 'pepita': float(params[0]), 'meseta': float(params[1]),
+                     'rango': float(params[2]), 'error': error}
+    return mejor
+
+def plan_kriging_local(puntos, nodos, modelo, vecinos=KRIGING_VECINOS, universal=False,
+                       tam_lote=TAM_LOTE_INTERPOLACION):
+    """
+    Kriging ordinario (o universal con deriva lineal) en vecindarios locales.
+    Cada nodo resuelve su sistema de k vecinos; los sistemas se resuelven en lotes con
+    np.linalg.solve. Además de los pesos, el plan guarda la varianza de kriging por nodo.
+    """
+    n = len(puntos)
+    k = min(vecinos, n)
+    n_deriva = 3 if universal else 1
+    s = k + n_deriva
+    tree = KDTree(puntos)
+    indices_plan = np.empty((len(nodos), k), dtype=np.int64)
+    pesos_plan = np.empty((len(nodos), k), dtype=np.float64)
+    varianza = np.empty(len(nodos), dtype=np.float64)
+    
+    for ini in range(0, len(nodos), tam_lote):
+        lote = nodos[ini:ini + tam_lote]
+        distancias, indices = tree.query(lote, k=k)
+        vecinos_xy = puntos[indices]
+        d_centros = np.linalg.norm(vecinos_xy[:, :, None, :] - vecinos_xy[:, None, :, :], axis=-1)
+        m = len(lote)
+        sistema = np.zeros((m, s, s))
+        sistema[:, :k, :k] = evaluar_variograma(modelo, d_centros)
+        sistema[:, :k, k] = 1.0
+        sistema[:, k, :k] = 1.0
+        lado_derecho = np.zeros((m, s, 1))
+        lado_derecho[:, :k, 0] = evaluar_variograma(modelo, distancias)
+        lado_derecho[:, k, 0] = 1.0
+        if universal:
+            # Deriva en coordenadas relativas al nodo: f(x0) = (1, 0, 0)
+            escala = distancias.max(axis=1)[:, None, None] + 1e-12
+            relativas = (vecinos_xy - lote[:, None, :]) / escala
+            sistema[:, :k, k + 1:] = relativas
+            sistema[:, k + 1:, :k] = relativas.transpose(0, 2, 1)
+        solucion = np.linalg.solve(sistema, lado_derecho)[:, :, 0]
+        indices_plan[ini:ini + tam_lote] = indices
+        pesos_plan[ini:ini + tam_lote] = solucion[:, :k]
+        varianza[ini:ini + tam_lote] = np.sum(solucion[:, :k] * lado_derecho[:, :k, 0], axis=1) + solucion[:, k]
+    return {'indices': indices_plan, 'pesos': pesos_plan, 'varianza': np.maximum(varianza, 0.0),
+            'metodo': 'kriging_universal' if universal else 'kriging', 'modelo': modelo}
+
+def construir_plan_interpolacion(puntos, nodos, metodo='rbf', modelo=None):
+    """
+    Construye el plan (vecinos + pesos) para interpolar cualquier capa definida sobre `puntos`.
+    Los métodos de kriging requieren el modelo de variograma ajustado. Si el sistema es
+    singular o hay pocos centros se cae a RBF local y luego a IDW.
+    """
+    if metodo in ('kriging', 'kriging_universal') and modelo is not None and len(puntos) >= 6:
+        try:
+            plan = plan_kriging_local(puntos, nodos, modelo, universal=(metodo == 'kriging_universal'))
+            if np.all(np.isfinite(plan['pesos'])):
+                return plan
+        except np.linalg.LinAlgError:
+            pass
+        metodo = 'rbf'
+    if metodo == 'rbf' and len(puntos) >= 4:
+        try:
+            plan = plan_rbf_local(puntos, nodos)
+            if np.all(np.isfinite(plan['pesos'])):
+                return plan
+        except np.linalg.LinAlgError:
+            pass
+    return plan_idw(puntos, nodos)
+
+def mascara_parcela(geometria, bounds, nx, ny):
+    """
+    Rasteriza la parcela sobre la grilla de interpolación: True en los nodos interiores.
+    """
+    nodos = crear_grilla_interpolacion(bounds, nx, ny)
+    return contiene_xy(geometria, nodos[:, 0], nodos[:, 1]).reshape(ny, nx)
+
+def clave_plan_interpolacion(puntos, bounds, nx, ny, metodo, modelo=None, geometria=None):
+    h = hashlib.sha1(np.ascontiguousarray(puntos, dtype=np.float64).tobytes())
+    h.update(repr((tuple(float(b) for b in bounds), nx, ny, metodo)).encode())
+    if modelo is not None:
+        h.update(repr(sorted(modelo.items())).encode())
+    if geometria is not None:
+        h.update(geometria.wkb)
+    return h.hexdigest()
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def _plan_interpolacion_cacheado(clave, _puntos, _bounds, nx, ny, metodo, _modelo=None, _geometria=None):
+    nodos = crear_grilla_interpolacion(_bounds, nx, ny)
+    mascara = None
+    if _geometria is not None:
+        mascara = mascara_parcela(_geometria, _bounds, nx, ny)
+        nodos = nodos[mascara.ravel()]
+    plan = construir_plan_interpolacion(_puntos, nodos, metodo, _modelo)
+    plan.update({'mascara': mascara, 'forma': (ny, nx)})
+    return plan
+
+def obtener_plan_interpolacion(puntos, bounds, nx, ny, metodo='rbf', modelo=None, geometria=None):
+    """
+    Plan cacheado por conjunto de centroides y especificación de grilla: NDVI, NDWI y las
+    variables de fertilidad comparten el mismo plan y cada capa extra cuesta una suma ponderada.
+    Los planes de kriging dependen además del variograma, que entra en la clave.
+    Con `geometria`, sólo se evalúan los nodos dentro de la parcela.
+    """
+    clave = clave_plan_interpolacion(puntos, bounds, nx, ny, metodo, modelo, geometria)
+    return _plan_interpolacion_cacheado(clave, puntos, tuple(bounds), nx, ny, metodo, modelo, geometria)
+
+def aplicar_plan_interpolacion(plan, valores):
+    return np.einsum('mk,mk->m', plan['pesos'], np.asarray(valores, dtype=np.float64)[plan['indices']])
+
+def rasterizar_plan(plan, valores_nodos):
+    """Ubica los valores de los nodos evaluados en la grilla completa (NaN fuera de la parcela)."""
+    if plan.get('mascara') is None:
+        return np.asarray(valores_nodos).reshape(plan['forma'])
+    raster = np.full(plan['forma'], np.nan)
+    raster[plan['mascara']] = valores_nodos
+    return raster
+
+def interpolar_idw(puntos, valores, nodos, k=8, epsilon=1e-6):
+    return aplicar_plan_interpolacion(plan_idw(puntos, nodos, k, epsilon), valores)
+
+def interpolar_rbf_local(puntos, valores, nodos, vecinos=RBF_VECINOS, suavizado=RBF_SUAVIZADO):
+    return aplicar_plan_interpolacion(plan_rbf_local(puntos, nodos, vecinos, suavizado), valores)
+
+# ===== SERIALIZACIÓN COMPACTA (GeoJSON / TopoJSON) =====
+PRECISION_COORDENADAS = 6      # decimales (~0.1 m en latitud)
+ZOOM_DETALLE_MAPA = 18         # zoom máximo al que se simplifica la geometría de los mapas
+UMBRAL_TOPOJSON = 2000         # a partir de cuántos bloques se comparten bordes vía TopoJSON
+
+def tolerancia_simplificacion(zoom, latitud=0.0, pixeles=0.5):
+    """Tolerancia en grados equivalente a `pixeles` de pantalla al nivel de zoom dado."""
+    grados_por_pixel = 360.0 / (256 * 2 ** zoom)
+    return pixeles * grados_por_pixel * max(math.cos(math.radians(latitud)), 0.01)
+
+def _propiedades_registros(gdf, propiedades):
+    """Propiedades seleccionadas como lista de dicts JSON-nativos (NaN -> null)."""
+    columnas = [c for c in (propiedades or []) if c in gdf.columns and c != gdf.geometry.name]
+    if not columnas:
+        return [{} for _ in range(len(gdf))]
+    return json.loads(gdf[columnas].to_json(orient='records', double_precision=PRECISION_COORDENADAS))
+
+def _anillos_poligonales(geom):
+    """Lista de polígonos, cada uno como lista de anillos (exterior primero)."""
+    if geom is None or geom.is_empty:
         return []
+    partes = getattr(geom, 'geoms', [geom])
+    return [[np.asarray(p.exterior.coords)[:, :2]] + [np.asarray(r.coords)[:, :2] for r in p.interiors]
+            for p in partes if p.geom_type == 'Polygon']
+
+def codificar_topojson(geometrias, registros, precision=PRECISION_COORDENADAS, tolerancia=0.0,
+                       nombre_objeto='bloques', ids=None):
+    """
+    Codifica polígonos como TopoJSON cuantizado: los vértices se llevan a una grilla entera de
+    10^-precision grados, los anillos se cortan en los nodos donde cambian los vecinos y cada
+    borde compartido se guarda una sola vez como arco. La simplificación se aplica por arco,
+    de modo que los bloques vecinos siguen compartiendo exactamente el mismo borde.
+    """
+    escala = 10.0 ** -precision
+    estructura = [_anillos_poligonales(g) for g in geometrias]
+    anillos = [a for poligonos in estructura for pol in poligonos for a in pol]
+    topologia = {'type': 'Topology', 'objects': {nombre_objeto: {'type': 'GeometryCollection', 'geometries': []}},
+                 'arcs': []}
+    if not anillos:
+        return topologia
+    
+    origen = np.min([a.min(axis=0) for a in anillos], axis=0)
+    cuantizados = []
+    for a in anillos:
+        q = np.round((a[:-1] - origen) / escala).astype(np.int64)
+        # Vértices que colapsan al cuantizar
+        q = q[np.any(q != np.roll(q, 1, axis=0), axis=1)] if len(q) > 1 else q
+        cuantizados.append(q)
+    tamanos = np.array([len(q) for q in cuantizados])
+    unicos, pid = np.unique(np.concatenate(cuantizados), axis=0, return_inverse=True)
+    pid = pid.ravel()
+    inicios = np.concatenate([[0], np.cumsum(tamanos)[:-1]])
+    
+    # Un nodo es un punto que aparece con distintos pares de vecinos
+    previo = np.concatenate([np.roll(pid[s:s + n], 1) for s, n in zip(inicios, tamanos)])
+    siguiente = np.concatenate([np.roll(pid[s:s + n], -1) for s, n in zip(inicios, tamanos)])
+    trios = np.unique(np.stack([pid, np.minimum(previo, siguiente), np.maximum(previo, siguiente)], axis=1), axis=0)
+    es_nodo = np.bincount(trios[:, 0], minlength=len(unicos)) > 1
+    
+    arcos, indice_arcos = [], {}
+    def registrar(directo, inverso):
+        if directo in indice_arcos:
+            return indice_arcos[directo]
+        if inverso in indice_arcos:
+            return ~indice_arcos[inverso]
+        indice_arcos[directo] = len(arcos)
+        arcos.append(directo)
+        return indice_arcos[directo]
+    
+    arcos_anillo = []
+    for s, n in zip(inicios, tamanos):
+        seg = pid[s:s + n]
+        if n < 3:
+            arcos_anillo.append(None)
+            continue
+        cortes = np.flatnonzero(es_nodo[seg])
+        if len(cortes) == 0:
+            ciclo = np.roll(seg, -int(np.argmin(seg)))
+            inverso = np.roll(ciclo[::-1], 1)
+            arcos_anillo.append([registrar(tuple(ciclo) + (ciclo[0],), tuple(inverso) + (inverso[0],))])
+            continue
+        rotado = np.append(np.roll(seg, -cortes[0]), seg[cortes[0]])
+        limites = list(cortes - cortes[0]) + [n]
+        arcos_anillo.append([registrar(tuple(rotado[i:j + 1]), tuple(rotado[i:j + 1][::-1]))
+                             for i, j in zip(limites[:-1], limites[1:])])
+    
+    tol_q = tolerancia / escala
+    for ids_arco in arcos:
+        coords = unicos[list(ids_arco)]
+        if tol_q > 0 and len(coords) > 2:
+            simplificado = np.asarray(LineString(coords).simplify(tol_q, preserve_topology=False).coords)
+            minimo = 4 if ids_arco[0] == ids_arco[-1] else 2
+            if len(simplificado) >= minimo:
+                coords = np.round(simplificado).astype(np.int64)
+        delta = np.vstack([coords[:1], np.diff(coords, axis=0)])
+        topologia['arcs'].append(delta.tolist())
+    
+    geometrias_topo = topologia['objects'][nombre_objeto]['geometries']
+    k = 0
+    for i, poligonos in enumerate(estructura):
+        salida = []
+        for pol in poligonos:
+            anillos_pol = [arcos_anillo[k + j] for j in range(len(pol))]
+            k += len(pol)
+            if anillos_pol[0] is not None:
+                salida.append([a for a in anillos_pol if a is not None])
+        if not salida:
+            geom = {'type': None}
+        elif len(salida) == 1:
+            geom = {'type': 'Polygon', 'arcs': salida[0]}
+        else:
+            geom = {'type': 'MultiPolygon', 'arcs': salida}
+        geom['properties'] = registros[i]
+        if ids is not None:
+            geom['id'] = ids[i]
+        geometrias_topo.append(geom)
+    
+    topologia['transform'] = {'scale': [escala, escala], 'translate': origen.tolist()}
+    return topologia
+
+def geojson_compacto(gdf, propiedades=None, precision=PRECISION_COORDENADAS, zoom=None, topojson=False):
+    """
+    Serializa un GeoDataFrame (EPSG:4326) para mapas y exportaciones: solo las propiedades
+    indicadas (None = todas), coordenadas redondeadas a `precision` decimales y, si se da
+    `zoom`, simplificación a medio píxel de ese nivel. Con `topojson=True` devuelve TopoJSON
+    con los bordes compartidos codificados una sola vez. Devuelve un dict.
+    """
+    if propiedades is None:
+        propiedades = [c for c in gdf.columns if c != gdf.geometry.name]
+    registros = _propiedades_registros(gdf, propiedades)
+    ids = [str(i) for i in gdf.index]
+    geoms = np.asarray(gdf.geometry.values, dtype=object)
+    tolerancia = 0.0
+    if zoom is not None and len(gdf):
+        tolerancia = tolerancia_simplificacion(zoom, float(np.mean(gdf.total_bounds[[1, 3]])))
+    
+    if topojson:
+        return codificar_topojson(geoms, registros, precision, tolerancia, ids=ids)
+    
+    if tolerancia > 0:
+        try:
+            # Simplificación de cobertura (shapely >= 2.1): los bordes compartidos siguen coincidiendo
+            geoms = shapely.coverage_simplify(geoms, tolerancia)
+        except Exception:
+            geoms = shapely.simplify(geoms, tolerancia, preserve_topology=True)
+    geoms = shapely.transform(geoms, lambda c: np.round(c, precision))
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {'id': ids[i], 'type': 'Feature', 'properties': registros[i],
+             'geometry': mapping(g) if g is not None and not g.is_empty else None}
+            for i, g in enumerate(geoms)
+        ]
+    }
+
+def capa_vectorial_compacta(gdf, nombre, style_function, tooltip_fields=None, tooltip_aliases=None,
+                            propiedades_estilo=(), zoom=ZOOM_DETALLE_MAPA):
+    """
+    Capa folium con serialización compacta: GeoJSON para pocas entidades, TopoJSON
+    (bordes compartidos) a partir de UMBRAL_TOPOJSON y teselas MVT a partir de UMBRAL_MVT.
+    """
+    propiedades = list(dict.fromkeys(list(propiedades_estilo) + list(tooltip_fields or [])))
+    if MVT_OK and len(gdf) >= UMBRAL_MVT:
+        try:
+            return capa_teselas_vectoriales(gdf, nombre, style_function, propiedades)
+        except OSError as e:
+            st.warning(f"No se pudieron escribir las teselas vectoriales ({str(e)[:80]}). Usando TopoJSON.")
+    tooltip = None
+    if tooltip_fields and tooltip_aliases:
+        tooltip = folium.GeoJsonTooltip(fields=tooltip_fields, aliases=tooltip_aliases, localize=True)
+    if len(gdf) >= UMBRAL_TOPOJSON:
+        return folium.TopoJson(
+            geojson_compacto(gdf, propiedades, zoom=zoom, topojson=True),
+            'objects.bloques',
+            name=nombre,
+            style_function=style_function,
+            tooltip=tooltip
+        )
+    return folium.GeoJson(
+        geojson_compacto(gdf, propiedades, zoom=zoom),
+        name=nombre,
+        style_function=style_function,
+        tooltip=tooltip
+    )
+
+# ===== TESELAS VECTORIALES (MVT) =====
+EXTENSION_MVT = 4096           # unidades por tesela (256 px -> 16 unidades por píxel)
+BORDE_MVT = 64                 # margen de recorte para que los trazos no se corten en el borde
+ZOOM_MIN_MVT = 10
+ZOOM_MAX_MVT = 17
+UMBRAL_MVT = 5000              # a partir de cuántas entidades la capa se sirve como MVT
+
+def _codificar_mvt(capa):
+    """Codifica una capa con mapbox_vector_tile (API 2.x y 1.x) en coordenadas de tesela, y hacia abajo."""
+    try:
+        return mapbox_vector_tile.encode([capa], default_options={'y_coord_down': True, 'extents': EXTENSION_MVT})
+    except TypeError:
+        return mapbox_vector_tile.encode([capa], y_coord_down=True, extents=EXTENSION_MVT)
+
+def generar_teselas_vectoriales(gdf, propiedades, nombre_capa='bloques'):
+    """
+    Genera una pirámide z/x/y de teselas MVT (protobuf) para un GeoDataFrame en EPSG:4326,
+    cacheada en disco por hash de contenido. En cada zoom las geometrías se proyectan una
+    vez al espacio de píxeles global, se simplifican a medio píxel y se recortan por tesela
+    con un STRtree. Devuelve {'url', 'zoom_min', 'zoom_max', 'capa'}.
+    """
+    h = hashlib.sha1(hash_gdf(gdf[list(propiedades) + [gdf.geometry.name]]).encode())
+    h.update(repr((nombre_capa, EXTENSION_MVT, ZOOM_MIN_MVT, ZOOM_MAX_MVT)).encode())
+    clave = h.hexdigest()[:20]
+    directorio = os.path.join(DIR_TESELAS, 'mvt', clave)
+    info = {'url': f"{URL_TESELAS}/mvt/{clave}/{{z}}/{{x}}/{{y}}.pbf", 'zoom_min': ZOOM_MIN_MVT,
+            'zoom_max': ZOOM_MAX_MVT, 'capa': nombre_capa}
+    marcador = os.path.join(directorio, 'completo')
+    if os.path.exists(marcador):
+        with open(marcador) as f:
+            info['zoom_max'] = int(f.read().strip() or ZOOM_MAX_MVT)
+        _tocar_marcador(marcador)
+        return info
+    
+    registros = _propiedades_registros(gdf, propiedades)
+    geoms = np.asarray(gdf.geometry.values, dtype=object)
+    minx, miny, maxx, maxy = gdf.total_bounds
+    total = 0
+    
+    for z in range(ZOOM_MIN_MVT, ZOOM_MAX_MVT + 1):
+        def a_pixeles(c, z=z):
+            x, y = _tesela_fraccional(c[:, 0], c[:, 1], z)
+            return np.column_stack([x, y]) * EXTENSION_MVT
+        proyectadas = shapely.transform(geoms, a_pixeles)
+        tolerancia = EXTENSION_MVT / TAM_TESELA / 2
+        try:
+            proyectadas = shapely.coverage_simplify(proyectadas, tolerancia)
+        except Exception:
+            proyectadas = shapely.simplify(proyectadas, tolerancia, preserve_topology=True)
+        arbol = shapely.STRtree(proyectadas)
+        
+        x0, y0 = _tesela_fraccional(minx, maxy, z)
+        x1, y1 = _tesela_fraccional(maxx, miny, z)
+        teselas = [(tx, ty) for tx in range(int(x0), int(x1) + 1) for ty in range(int(y0), int(y1) + 1)]
+        total += len(teselas)
+        if total > MAX_TESELAS_PIRAMIDE and z > ZOOM_MIN_MVT:
+            info['zoom_max'] = z - 1
+            break
+        
+        for tx, ty in teselas:
+            ox, oy = tx * EXTENSION_MVT, ty * EXTENSION_MVT
+            rect = (ox - BORDE_MVT, oy - BORDE_MVT, ox + EXTENSION_MVT + BORDE_MVT, oy + EXTENSION_MVT + BORDE_MVT)
+            indices = arbol.query(box(*rect))
+            if len(indices) == 0:
+                continue
+            recortadas = shapely.clip_by_rect(proyectadas[indices], *rect)
+            locales = shapely.transform(recortadas, lambda c, o=np.array([ox, oy]): c - o)
+            entidades = [{'geometry': g, 'properties': registros[i]}
+                         for i, g in zip(indices, locales) if g is not None and not g.is_empty]
+            if not entidades:
+                continue
+            ruta = os.path.join(directorio, str(z), str(tx))
+            os.makedirs(ruta, exist_ok=True)
+            with open(os.path.join(ruta, f"{ty}.pbf"), 'wb') as f:
+                f.write(_codificar_mvt({'name': nombre_capa, 'features': entidades}))
+    
+    os.makedirs(directorio, exist_ok=True)
+    with open(marcador, 'w') as f:
+        f.write(str(info['zoom_max']))
+    podar_cache_teselas(os.path.join(DIR_TESELAS, 'mvt'), conservar=directorio)
+    return info
+
+def capa_teselas_vectoriales(gdf, nombre, style_function, propiedades=()):
+    """
+    Capa VectorGrid.Protobuf para capas con miles de bloques. El estilo de cada entidad se
+    calcula en Python con la misma style_function de folium y viaja como propiedades, así el
+    navegador solo lee colores ya resueltos.
+    """
+    propiedades = [c for c in propiedades if c in gdf.columns]
+    registros = _propiedades_registros(gdf, propiedades)
+    estilos = pd.DataFrame([style_function({'properties': r}) for r in registros], index=gdf.index)
+    columnas_estilo = {c: f'_{c}' for c in estilos.columns}
+    gdf_estilo = gdf[propiedades + [gdf.geometry.name]].join(estilos.rename(columns=columnas_estilo))
+    info = generar_teselas_vectoriales(gdf_estilo, propiedades + list(columnas_estilo.values()))
+    opciones = """{
+        "rendererFactory": L.canvas.tile,
+        "interactive": true,
+        "maxNativeZoom": %d,
+        "minNativeZoom": %d,
+        "vectorTileLayerStyles": {
+            "%s": function(p) {
+                // ?? y no ||: una opacidad o un grosor 0 del estilo son válidos
+                return {fill: true, fillColor: p._fillColor ?? '#3388ff', fillOpacity: p._fillOpacity ?? 0.6,
+                        color: p._color ?? 'black', weight: p._weight ?? 0.5};
+            }
+        }
+    }""" % (info['zoom_max'], info['zoom_min'], info['capa'])
+    return VectorGridProtobuf(info['url'], nombre, opciones)
 
 # ===== FUNCIONES DE VISUALIZACIÓN =====
 def crear_mapa_interactivo_base(gdf, columna_color=None, colormap=None, tooltip_fields=None, tooltip_aliases=None):
@@ -1677,16 +2889,11 @@ def crear_mapa_interactivo_base(gdf, columna_color=None, colormap=None, tooltip_
         def style_function(feature):
             return {'fillColor': '#3388ff', 'color': 'black', 'weight': 0.5, 'fillOpacity': 0.4}
     
-    if tooltip_fields and tooltip_aliases:
-        tooltip = folium.GeoJsonTooltip(fields=tooltip_fields, aliases=tooltip_aliases, localize=True)
-    else:
-        tooltip = None
-    
-    folium.GeoJson(
-        gdf.to_json(),
-        name='Polígonos',
-        style_function=style_function,
-        tooltip=tooltip
+    capa_vectorial_compacta(
+        gdf, 'Polígonos', style_function,
+        tooltip_fields=tooltip_fields,
+        tooltip_aliases=tooltip_aliases,
+        propiedades_estilo=[columna_color] if columna_color else ()
     ).add_to(m)
     
     folium.LayerControl(collapsed=False).add_to(m)
@@ -1695,186 +2902,307 @@ def crear_mapa_interactivo_base(gdf, columna_color=None, colormap=None, tooltip_
     MiniMap(toggle_display=True).add_to(m)
     return m
 
-def crear_mapa_calor_indice_rbf(gdf, columna, titulo, vmin, vmax, colormap_list):
-    try:
-        plantacion_union = gdf.unary_union
-        bounds = plantacion_union.bounds
-        dx = bounds[2] - bounds[0]
-        dy = bounds[3] - bounds[1]
-        minx = bounds[0] - 0.1 * dx
-        maxx = bounds[2] + 0.1 * dx
-        miny = bounds[1] - 0.1 * dy
-        maxy = bounds[3] + 0.1 * dy
-        
-        puntos = []
-        valores = []
-        for idx, row in gdf.iterrows():
-            centroide = row.geometry.centroid
-            puntos.append([centroide.x, centroide.y])
-            valores.append(row[columna])
-        puntos = np.array(puntos)
-        valores = np.array(valores)
-        
-        if len(puntos) < 4:
-            return crear_mapa_calor_indice_idw(gdf, columna, titulo, vmin, vmax, colormap_list)
-        
-        n = 300
-        xi = np.linspace(minx, maxx, n)
-        yi = np.linspace(miny, maxy, n)
-        XI, YI = np.meshgrid(xi, yi)
-        
-        try:
-            rbf = Rbf(puntos[:, 0], puntos[:, 1], valores, function='multiquadric', smooth=0.1)
-            ZI = rbf(XI, YI)
-        except Exception as e:
-            return crear_mapa_calor_indice_idw(gdf, columna, titulo, vmin, vmax, colormap_list)
-        
-        cmap = matplotlib.colors.LinearSegmentedColormap.from_list('custom', colormap_list)
-        norm = matplotlib.colors.Normalize(vmin=vmin, vmax=vmax)
-        rgba = cmap(norm(ZI))
-        img = (rgba * 255).astype(np.uint8)
-        
-        img_bytes = io.BytesIO()
-        Image.fromarray(img).save(img_bytes, format='PNG')
-        img_bytes.seek(0)
-        img_base64 = base64.b64encode(img_bytes.getvalue()).decode('utf-8')
-        img_data = f"data:image/png;base64,{img_base64}"
-        
-        centroide = plantacion_union.centroid
-        m = folium.Map(location=[centroide.y, centroide.x], zoom_start=16, tiles=None, control_scale=True)
-        folium.TileLayer(
-            tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-            attr='Esri, Maxar, Earthstar Geographics',
-            name='Satélite Esri',
-            overlay=False,
-            control=True
-        ).add_to(m)
-        
-        bounds_img = [[miny, minx], [maxy, maxx]]
-        folium.raster_layers.ImageOverlay(
-            image=img_data,
-            bounds=bounds_img,
-            opacity=0.7,
-            name=f'Calor {titulo}',
-            interactive=True,
-            zindex=1
-        ).add_to(m)
-        
-        folium.GeoJson(
-            gpd.GeoSeries(plantacion_union).to_json(),
-            name='Límite plantación',
-            style_function=lambda x: {'color': 'white', 'weight': 2, 'fillOpacity': 0},
-            tooltip='Límite de la plantación'
-        ).add_to(m)
-        
-        colormap = LinearColormap(colors=colormap_list, vmin=vmin, vmax=vmax, caption=titulo)
-        colormap.add_to(m)
-        
-        folium.LayerControl(collapsed=False).add_to(m)
-        Fullscreen().add_to(m)
-        MeasureControl().add_to(m)
-        MiniMap(toggle_display=True).add_to(m)
-        
-        return m
-    except Exception as e:
-        return None
+COLORES_VARIANZA_KRIGING = ['#f7fcfd', '#9ebcda', '#8c6bb1', '#4d004b']
 
-def crear_mapa_calor_indice_idw(gdf, columna, titulo, vmin, vmax, colormap_list):
-    try:
-        plantacion_union = gdf.unary_union
-        bounds = plantacion_union.bounds
-        dx = bounds[2] - bounds[0]
-        dy = bounds[3] - bounds[1]
-        minx = bounds[0] - 0.1 * dx
-        maxx = bounds[2] + 0.1 * dx
-        miny = bounds[1] - 0.1 * dy
-        maxy = bounds[3] + 0.1 * dy
-        
-        puntos = []
-        valores = []
-        for idx, row in gdf.iterrows():
-            centroide = row.geometry.centroid
-            puntos.append([centroide.x, centroide.y])
-            valores.append(row[columna])
-        puntos = np.array(puntos)
-        valores = np.array(valores)
-        
-        n = 200
-        xi = np.linspace(minx, maxx, n)
-        yi = np.linspace(miny, maxy, n)
-        XI, YI = np.meshgrid(xi, yi)
-        
-        tree = KDTree(puntos)
-        k = min(8, len(puntos))
-        distancias, indices = tree.query(np.column_stack((XI.ravel(), YI.ravel())), k=k)
-        
-        epsilon = 1e-6
-        pesos = 1.0 / (distancias + epsilon)
-        suma_pesos = np.sum(pesos, axis=1)
-        valores_vecinos = valores[indices]
-        valores_interp = np.sum(pesos * valores_vecinos, axis=1) / suma_pesos
-        ZI = valores_interp.reshape(XI.shape)
-        
-        cmap = matplotlib.colors.LinearSegmentedColormap.from_list('custom', colormap_list)
-        norm = matplotlib.colors.Normalize(vmin=vmin, vmax=vmax)
-        rgba = cmap(norm(ZI))
-        img = (rgba * 255).astype(np.uint8)
-        
-        img_bytes = io.BytesIO()
-        Image.fromarray(img).save(img_bytes, format='PNG')
-        img_bytes.seek(0)
-        img_base64 = base64.b64encode(img_bytes.getvalue()).decode('utf-8')
-        img_data = f"data:image/png;base64,{img_base64}"
-        
-        centroide = plantacion_union.centroid
-        m = folium.Map(location=[centroide.y, centroide.x], zoom_start=16, tiles=None, control_scale=True)
-        folium.TileLayer(
-            tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-            attr='Esri, Maxar, Earthstar Geographics',
-            name='Satélite Esri',
-            overlay=False,
-            control=True
-        ).add_to(m)
-        
-        bounds_img = [[miny, minx], [maxy, maxx]]
-        folium.raster_layers.ImageOverlay(
-            image=img_data,
-            bounds=bounds_img,
-            opacity=0.7,
-            name=f'Calor {titulo}',
-            interactive=True,
-            zindex=1
-        ).add_to(m)
-        
-        folium.GeoJson(
-            gpd.GeoSeries(plantacion_union).to_json(),
-            name='Límite plantación',
-            style_function=lambda x: {'color': 'white', 'weight': 2, 'fillOpacity': 0},
-            tooltip='Límite de la plantación'
-        ).add_to(m)
-        
-        colormap = LinearColormap(colors=colormap_list, vmin=vmin, vmax=vmax, caption=titulo)
-        colormap.add_to(m)
-        
-        folium.LayerControl(collapsed=False).add_to(m)
-        Fullscreen().add_to(m)
-        MeasureControl().add_to(m)
-        MiniMap(toggle_display=True).add_to(m)
-        
-        return m
+# ===== COLOREADO DE RASTERS (LUT uint8) =====
+FORMATO_OVERLAY = 'PNG'
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def paleta_lut(colores):
+    """
+    Paleta de 256 entradas RGB (uint8) para una rampa de colores.
+    El índice 0 se reserva para píxeles transparentes; 1-255 recorren la rampa.
+    """
+    cmap = matplotlib.colors.LinearSegmentedColormap.from_list('lut', list(colores), N=255)
+    lut = np.zeros((256, 3), dtype=np.uint8)
+    lut[1:] = np.round(cmap(np.linspace(0.0, 1.0, 255))[:, :3] * 255).astype(np.uint8)
+    return lut
+
+def cuantizar_uint8(Z, vmin, vmax, mascara=None):
+    """
+    Cuantiza directamente a índices de paleta: 1-255 sobre [vmin, vmax] y 0 para NaN
+    o píxeles fuera de la máscara. 1 byte por píxel en lugar del RGBA float64 de 32.
+    """
+    rango = float(vmax - vmin) or 1.0
+    escalado = (np.asarray(Z, dtype=np.float32) - np.float32(vmin)) * np.float32(254.0 / rango)
+    np.clip(escalado, 0.0, 254.0, out=escalado)
+    indices = (escalado + 1.5).astype(np.uint8)
+    indices[np.isnan(escalado)] = 0
+    if mascara is not None:
+        indices[~mascara] = 0
+    return indices
+
+def codificar_imagen_paleta(indices, colores, formato=FORMATO_OVERLAY):
+    """Codifica índices uint8 como PNG en modo paleta (índice 0 transparente) o WebP con alfa."""
+    img = Image.fromarray(indices, mode='P')
+    img.putpalette(paleta_lut(tuple(colores)).ravel().tolist())
+    buffer = io.BytesIO()
+    if formato.upper() == 'WEBP':
+        img.info['transparency'] = 0
+        img.convert('RGBA').save(buffer, format='WEBP', lossless=True)
+    else:
+        img.save(buffer, format='PNG', transparency=0)
+    return buffer.getvalue()
+
+def _imagen_overlay_base64(ZI, vmin, vmax, colormap_list, mascara=None, formato=FORMATO_OVERLAY):
+    datos = codificar_imagen_paleta(cuantizar_uint8(ZI, vmin, vmax, mascara), colormap_list, formato)
+    img_base64 = base64.b64encode(datos).decode('utf-8')
+    return f"data:image/{formato.lower()};base64,{img_base64}"
+
+# ===== PIRÁMIDE DE TESELAS XYZ =====
+# Streamlit sirve ./static en app/static cuando server.enableStaticServing = true
+DIR_TESELAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'tiles')
+URL_TESELAS = os.environ.get("TILES_BASE_URL", "app/static/tiles")
+USAR_TESELAS_XYZ = True
+TAM_TESELA = 256
+ZOOM_MAX_TESELAS = 19
+MAX_TESELAS_PIRAMIDE = 2048
+MAX_MB_TESELAS = 512  # por caché: raster (tiles/) y vectorial (tiles/mvt/) por separado
+
+def _tamano_directorio(ruta):
+    return sum(os.path.getsize(os.path.join(d, a)) for d, _, archivos in os.walk(ruta) for a in archivos)
+
+def podar_cache_teselas(raiz, conservar=None, max_mb=MAX_MB_TESELAS):
+    """
+    Limita el caché de pirámides bajo `raiz` a `max_mb`, borrando primero las menos usadas
+    (fecha del marcador 'completo', que se toca en cada acierto). La pirámide `conservar`,
+    recién generada, nunca se borra. Devuelve cuántas pirámides se eliminaron.
+    """
+    if not os.path.isdir(raiz):
+        return 0
+    entradas = []
+    for nombre in os.listdir(raiz):
+        ruta = os.path.join(raiz, nombre)
+        if nombre == 'mvt' or not os.path.isdir(ruta):
+            continue
+        marcador = os.path.join(ruta, 'completo')
+        try:
+            uso = os.path.getmtime(marcador if os.path.exists(marcador) else ruta)
+            entradas.append((uso, ruta, _tamano_directorio(ruta)))
+        except OSError:
+            continue
+    total = sum(e[2] for e in entradas)
+    limite = max_mb * 1024 * 1024
+    borradas = 0
+    for uso, ruta, tam in sorted(entradas):
+        if total <= limite:
+            break
+        if conservar is not None and os.path.abspath(ruta) == os.path.abspath(conservar):
+            continue
+        shutil.rmtree(ruta, ignore_errors=True)
+        total -= tam
+        borradas += 1
+    return borradas
+
+def _tocar_marcador(marcador):
+    try:
+        os.utime(marcador)
+    except OSError:
+        pass
+
+def _tesela_fraccional(lon, lat, z):
+    """Coordenadas XYZ (Web Mercator) fraccionarias de un punto lon/lat."""
+    n = 2 ** z
+    lat_rad = np.radians(np.clip(lat, -85.0511, 85.0511))
+    x = (np.asarray(lon) + 180.0) / 360.0 * n
+    y = (1.0 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / np.pi) / 2.0 * n
+    return x, y
+
+def rango_zoom_teselas(bounds, nx):
+    """
+    Zoom nativo del raster (tamaño de píxel de la tesela ≈ tamaño de celda) y rango a generar:
+    se generan algunos niveles menores para la vista general y uno mayor para acercamientos.
+    """
+    celda_grados = max((bounds[2] - bounds[0]) / max(nx, 1), 1e-9)
+    zoom_nativo = int(np.floor(np.log2(360.0 / (celda_grados * TAM_TESELA))))
+    zoom_max = int(np.clip(zoom_nativo + 1, 0, ZOOM_MAX_TESELAS))
+    return max(zoom_max - 5, 0), zoom_max
+
+def generar_piramide_teselas(Z, bounds, vmin, vmax, colores):
+    """
+    Renderiza un raster (EPSG:4326, fila 0 = norte, NaN = transparente) en una pirámide z/x/y
+    de PNG en paleta, cacheada en disco por hash de contenido. Las teselas se remuestrean
+    bilinealmente del raster, así que cada nivel se dibuja a su resolución propia.
+    Devuelve {'url', 'zoom_min', 'zoom_max'} o None si no se pudo generar.
+    """
+    Z = np.asarray(Z, dtype=np.float64)
+    h = hashlib.sha1(np.ascontiguousarray(Z).tobytes())
+    h.update(repr((tuple(float(b) for b in bounds), float(vmin), float(vmax), tuple(colores), Z.shape)).encode())
+    clave = h.hexdigest()[:20]
+    ny, nx = Z.shape
+    minx, miny, maxx, maxy = bounds
+    zoom_min, zoom_max = rango_zoom_teselas(bounds, nx)
+    directorio = os.path.join(DIR_TESELAS, clave)
+    info = {'url': f"{URL_TESELAS}/{clave}/{{z}}/{{x}}/{{y}}.png", 'zoom_min': zoom_min, 'zoom_max': zoom_max}
+    marcador = os.path.join(directorio, 'completo')
+    if os.path.exists(marcador):
+        with open(marcador) as f:
+            info['zoom_max'] = int(f.read().strip() or zoom_max)
+        _tocar_marcador(marcador)
+        return info
+    
+    from scipy.ndimage import map_coordinates
+    validos = np.isfinite(Z)
+    Z_relleno = np.where(validos, Z, np.nanmean(Z) if validos.any() else 0.0)
+    validos = validos.astype(np.float32)
+    pixeles = np.arange(TAM_TESELA) + 0.5
+    total = 0
+    
+    for z in range(zoom_min, zoom_max + 1):
+        x0, y0 = _tesela_fraccional(minx, maxy, z)
+        x1, y1 = _tesela_fraccional(maxx, miny, z)
+        tx_rango = range(int(np.floor(x0)), int(np.floor(x1)) + 1)
+        ty_rango = range(int(np.floor(y0)), int(np.floor(y1)) + 1)
+        total += len(tx_rango) * len(ty_rango)
+        if total > MAX_TESELAS_PIRAMIDE and z > zoom_min:
+            info['zoom_max'] = z - 1
+            break
+        n = 2 ** z
+        for tx in tx_rango:
+            lon = (tx + pixeles / TAM_TESELA) / n * 360.0 - 180.0
+            col = (lon - minx) / (maxx - minx) * (nx - 1)
+            for ty in ty_rango:
+                lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (ty + pixeles / TAM_TESELA) / n))))
+                fila = (maxy - lat) / (maxy - miny) * (ny - 1)
+                FF, CC = np.meshgrid(fila, col, indexing='ij')
+                dentro = map_coordinates(validos, [FF, CC], order=0, mode='constant', cval=0.0) > 0.5
+                if not dentro.any():
+                    continue
+                valores = map_coordinates(Z_relleno, [FF, CC], order=1, mode='nearest')
+                ruta = os.path.join(directorio, str(z), str(tx))
+                os.makedirs(ruta, exist_ok=True)
+                with open(os.path.join(ruta, f"{ty}.png"), 'wb') as f:
+                    f.write(codificar_imagen_paleta(cuantizar_uint8(valores, vmin, vmax, dentro), colores, 'PNG'))
+    
+    os.makedirs(directorio, exist_ok=True)
+    with open(marcador, 'w') as f:
+        f.write(str(info['zoom_max']))
+    podar_cache_teselas(DIR_TESELAS, conservar=directorio)
+    return info
+
+def agregar_capa_raster(m, Z, bounds, vmin, vmax, colores, nombre, zindex=1, show=True):
+    """
+    Agrega un raster al mapa como capa de teselas XYZ servida localmente; si no se pueden
+    generar las teselas, cae a un ImageOverlay embebido en base64.
+    """
+    minx, miny, maxx, maxy = bounds
+    bounds_img = [[miny, minx], [maxy, maxx]]
+    if USAR_TESELAS_XYZ:
+        try:
+            info = generar_piramide_teselas(Z, bounds, vmin, vmax, colores)
+            folium.TileLayer(
+                tiles=info['url'],
+                attr='Interpolación local',
+                name=nombre,
+                overlay=True,
+                control=True,
+                show=show,
+                opacity=0.7,
+                max_zoom=22,
+                max_native_zoom=info['zoom_max'],
+                min_native_zoom=info['zoom_min'],
+                bounds=bounds_img,
+                z_index=zindex
+            ).add_to(m)
+            return
+        except OSError as e:
+            st.warning(f"No se pudieron escribir las teselas ({str(e)[:80]}). Usando imagen embebida.")
+    folium.raster_layers.ImageOverlay(
+        image=_imagen_overlay_base64(Z, vmin, vmax, colores),
+        bounds=bounds_img,
+        opacity=0.7,
+        name=nombre,
+        interactive=True,
+        zindex=zindex,
+        show=show
+    ).add_to(m)
+
+def _crear_mapa_calor(gdf, columna, titulo, vmin, vmax, colormap_list, metodo):
+    plantacion_union = gdf.unary_union
+    bounds = plantacion_union.bounds
+    minx, miny, maxx, maxy = bounds
+    
+    validos = gdf[columna].notna().values
+    puntos = centroides_bloques(gdf)[validos]
+    valores = gdf[columna].values[validos].astype(np.float64)
+    if len(puntos) == 0:
+        return None
+    
+    nx, ny = resolucion_grilla_adaptativa(bounds)
+    modelo = ajustar_variograma(puntos, valores) if metodo in ('kriging', 'kriging_universal') else None
+    plan = obtener_plan_interpolacion(puntos, bounds, nx, ny, metodo, modelo, plantacion_union)
+    ZI = rasterizar_plan(plan, aplicar_plan_interpolacion(plan, valores))
+    
+    centroide = plantacion_union.centroid
+    m = folium.Map(location=[centroide.y, centroide.x], zoom_start=16, tiles=None, control_scale=True)
+    folium.TileLayer(
+        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+        attr='Esri, Maxar, Earthstar Geographics',
+        name='Satélite Esri',
+        overlay=False,
+        control=True
+    ).add_to(m)
+    
+    agregar_capa_raster(m, ZI, bounds, vmin, vmax, colormap_list, f'Calor {titulo}', zindex=1)
+    
+    if 'varianza' in plan:
+        VAR = rasterizar_plan(plan, plan['varianza'])
+        var_max = float(np.nanmax(VAR)) or 1.0
+        agregar_capa_raster(m, VAR, bounds, 0.0, var_max, COLORES_VARIANZA_KRIGING,
+                            f'Varianza de kriging ({plan["modelo"]["tipo"]})', zindex=2, show=False)
+        LinearColormap(colors=COLORES_VARIANZA_KRIGING, vmin=0.0, vmax=var_max,
+                       caption=f'Varianza de kriging - {titulo}').add_to(m)
+    
+    folium.GeoJson(
+        gpd.GeoSeries(plantacion_union).to_json(),
+        name='Límite plantación',
+        style_function=lambda x: {'color': 'white', 'weight': 2, 'fillOpacity': 0},
+        tooltip='Límite de la plantación'
+    ).add_to(m)
+    
+    colormap = LinearColormap(colors=colormap_list, vmin=vmin, vmax=vmax, caption=titulo)
+    colormap.add_to(m)
+    
+    folium.LayerControl(collapsed=False).add_to(m)
+    Fullscreen().add_to(m)
+    MeasureControl().add_to(m)
+    MiniMap(toggle_display=True).add_to(m)
+    
+    return m
+
+def crear_mapa_calor_indice_rbf(gdf, columna, titulo, vmin, vmax, colormap_list):
+    try:
+        return _crear_mapa_calor(gdf, columna, titulo, vmin, vmax, colormap_list, 'rbf')
     except Exception as e:
         return None
 
-def mostrar_estadisticas_indice(gdf, columna, titulo, vmin, vmax, colormap_list):
-    mapa_calor = None
+def crear_mapa_calor_indice_idw(gdf, columna, titulo, vmin, vmax, colormap_list):
     try:
-        mapa_calor = crear_mapa_calor_indice_rbf(gdf, columna, titulo, vmin, vmax, colormap_list)
-    except:
-        mapa_calor = None
-    
-    if mapa_calor:
-        folium_static(mapa_calor, width=1000, height=600)
-    else:
+        return _crear_mapa_calor(gdf, columna, titulo, vmin, vmax, colormap_list, 'idw')
+    except Exception as e:
+        return None
+
+def crear_mapa_calor_indice_kriging(gdf, columna, titulo, vmin, vmax, colormap_list, universal=False):
+    """
+    Mapa de calor por kriging local con variograma ajustado automáticamente.
+    Agrega una segunda capa (oculta por defecto) con la varianza de kriging.
+    """
+    try:
+        return _crear_mapa_calor(gdf, columna, titulo, vmin, vmax, colormap_list,
+                                 'kriging_universal' if universal else 'kriging')
+    except Exception as e:
+        return None
+
+METODOS_MAPA_CALOR = {
+    'RBF local': crear_mapa_calor_indice_rbf,
+    'IDW': crear_mapa_calor_indice_idw,
+    'Kriging ordinario': crear_mapa_calor_indice_kriging,
+    'Kriging universal': lambda *args: crear_mapa_calor_indice_kriging(*args, universal=True)
+}
+
+def mostrar_estadisticas_indice(gdf, columna, titulo, vmin, vmax, colormap_list, metodo='RBF local'):
+    crear_mapa_calor = METODOS_MAPA_CALOR.get(metodo, crear_mapa_calor_indice_rbf)
+    if not mostrar_mapa_cacheado(crear_mapa_calor, gdf, columna, titulo, vmin, vmax, colormap_list):
         st.warning("No se pudo generar el mapa de calor. Mostrando gráfico de barras.")
         fig, ax = plt.subplots(figsize=(10,4))
         ax.bar(range(len(gdf)), gdf[columna].values, color='steelblue')
@@ -1968,23 +3296,36 @@ def mostrar_comparacion_ndvi_ndwi(gdf):
         bottom_ndwi.columns = ['Bloque', 'NDWI', 'Salud']
         st.dataframe(bottom_ndwi.style.format({'NDWI': '{:.3f}'}), use_container_width=True)
 
+INFO_VARIABLES_FERTILIDAD = {
+    'N_kg_ha': {'titulo': 'Nitrógeno (N)', 'unidad': 'kg/ha', 'vmin': 40, 'vmax': 180, 'cmap': 'YlGnBu'},
+    'P_kg_ha': {'titulo': 'Fósforo (P₂O₅)', 'unidad': 'kg/ha', 'vmin': 15, 'vmax': 70, 'cmap': 'YlOrRd'},
+    'K_kg_ha': {'titulo': 'Potasio (K₂O)', 'unidad': 'kg/ha', 'vmin': 80, 'vmax': 250, 'cmap': 'YlGn'},
+    'pH': {'titulo': 'pH del suelo', 'unidad': '', 'vmin': 4.5, 'vmax': 6.5, 'cmap': 'RdYlGn_r'},
+    'MO_porcentaje': {'titulo': 'Materia Orgánica', 'unidad': '%', 'vmin': 1.0, 'vmax': 5.0, 'cmap': 'BrBG'}
+}
+
+PALETAS_FERTILIDAD = {
+    'YlOrRd': ['#ffffb2','#fecc5c','#fd8d3c','#f03b20','#bd0026'],
+    'YlGn': ['#c7e9c0','#74c476','#31a354','#006d2c'],
+    'RdYlGn_r': ['#4575b4','#91bfdb','#e0f3f8','#fee090','#fc8d59','#d73027'],
+    'BrBG': ['#8c510a','#bf812d','#dfc27d','#f6e8c3','#c7eae5','#80cdc1','#35978f','#01665e']
+}
+
+def info_variable_fertilidad(gdf_fertilidad, variable):
+    """Título, unidad, rango y paleta de una variable de fertilidad."""
+    info = dict(INFO_VARIABLES_FERTILIDAD.get(variable, {'titulo': variable, 'unidad': '', 'vmin': None, 'vmax': None, 'cmap': 'YlOrRd'}))
+    info['colores'] = PALETAS_FERTILIDAD.get(info['cmap'], PALETAS_FERTILIDAD['BrBG'])
+    info['vmin'] = info['vmin'] if info['vmin'] else gdf_fertilidad[variable].min()
+    info['vmax'] = info['vmax'] if info['vmax'] else gdf_fertilidad[variable].max()
+    return info
+
 def crear_mapa_fertilidad_interactivo(gdf_fertilidad, variable, colormap_nombre='YlOrRd'):
-    info_var = {
-        'N_kg_ha': {'titulo': 'Nitrógeno (N)', 'unidad': 'kg/ha', 'vmin': 40, 'vmax': 180, 'cmap': 'YlGnBu'},
-        'P_kg_ha': {'titulo': 'Fósforo (P₂O₅)', 'unidad': 'kg/ha', 'vmin': 15, 'vmax': 70, 'cmap': 'YlOrRd'},
-        'K_kg_ha': {'titulo': 'Potasio (K₂O)', 'unidad': 'kg/ha', 'vmin': 80, 'vmax': 250, 'cmap': 'YlGn'},
-        'pH': {'titulo': 'pH del suelo', 'unidad': '', 'vmin': 4.5, 'vmax': 6.5, 'cmap': 'RdYlGn_r'},
-        'MO_porcentaje': {'titulo': 'Materia Orgánica', 'unidad': '%', 'vmin': 1.0, 'vmax': 5.0, 'cmap': 'BrBG'}
-    }
-    info = info_var.get(variable, {'titulo': variable, 'unidad': '', 'vmin': None, 'vmax': None, 'cmap': 'YlOrRd'})
+    info = info_variable_fertilidad(gdf_fertilidad, variable)
     
     colormap = LinearColormap(
-        colors=['#ffffb2','#fecc5c','#fd8d3c','#f03b20','#bd0026'] if info['cmap'] == 'YlOrRd' else
-                ['#c7e9c0','#74c476','#31a354','#006d2c'] if info['cmap'] == 'YlGn' else
-                ['#4575b4','#91bfdb','#e0f3f8','#fee090','#fc8d59','#d73027'] if info['cmap'] == 'RdYlGn_r' else
-                ['#8c510a','#bf812d','#dfc27d','#f6e8c3','#c7eae5','#80cdc1','#35978f','#01665e'],
-        vmin=info['vmin'] if info['vmin'] else gdf_fertilidad[variable].min(),
-        vmax=info['vmax'] if info['vmax'] else gdf_fertilidad[variable].max(),
+        colors=info['colores'],
+        vmin=info['vmin'],
+        vmax=info['vmax'],
         caption=f"{info['titulo']} ({info['unidad']})"
     )
     
@@ -1992,8 +3333,8 @@ def crear_mapa_fertilidad_interactivo(gdf_fertilidad, variable, colormap_nombre=
         gdf_fertilidad,
         columna_color=variable,
         colormap=colormap,
-        tooltip_fields=['id_bloque', variable, 'recomendacion_N', 'recomendacion_P', 'recomendacion_K'],
-        tooltip_aliases=['Bloque', f'{info["titulo"]} ({info["unidad"]})', 'Recom. N', 'Recom. P', 'Recom. K']
+        tooltip_fields=['id_bloque', variable, 'codigo_recomendacion', 'urea_kg_ha', 'DAP_kg_ha', 'KCl_kg_ha'],
+        tooltip_aliases=['Bloque', f'{info["titulo"]} ({info["unidad"]})', 'Aplicar', 'Urea kg/ha', 'DAP kg/ha', 'KCl kg/ha']
     )
     if m:
         colormap.add_to(m)
@@ -2111,142 +3452,939 @@ def crear_leyenda_html(detecciones_info):
     return html
 
 # ===== CURVAS DE NIVEL =====
-def obtener_dem_opentopography(gdf, api_key=None):
+URL_OPENTOPOGRAPHY = "https://portal.opentopography.org/API/globaldem"
+DIR_CACHE_DEM = os.environ.get(
+    "DEM_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'dem')
+)
+TAM_TESELA_DEM_GRADOS = 0.05    # 180 x 180 celdas SRTM 1" por tesela
+MAX_DESCARGAS_DEM = 4
+NODATA_DEM = -32768
+
+def teselas_dem(bounds, margen=0.05):
+    """Índices (i, j) de la grilla fija de teselas DEM que cubren los límites más un margen relativo."""
+    west, south, east, north = bounds
+    dx, dy = (east - west) * margen, (north - south) * margen
+    t = TAM_TESELA_DEM_GRADOS
+    i0, i1 = int(math.floor((west - dx) / t)), int(math.floor((east + dx) / t))
+    j0, j1 = int(math.floor((south - dy) / t)), int(math.floor((north + dy) / t))
+    return [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+
+def ruta_tesela_dem(i, j, demtype="SRTMGL1"):
+    return os.path.join(DIR_CACHE_DEM, demtype, f"{i}_{j}.tif")
+
+def _descargar_tesela_dem(i, j, api_key, demtype="SRTMGL1"):
+    """Descarga una tesela y la guarda como GeoTIFF teselado y comprimido (escritura atómica)."""
+    from rasterio.io import MemoryFile
+    t = TAM_TESELA_DEM_GRADOS
+    params = {
+        "demtype": demtype,
+        "south": j * t,
+        "north": (j + 1) * t,
+        "west": i * t,
+        "east": (i + 1) * t,
+        "outputFormat": "GTiff",
+        "API_Key": api_key
+    }
+    response = requests.get(URL_OPENTOPOGRAPHY, params=params, timeout=60)
+    response.raise_for_status()
+    ruta = ruta_tesela_dem(i, j, demtype)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    with MemoryFile(response.content) as memoria, memoria.open() as src:
+        perfil = src.profile.copy()
+        perfil.update(driver="GTiff", tiled=True, blockxsize=128, blockysize=128,
+                      compress="deflate", predictor=2)
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with rasterio.open(temporal, "w", **perfil) as dst:
+            dst.write(src.read())
+    os.replace(temporal, ruta)
+    return ruta
+
+def obtener_dem_opentopography(gdf, api_key=None, demtype="SRTMGL1"):
+    """
+    DEM recortado a la plantación a partir de una caché en disco de teselas fijas de
+    TAM_TESELA_DEM_GRADOS. Solo se descargan (en paralelo) las teselas faltantes, por lo que
+    la API key únicamente hace falta si la zona no está ya en caché. El resultado es un
+    mosaico memory-mapped (ver mosaico_dem_memmap), no un array en memoria.
+    """
     try:
         import rasterio
-        from rasterio.mask import mask
     except ImportError:
-        st.warning("Para curvas de nivel reales instala rasterio y scikit-image")
+        st.warning("Para curvas de nivel reales instala rasterio y contourpy")
         return None, None, None
     if api_key is None:
         api_key = os.environ.get("OPENTOPOGRAPHY_API_KEY", None)
-    if not api_key:
-        return None, None, None
     try:
-        bounds = gdf.total_bounds
-        west, south, east, north = bounds
-        lon_span = east - west
-        lat_span = north - south
-        west -= lon_span * 0.05
-        east += lon_span * 0.05
-        south -= lat_span * 0.05
-        north += lat_span * 0.05
-        url = "https://portal.opentopography.org/API/globaldem"
-        params = {
-            "demtype": "SRTMGL1",
-            "south": south,
-            "north": north,
-            "west": west,
-            "east": east,
-            "outputFormat": "GTiff",
-            "API_Key": api_key
-        }
-        response = requests.get(url, params=params, timeout=60)
-        response.raise_for_status()
-        dem_bytes = BytesIO(response.content)
-        with rasterio.open(dem_bytes) as src:
-            geom = [mapping(gdf.unary_union)]
-            out_image, out_transform = mask(src, geom, crop=True, nodata=-32768)
-            out_meta = src.meta.copy()
-            out_meta.update({
-                "driver": "GTiff",
-                "height": out_image.shape[1],
-                "width": out_image.shape[2],
-                "transform": out_transform,
-                "nodata": -32768
-            })
-        return out_image.squeeze(), out_meta, out_transform
+        teselas = teselas_dem(gdf.total_bounds)
+        faltantes = [(i, j) for i, j in teselas if not os.path.exists(ruta_tesela_dem(i, j, demtype))]
+        if faltantes:
+            if not api_key:
+                return None, None, None
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(MAX_DESCARGAS_DEM, len(faltantes))) as ejecutor:
+                list(ejecutor.map(lambda ij: _descargar_tesela_dem(ij[0], ij[1], api_key, demtype), faltantes))
+        
+        return mosaico_dem_memmap(teselas, gdf.unary_union, demtype)
     except Exception as e:
         st.error(f"Error descargando DEM: {str(e)[:200]}")
         return None, None, None
 
-def generar_curvas_nivel_simuladas(gdf):
-    try:
-        from skimage import measure
-    except ImportError:
-        return []
-    bounds = gdf.total_bounds
-    minx, miny, maxx, maxy = bounds
-    n = 100
-    x = np.linspace(minx, maxx, n)
-    y = np.linspace(miny, maxy, n)
-    X, Y = np.meshgrid(x, y)
-    np.random.seed(42)
-    Z = np.random.randn(n, n) * 20
+# ===== PROCESAMIENTO DEM POR VENTANAS =====
+TAM_VENTANA_DEM = 2048                  # lado de la ventana de procesamiento (celdas)
+MAX_CELDAS_DEM_EN_MEMORIA = 4_000_000   # por encima, las etapas DEM trabajan por ventanas
+
+def ventanas_dem(forma, tam=TAM_VENTANA_DEM, halo=1):
+    """
+    Recorre el raster en ventanas. Por cada una devuelve (interior, ampliada, desplazamiento):
+    slices del interior sin solapamiento, slices ampliados con `halo` celdas por lado
+    (recortados al raster) y la posición del interior dentro de la ventana ampliada.
+    """
+    filas, columnas = forma
+    for r0 in range(0, filas, tam):
+        for c0 in range(0, columnas, tam):
+            r1, c1 = min(r0 + tam, filas), min(c0 + tam, columnas)
+            R0, C0 = max(r0 - halo, 0), max(c0 - halo, 0)
+            R1, C1 = min(r1 + halo, filas), min(c1 + halo, columnas)
+            interior = (slice(r0, r1), slice(c0, c1))
+            ampliada = (slice(R0, R1), slice(C0, C1))
+            desplazamiento = (slice(r0 - R0, r1 - R0), slice(c0 - C0, c1 - C0))
+            yield interior, ampliada, desplazamiento
+
+def transform_ventana(transform, fila0, col0):
+    """Coeficientes afines (6) de una ventana que empieza en (fila0, col0)."""
+    a, b, c, d, e, f = tuple(transform)[:6]
+    return (a, b, a * col0 + b * fila0 + c, d, e, d * col0 + e * fila0 + f)
+
+def dem_flotante(dem):
+    """Copia float64 de un DEM (o de una ventana) con NaN en celdas sin dato."""
+    z = np.ma.filled(np.ma.asarray(dem).astype(np.float64), np.nan)
+    z[z <= -999] = np.nan
+    return z
+
+def rango_dem(dem):
+    """Mínimo y máximo válidos del DEM, leyendo ventana por ventana."""
+    vmin, vmax = np.inf, -np.inf
+    for interior, _, _ in ventanas_dem(dem.shape, halo=0):
+        z = dem_flotante(dem[interior])
+        if np.isfinite(z).any():
+            vmin = min(vmin, float(np.nanmin(z)))
+            vmax = max(vmax, float(np.nanmax(z)))
+    return vmin, vmax
+
+def mosaico_dem_memmap(teselas, geometria, demtype="SRTMGL1"):
+    """
+    Mosaico float32 (NaN fuera de la geometría) de las teselas DEM en caché, escrito en un
+    .npy memory-mapped bajo DIR_CACHE_DEM/mosaicos. Cada tesela se copia en su ventana y la
+    máscara del polígono se aplica por ventanas, así la memoria pico no depende del área.
+    Devuelve (array memmap de solo lectura, meta, transform).
+    """
+    from rasterio.windows import from_bounds
+    from rasterio.transform import from_origin, Affine
+    from rasterio.features import geometry_mask
+    rutas = [ruta_tesela_dem(i, j, demtype) for i, j in teselas]
+    with rasterio.open(rutas[0]) as src:
+        res_x, res_y = src.res
+        crs = src.crs
+        izquierda, arriba = src.bounds.left, src.bounds.top
+    west, south, east, north = geometria.bounds
+    # Alinear el origen a la grilla de píxeles de las teselas
+    west = izquierda + math.floor((west - izquierda) / res_x) * res_x
+    north = arriba - math.floor((arriba - north) / res_y) * res_y
+    ancho = max(int(math.ceil((east - west) / res_x)), 1)
+    alto = max(int(math.ceil((north - south) / res_y)), 1)
+    transform = from_origin(west, north, res_x, res_y)
+    meta = {"driver": "GTiff", "dtype": "float32", "count": 1, "crs": crs, "transform": transform,
+            "width": ancho, "height": alto, "nodata": np.nan}
+    
+    h = hashlib.sha1(repr((sorted(teselas), demtype, ancho, alto)).encode())
+    h.update(geometria.wkb)
+    ruta = os.path.join(DIR_CACHE_DEM, 'mosaicos', f"{h.hexdigest()[:20]}.npy")
+    if os.path.exists(ruta):
+        return np.load(ruta, mmap_mode='r'), meta, transform
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.{os.getpid()}.tmp.npy"
+    destino = np.lib.format.open_memmap(temporal, mode='w+', dtype=np.float32, shape=(alto, ancho))
+    for interior, _, _ in ventanas_dem(destino.shape, halo=0):
+        destino[interior] = np.nan
+    
+    for ruta_tesela in rutas:
+        with rasterio.open(ruta_tesela) as src:
+            l, b, r, t = src.bounds
+            inter = (max(west, l), max(south, b), min(east, r), min(north, t))
+            if inter[0] >= inter[2] or inter[1] >= inter[3]:
+                continue
+            v_dst = from_bounds(*inter, transform=transform).round_offsets().round_lengths()
+            v_src = from_bounds(*inter, transform=src.transform).round_offsets().round_lengths()
+            f0, c0 = max(int(v_dst.row_off), 0), max(int(v_dst.col_off), 0)
+            f1, c1 = min(f0 + int(v_dst.height), alto), min(c0 + int(v_dst.width), ancho)
+            if f1 <= f0 or c1 <= c0:
+                continue
+            datos = src.read(1, window=v_src, out_shape=(int(v_dst.height), int(v_dst.width)), masked=True)
+            destino[f0:f1, c0:c1] = dem_flotante(datos)[:f1 - f0, :c1 - c0]
+    
+    for (filas, columnas), _, _ in ventanas_dem(destino.shape, halo=0):
+        t_v = Affine(*transform_ventana(transform, filas.start, columnas.start))
+        fuera = geometry_mask([mapping(geometria)], out_shape=(filas.stop - filas.start, columnas.stop - columnas.start),
+                              transform=t_v)
+        destino[filas, columnas][fuera] = np.nan
+    destino.flush()
+    del destino
+    os.replace(temporal, ruta)
+    return np.load(ruta, mmap_mode='r'), meta, transform
+
+TOLERANCIA_CURVAS_PX = 0.5      # simplificación de isolíneas, en píxeles del DEM
+LONGITUD_MIN_CURVA_PX = 4.0     # descarta fragmentos más cortos que esto (en píxeles)
+
+def _curvas_vacias(crs='EPSG:4326'):
+    return gpd.GeoDataFrame({'elevacion': np.array([], dtype=float)}, geometry=[], crs=crs)
+
+def generar_dem_simulado(bounds, n=100, semilla=42):
+    """Relieve suave simulado (50-200 m) sobre los límites dados; fila 0 = sur."""
     from scipy.ndimage import gaussian_filter
-    Z = gaussian_filter(Z, sigma=5)
+    minx, miny, maxx, maxy = bounds
+    Z = gaussian_filter(np.random.RandomState(semilla).randn(n, n) * 20, sigma=5)
     Z = 50 + (Z - Z.min()) / (Z.max() - Z.min()) * 150
-    contours = []
-    niveles = np.arange(50, 200, 10)
-    for nivel in niveles:
-        try:
-            for contour in measure.find_contours(Z, nivel):
-                coords = []
-                for row, col in contour:
-                    lat = miny + (row / n) * (maxy - miny)
-                    lon = minx + (col / n) * (maxx - minx)
-                    coords.append((lon, lat))
-                if len(coords) > 2:
-                    line = LineString(coords)
-                    if line.length > 0.01:
-                        contours.append((line, nivel))
-        except:
-            continue
-    return contours
+    transform = ((maxx - minx) / n, 0.0, minx, 0.0, (maxy - miny) / n, miny)
+    return Z, transform
 
-def generar_curvas_nivel_reales(dem_array, transform, intervalo=10):
+def extraer_curvas_nivel(Z, transform, niveles, tolerancia_px=TOLERANCIA_CURVAS_PX,
+                         longitud_min_px=LONGITUD_MIN_CURVA_PX, crs='EPSG:4326'):
+    """
+    Isolíneas de todos los niveles en una sola pasada de contourpy sobre el DEM (admite
+    arrays enmascarados). Las líneas se construyen en bloque con shapely.linestrings, se
+    simplifican en espacio de píxeles y la transformación afín (rasterio o tupla de 6
+    coeficientes) se aplica a arrays completos de vértices, en el centro de cada píxel.
+    Devuelve un GeoDataFrame con columnas 'elevacion' y 'geometry'.
+    """
     try:
-        from skimage import measure
+        import contourpy
     except ImportError:
-        return []
+        st.warning("Para generar curvas de nivel instala contourpy (incluido con matplotlib >= 3.6)")
+        return _curvas_vacias(crs)
+    niveles = np.asarray(niveles, dtype=np.float64)
+    if Z is None or niveles.size == 0:
+        return _curvas_vacias(crs)
+    
+    generador = contourpy.contour_generator(z=Z, line_type=contourpy.LineType.ChunkCombinedOffset)
+    if hasattr(generador, 'multi_lines'):
+        por_nivel = generador.multi_lines(niveles)
+    else:
+        por_nivel = [generador.lines(nivel) for nivel in niveles]
+    
+    vertices, indices, elevaciones = [], [], []
+    n_lineas = 0
+    for nivel, (puntos_chunks, offsets_chunks) in zip(niveles, por_nivel):
+        for puntos, offsets in zip(puntos_chunks, offsets_chunks):
+            if puntos is None:
+                continue
+            conteos = np.diff(offsets)
+            vertices.append(puntos)
+            indices.append(np.repeat(np.arange(n_lineas, n_lineas + len(conteos)), conteos))
+            elevaciones.append(np.full(len(conteos), nivel))
+            n_lineas += len(conteos)
+    if n_lineas == 0:
+        return _curvas_vacias(crs)
+    
+    lineas = shapely.linestrings(np.concatenate(vertices), indices=np.concatenate(indices))
+    elevaciones = np.concatenate(elevaciones)
+    if tolerancia_px > 0:
+        lineas = shapely.simplify(lineas, tolerancia_px, preserve_topology=False)
+    mantener = shapely.length(lineas) >= longitud_min_px
+    lineas, elevaciones = lineas[mantener], elevaciones[mantener]
+    
+    a, b, c, d, e, f = tuple(transform)[:6]
+    def afin(p):
+        col, fila = p[:, 0] + 0.5, p[:, 1] + 0.5
+        return np.column_stack([a * col + b * fila + c, d * col + e * fila + f])
+    lineas = shapely.transform(lineas, afin)
+    return gpd.GeoDataFrame({'elevacion': elevaciones}, geometry=lineas, crs=crs)
+
+def generar_curvas_nivel_simuladas(gdf, intervalo=10):
+    Z, transform = generar_dem_simulado(gdf.total_bounds)
+    return extraer_curvas_nivel(Z, transform, np.arange(50, 200, intervalo))
+
+def _unir_curvas(geoms, elevaciones):
+    """Une con shapely.line_merge, nivel por nivel, los trozos que comparten extremos."""
+    lineas, niveles_lineas = [], []
+    for nivel in np.unique(elevaciones):
+        unidas = shapely.get_parts(shapely.line_merge(shapely.multilinestrings(geoms[elevaciones == nivel])))
+        lineas.append(unidas)
+        niveles_lineas.append(np.full(len(unidas), nivel))
+    if not lineas:
+        return np.array([], dtype=object), np.array([], dtype=float)
+    return np.concatenate(lineas), np.concatenate(niveles_lineas)
+
+def extraer_curvas_nivel_por_ventanas(dem, transform, niveles, tolerancia_px=TOLERANCIA_CURVAS_PX,
+                                     longitud_min_px=LONGITUD_MIN_CURVA_PX, tam=TAM_VENTANA_DEM):
+    """
+    extraer_curvas_nivel ventana por ventana. Cada ventana incluye la primera fila/columna
+    de la siguiente, así que los trozos de una misma isolínea se tocan en el borde. Cada
+    trozo se simplifica en su ventana (Douglas-Peucker conserva los extremos) y se ajusta a
+    una grilla fina para que los extremos coincidan exactamente. Al terminar cada fila de
+    ventanas los trozos pendientes se unen por nivel con shapely.line_merge, y las líneas que
+    no llegan a la costura con la fila siguiente quedan terminadas: en memoria solo esperan
+    las que cruzan esa costura, de modo que el consumo depende del ancho del DEM y no del área.
+    """
+    a, b, c, d, e, f = tuple(transform)[:6]
+    pixel = float(np.sqrt(abs(a * e - b * d)))
+    inversa = np.linalg.inv(np.array([[a, b], [d, e]], dtype=np.float64))
+    
+    def fila_pixel(xy):
+        return (xy - [c, f]) @ inversa[1] - 0.5
+    
+    terminadas, niveles_terminadas = [], []
+    pendientes, niveles_pendientes = [], []
+    crs = None
+    
+    def cerrar_fila(costura):
+        nonlocal pendientes, niveles_pendientes
+        if not pendientes:
+            return
+        lineas, elevaciones = _unir_curvas(np.concatenate(pendientes), np.concatenate(niveles_pendientes))
+        abiertas = ~shapely.is_closed(lineas)
+        if costura is not None:
+            extremos = np.column_stack([fila_pixel(shapely.get_coordinates(shapely.get_point(lineas, i)))
+                                        for i in (0, -1)])
+            sigue = abiertas & np.any(np.abs(extremos - costura) < 1e-3, axis=1)
+        else:
+            sigue = np.zeros(len(lineas), dtype=bool)
+        terminadas.append(lineas[~sigue])
+        niveles_terminadas.append(elevaciones[~sigue])
+        pendientes, niveles_pendientes = [lineas[sigue]], [elevaciones[sigue]]
+    
+    fila_actual = None
+    for interior, ampliada, _ in ventanas_dem(dem.shape, tam=tam, halo=1):
+        filas, columnas = ampliada
+        if fila_actual is not None and interior[0].start != fila_actual:
+            cerrar_fila(interior[0].start)
+        fila_actual = interior[0].start
+        fila0 = filas.start if filas.start == 0 else filas.start + 1
+        col0 = columnas.start if columnas.start == 0 else columnas.start + 1
+        sub = np.ma.masked_invalid(dem_flotante(dem[fila0:filas.stop, col0:columnas.stop]))
+        if sub.count() == 0:
+            continue
+        trozos = extraer_curvas_nivel(sub, transform_ventana(transform, fila0, col0), niveles,
+                                      tolerancia_px=tolerancia_px, longitud_min_px=0)
+        if len(trozos):
+            crs = trozos.crs
+            pendientes.append(shapely.set_precision(trozos.geometry.values, pixel * 1e-6))
+            niveles_pendientes.append(trozos['elevacion'].to_numpy())
+    cerrar_fila(None)
+    
+    if crs is None:
+        return _curvas_vacias()
+    lineas, elevaciones = np.concatenate(terminadas), np.concatenate(niveles_terminadas)
+    mantener = shapely.length(lineas) >= longitud_min_px * pixel
+    return gpd.GeoDataFrame({'elevacion': elevaciones[mantener]}, geometry=lineas[mantener], crs=crs)
+
+def generar_curvas_nivel_reales(dem_array, transform, intervalo=10):
     if dem_array is None:
-        return []
-    dem_array = np.ma.masked_where(dem_array <= -999, dem_array)
-    vmin = dem_array.min()
-    vmax = dem_array.max()
-    if vmin is np.ma.masked or vmax is np.ma.masked:
-        return []
+        return _curvas_vacias()
+    vmin, vmax = rango_dem(dem_array)
+    if not np.isfinite(vmin) or not np.isfinite(vmax):
+        return _curvas_vacias()
     niveles = np.arange(np.floor(vmin / intervalo) * intervalo,
                         np.ceil(vmax / intervalo) * intervalo + intervalo,
                         intervalo)
-    contours = []
-    for nivel in niveles:
+    return extraer_curvas_nivel_por_ventanas(dem_array, transform, niveles)
+
+# ===== ESTADÍSTICAS ZONALES =====
+def rasterizar_zonas(gdf, forma, transform):
+    """
+    Raster int32 con el índice posicional de cada bloque (0..n-1) en las celdas cuyo centro
+    cae dentro de él y -1 fuera. Usa rasterio.features.rasterize si está disponible y, si no,
+    una consulta STRtree sobre los centros de celda.
+    """
+    filas, columnas = forma
+    a, b, c, d, e, f = tuple(transform)[:6]
+    try:
+        from rasterio.features import rasterize
+        from affine import Affine
+        return rasterize(
+            ((geom, i) for i, geom in enumerate(gdf.geometry.values) if geom is not None and not geom.is_empty),
+            out_shape=forma, transform=Affine(a, b, c, d, e, f), fill=-1, dtype='int32'
+        )
+    except ImportError:
+        cc, ff = np.meshgrid(np.arange(columnas) + 0.5, np.arange(filas) + 0.5)
+        centros = shapely.points(a * cc + b * ff + c, d * cc + e * ff + f).ravel()
+        idx_centro, idx_bloque = shapely.STRtree(np.asarray(gdf.geometry.values, dtype=object)).query(
+            centros, predicate='within')
+        zonas = np.full(filas * columnas, -1, dtype=np.int32)
+        zonas[idx_centro] = idx_bloque
+        return zonas.reshape(forma)
+
+def acumular_zonal(acumulado, valores, zonas, n_zonas):
+    """
+    Suma, suma de cuadrados, conteo, mínimo y máximo por zona (np.bincount, O(n)).
+    Acepta un acumulado previo para agregar ventana por ventana.
+    """
+    if acumulado is None:
+        acumulado = {'suma': np.zeros(n_zonas), 'suma2': np.zeros(n_zonas), 'cuenta': np.zeros(n_zonas),
+                     'min': np.full(n_zonas, np.inf), 'max': np.full(n_zonas, -np.inf)}
+    v = np.asarray(valores, dtype=np.float64).ravel()
+    z = np.asarray(zonas).ravel()
+    validos = (z >= 0) & np.isfinite(v)
+    v, z = v[validos], z[validos]
+    acumulado['suma'] += np.bincount(z, weights=v, minlength=n_zonas)
+    acumulado['suma2'] += np.bincount(z, weights=v * v, minlength=n_zonas)
+    acumulado['cuenta'] += np.bincount(z, minlength=n_zonas)
+    np.minimum.at(acumulado['min'], z, v)
+    np.maximum.at(acumulado['max'], z, v)
+    return acumulado
+
+def finalizar_zonal(acumulado):
+    """Media, desvío, mínimo, máximo y cantidad de celdas válidas por zona."""
+    cuenta = acumulado['cuenta']
+    vacias = cuenta == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        media = acumulado['suma'] / cuenta
+        varianza = acumulado['suma2'] / cuenta - media ** 2
+    return {'media': media, 'desvio': np.sqrt(np.clip(varianza, 0, None)),
+            'min': np.where(vacias, np.nan, acumulado['min']),
+            'max': np.where(vacias, np.nan, acumulado['max']), 'celdas': cuenta.astype(np.int64)}
+
+def estadisticas_zonales(valores, zonas, n_zonas):
+    """Estadísticas por zona de un raster completo en memoria."""
+    return finalizar_zonal(acumular_zonal(None, valores, zonas, n_zonas))
+
+# ===== ANÁLISIS DEL TERRENO =====
+PENDIENTE_MIN_TWI = 0.001       # tan(β) mínima para evitar TWI infinito en zonas planas
+UMBRALES_RIESGO_EROSION = [(1.0, 'Bajo'), (3.0, 'Moderado'), (6.0, 'Alto'), (np.inf, 'Muy alto')]
+# Desplazamientos D8 (fila, columna) en sentido horario desde el norte
+DESPLAZAMIENTOS_D8 = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]
+
+def espaciado_celda_metros(transform, forma):
+    """Espaciado (dx, dy) en metros con signo; dy < 0 cuando la fila 0 es el norte."""
+    a, b, c, d, e, f = tuple(transform)[:6]
+    if abs(a) > 1.0 or abs(e) > 1.0:
+        # Raster ya proyectado en metros
+        return a, e
+    lat_media = f + e * forma[0] / 2.0
+    return a * 111320.0 * math.cos(math.radians(lat_media)), e * 110540.0
+
+def pendiente_orientacion(dem, dx, dy):
+    """
+    Pendiente (grados) y orientación (grados desde el norte, sentido horario, hacia donde
+    mira la ladera) con diferencias centradas de np.gradient. dy lleva el signo de la
+    transformación, así que sirve igual para rasters norte-arriba o sur-arriba.
+    """
+    dz_fila, dz_col = np.gradient(np.asarray(dem, dtype=np.float64))
+    dz_este = dz_col / dx
+    dz_norte = dz_fila / dy
+    pendiente = np.degrees(np.arctan(np.hypot(dz_este, dz_norte)))
+    orientacion = np.degrees(np.arctan2(-dz_este, -dz_norte)) % 360.0
+    return pendiente, orientacion
+
+def direccion_flujo_d8(dem, dx, dy):
+    """
+    Índice lineal de la celda receptora según D8 (mayor caída por distancia) o -1 en
+    sumideros, llanos y celdas sin dato. Recorre los 8 vecinos con operaciones sobre el
+    raster completo, sin bucles por celda.
+    """
+    filas, columnas = dem.shape
+    z = np.pad(np.asarray(dem, dtype=np.float64), 1, constant_values=np.nan)
+    mejor_caida = np.zeros((filas, columnas))
+    receptor = np.full((filas, columnas), -1, dtype=np.int64)
+    ff, cc = np.mgrid[0:filas, 0:columnas]
+    for df, dc in DESPLAZAMIENTOS_D8:
+        distancia = math.hypot(df * dy, dc * dx)
+        vecino = z[1 + df:1 + df + filas, 1 + dc:1 + dc + columnas]
+        with np.errstate(invalid='ignore'):
+            caida = (z[1:-1, 1:-1] - vecino) / distancia
+            mejor = caida > mejor_caida
+        mejor_caida = np.where(mejor, caida, mejor_caida)
+        receptor = np.where(mejor, (ff + df) * columnas + (cc + dc), receptor)
+    return receptor.ravel()
+
+def acumulacion_flujo(receptor, validos=None):
+    """
+    Celdas aguas arriba (incluida la propia) de cada celda. Ordenamiento topológico por
+    frentes (Kahn): cada celda se procesa una sola vez cuando ya recibió a todos sus
+    donantes, así que el costo es O(n) y no hay recursión.
+    """
+    n = receptor.size
+    acumulado = np.ones(n, dtype=np.float64)
+    if validos is not None:
+        acumulado[~validos.ravel()] = 0.0
+    drena = receptor >= 0
+    pendientes = np.bincount(receptor[drena], minlength=n)
+    frente = np.flatnonzero((pendientes == 0) & drena)
+    while frente.size:
+        destino = receptor[frente]
+        np.add.at(acumulado, destino, acumulado[frente])
+        np.subtract.at(pendientes, destino, 1)
+        destino = np.unique(destino)
+        frente = destino[(pendientes[destino] == 0) & drena[destino]]
+    return acumulado
+
+def analizar_terreno(dem, transform):
+    """
+    Pendiente, orientación, acumulación de flujo D8, índice topográfico de humedad
+    (TWI = ln(a / tan β)) y factor LS de RUSLE (Moore & Burch) sobre un DEM.
+    Devuelve un dict de rasters con la forma del DEM.
+    """
+    dem = dem_flotante(dem)
+    dx, dy = espaciado_celda_metros(transform, dem.shape)
+    pendiente, orientacion = pendiente_orientacion(dem, dx, dy)
+    validos = np.isfinite(dem)
+    receptor = direccion_flujo_d8(dem, abs(dx), abs(dy))
+    acumulado = acumulacion_flujo(receptor, validos).reshape(dem.shape)
+    
+    ancho = math.sqrt(abs(dx * dy))
+    area_especifica = acumulado * abs(dx * dy) / ancho
+    beta = np.radians(pendiente)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        twi = np.log(area_especifica / np.maximum(np.tan(beta), PENDIENTE_MIN_TWI))
+        ls = (area_especifica / 22.13) ** 0.4 * (np.sin(beta) / 0.0896) ** 1.3
+    for capa in (twi, ls):
+        capa[~validos] = np.nan
+    return {'pendiente': pendiente, 'orientacion': orientacion, 'area_aporte_ha': acumulado * abs(dx * dy) / 10000.0,
+            'twi': twi, 'ls': ls}
+
+def clasificar_riesgo_erosion(ls):
+    limites = np.array([u for u, _ in UMBRALES_RIESGO_EROSION])
+    etiquetas = np.array([c for _, c in UMBRALES_RIESGO_EROSION] + ['Sin dato'], dtype=object)
+    ls = np.asarray(ls, dtype=np.float64)
+    return np.where(np.isfinite(ls), etiquetas[np.searchsorted(limites, ls, side='right').clip(max=len(limites) - 1)],
+                    'Sin dato')
+
+def _acumular_terreno(acumulados, capas, zonas, n_zonas):
+    """Agrega capas del terreno por zona; la orientación se promedia como vector (seno, coseno)."""
+    for nombre, valores in capas.items():
+        if nombre == 'orientacion':
+            rad = np.radians(valores)
+            acumulados['seno'] = acumular_zonal(acumulados.get('seno'), np.sin(rad), zonas, n_zonas)
+            acumulados['coseno'] = acumular_zonal(acumulados.get('coseno'), np.cos(rad), zonas, n_zonas)
+        else:
+            acumulados[nombre] = acumular_zonal(acumulados.get(nombre), valores, zonas, n_zonas)
+    return acumulados
+
+def _terreno_por_ventanas(gdf, dem, transform):
+    """
+    Versión por ventanas para DEM grandes (p. ej. memmap): pendiente y orientación se calculan
+    en ventanas con halo de 1 celda. La acumulación de flujo no es local, así que TWI y LS se
+    calculan sobre el DEM submuestreado hasta MAX_CELDAS_DEM_EN_MEMORIA celdas.
+    """
+    n = len(gdf)
+    dx, dy = espaciado_celda_metros(transform, dem.shape)
+    acumulados = {}
+    for interior, ampliada, desplazamiento in ventanas_dem(dem.shape, halo=1):
+        pendiente, orientacion = pendiente_orientacion(dem_flotante(dem[ampliada]), dx, dy)
+        pendiente, orientacion = pendiente[desplazamiento], orientacion[desplazamiento]
+        zonas = rasterizar_zonas(gdf, pendiente.shape,
+                                 transform_ventana(transform, interior[0].start, interior[1].start))
+        if (zonas >= 0).any():
+            _acumular_terreno(acumulados, {'pendiente': pendiente, 'orientacion': orientacion}, zonas, n)
+    
+    paso = int(math.ceil(math.sqrt(dem.size / MAX_CELDAS_DEM_EN_MEMORIA)))
+    a, b, c, d, e, f = tuple(transform)[:6]
+    transform_reducido = (a * paso, b * paso, c, d * paso, e * paso, f)
+    capas = analizar_terreno(dem[::paso, ::paso], transform_reducido)
+    zonas = rasterizar_zonas(gdf, capas['twi'].shape, transform_reducido)
+    return _acumular_terreno(acumulados, {k: capas[k] for k in ('twi', 'ls', 'area_aporte_ha')}, zonas, n)
+
+def terreno_por_bloque(gdf, dem, transform):
+    """
+    Agrega el análisis del terreno por bloque mediante estadísticas zonales y devuelve
+    un DataFrame alineado con gdf (mismo índice). Los DEM de más de
+    MAX_CELDAS_DEM_EN_MEMORIA celdas se procesan por ventanas.
+    """
+    n = len(gdf)
+    if dem.size > MAX_CELDAS_DEM_EN_MEMORIA:
+        acumulados = _terreno_por_ventanas(gdf, dem, transform)
+    else:
+        capas = analizar_terreno(dem, transform)
+        zonas = rasterizar_zonas(gdf, capas['pendiente'].shape, transform)
+        acumulados = _acumular_terreno({}, capas, zonas, n)
+    est = {nombre: finalizar_zonal(acumulado) for nombre, acumulado in acumulados.items()}
+    return pd.DataFrame({
+        'pendiente_media': np.round(est['pendiente']['media'], 2),
+        'pendiente_max': np.round(est['pendiente']['max'], 2),
+        'orientacion_media': np.round(np.degrees(np.arctan2(est['seno']['media'], est['coseno']['media'])) % 360.0, 0),
+        'twi_medio': np.round(est['twi']['media'], 2),
+        'area_aporte_max_ha': np.round(est['area_aporte_ha']['max'], 2),
+        'ls_medio': np.round(est['ls']['media'], 2),
+        'riesgo_erosion': clasificar_riesgo_erosion(est['ls']['media'])
+    }, index=gdf.index)
+
+# ===== PROPIEDADES DE SUELO (SOILGRIDS LOCAL) =====
+DIR_SOILGRIDS = os.environ.get(
+    "SOILGRIDS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'soilgrids')
+)
+# variable SoilGrids -> (columna, factor a unidades de la app: g/kg -> %, dg/kg -> g/kg, pH*10 -> pH)
+VARIABLES_SOILGRIDS = {
+    'sand': ('arena', 0.1), 'silt': ('limo', 0.1), 'clay': ('arcilla', 0.1),
+    'soc': ('COS_g_kg', 0.1), 'phh2o': ('pH_suelo', 0.1),
+}
+# (intervalo, espesor en cm): la media ponderada cubre 0-30 cm
+PROFUNDIDADES_SOILGRIDS = [('0-5cm', 5), ('5-15cm', 10), ('15-30cm', 15)]
+EXTENSIONES_SOILGRIDS = ('.tif', '.vrt')
+
+def ruta_soilgrids(variable, profundidad, directorio=DIR_SOILGRIDS):
+    """Ruta del raster '<variable>_<profundidad>_mean.tif|.vrt' en el almacén local, o None."""
+    for extension in EXTENSIONES_SOILGRIDS:
+        ruta = os.path.join(directorio, f"{variable}_{profundidad}_mean{extension}")
+        if os.path.exists(ruta):
+            return ruta
+    return None
+
+def leer_ventana_soilgrids(ruta, gdf):
+    """
+    Lee solo la ventana del raster que cubre la parcela, con una celda de margen.
+    Devuelve (valores float64 con NaN, transform de la ventana, gdf en el CRS del raster)
+    o None si el raster no cubre la parcela.
+    """
+    from rasterio.windows import from_bounds, Window
+    from rasterio.errors import WindowError
+    with rasterio.open(ruta) as src:
+        gdf_src = gdf.to_crs(src.crs) if src.crs is not None and gdf.crs is not None and gdf.crs != src.crs else gdf
+        ventana = from_bounds(*gdf_src.total_bounds, transform=src.transform)
+        ventana = Window(math.floor(ventana.col_off) - 1, math.floor(ventana.row_off) - 1,
+                         math.ceil(ventana.width) + 3, math.ceil(ventana.height) + 3)
         try:
-            for contour in measure.find_contours(dem_array.filled(fill_value=-999), nivel):
-                coords = []
-                for row, col in contour:
-                    x, y = transform * (col, row)
-                    coords.append((x, y))
-                if len(coords) > 2:
-                    line = LineString(coords)
-                    if line.length > 0.01:
-                        contours.append((line, nivel))
-        except:
-            continue
-    return contours
+            ventana = ventana.intersection(Window(0, 0, src.width, src.height))
+        except WindowError:
+            return None
+        datos = src.read(1, window=ventana, masked=True)
+        return np.ma.filled(datos.astype(np.float64), np.nan), tuple(src.window_transform(ventana))[:6], gdf_src
+
+def media_por_bloque(valores, transform, gdf):
+    """
+    Media zonal por bloque. Los bloques más chicos que una celda (ningún centro de celda
+    dentro) toman el valor de la celda que contiene su centroide.
+    """
+    n = len(gdf)
+    zonas = rasterizar_zonas(gdf, valores.shape, transform)
+    media = finalizar_zonal(acumular_zonal(None, valores, zonas, n))['media']
+    sin_celdas = ~np.isfinite(media)
+    if sin_celdas.any():
+        from affine import Affine
+        inversa = ~Affine(*transform)
+        centroides = shapely.centroid(np.asarray(gdf.geometry.values, dtype=object)[sin_celdas])
+        x, y = shapely.get_x(centroides), shapely.get_y(centroides)
+        columnas = np.floor(inversa.a * x + inversa.b * y + inversa.c).astype(np.int64)
+        filas = np.floor(inversa.d * x + inversa.e * y + inversa.f).astype(np.int64)
+        dentro = (filas >= 0) & (filas < valores.shape[0]) & (columnas >= 0) & (columnas < valores.shape[1])
+        muestra = np.full(len(x), np.nan)
+        muestra[dentro] = valores[filas[dentro], columnas[dentro]]
+        media[sin_celdas] = muestra
+    return media
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _propiedades_suelo_cacheadas(clave, _gdf, _rutas):
+    """Medias por bloque ponderadas por espesor (0-30 cm) de cada variable disponible."""
+    columnas = {}
+    for variable, (columna, factor) in VARIABLES_SOILGRIDS.items():
+        suma, pesos = np.zeros(len(_gdf)), np.zeros(len(_gdf))
+        for profundidad, espesor in PROFUNDIDADES_SOILGRIDS:
+            ruta = _rutas.get((variable, profundidad))
+            lectura = leer_ventana_soilgrids(ruta, _gdf) if ruta else None
+            if lectura is None:
+                continue
+            valores, transform, gdf_src = lectura
+            media = media_por_bloque(valores, transform, gdf_src) * factor
+            validos = np.isfinite(media)
+            suma[validos] += media[validos] * espesor
+            pesos[validos] += espesor
+        if pesos.any():
+            with np.errstate(invalid='ignore'):
+                columnas[columna] = np.where(pesos > 0, suma / pesos, np.nan)
+    return pd.DataFrame(columnas, index=_gdf.index) if columnas else None
+
+def propiedades_suelo_por_bloque(gdf, directorio=DIR_SOILGRIDS):
+    """
+    Arena, limo, arcilla (%), carbono orgánico (g/kg) y pH por bloque desde el almacén local
+    tipo SoilGrids, sin acceso a red. Cada raster se lee solo en la ventana de la parcela y el
+    resultado se cachea por geometría de parcela y versión de los archivos.
+    Devuelve un DataFrame alineado con gdf o None si no hay almacén o no cubre la parcela.
+    """
+    if not RASTERIO_OK or not os.path.isdir(directorio):
+        return None
+    rutas = {(variable, profundidad): ruta_soilgrids(variable, profundidad, directorio)
+             for variable in VARIABLES_SOILGRIDS for profundidad, _ in PROFUNDIDADES_SOILGRIDS}
+    rutas = {k: r for k, r in rutas.items() if r}
+    if not rutas:
+        return None
+    try:
+        firma = repr(sorted((os.path.basename(r), os.path.getmtime(r)) for r in rutas.values()))
+        clave = hashlib.sha1((hash_gdf(gdf[[gdf.geometry.name]]) + firma).encode()).hexdigest()
+        propiedades = _propiedades_suelo_cacheadas(clave, gdf, rutas)
+        if propiedades is None or propiedades.isna().all().all():
+            return None
+        return propiedades
+    except Exception as e:
+        st.warning(f"No se pudo leer el almacén de suelos: {str(e)[:100]}")
+        return None
+
+# ===== VISTA 3D DEL TERRENO =====
+MAX_LADO_MALLA = 513            # lado máximo del DEM usado para sombreado y malla
+TRIANGULOS_MALLA = 20000        # presupuesto por defecto de triángulos
+TOLERANCIA_MALLA_M = 1.0        # error vertical admitido antes de subdividir (m)
+
+def preparar_dem_malla(dem, transform, max_lado=MAX_LADO_MALLA):
+    """DEM submuestreado a lo sumo a max_lado celdas por lado, su transformación y una clave de caché."""
+    paso = max(1, int(math.ceil(max(dem.shape) / max_lado)))
+    Z = dem_flotante(dem[::paso, ::paso])
+    a, b, c, d, e, f = tuple(transform)[:6]
+    transform_reducido = (a * paso, b * paso, c, d * paso, e * paso, f)
+    h = hashlib.sha1(np.ascontiguousarray(Z).tobytes())
+    h.update(repr(transform_reducido).encode())
+    return Z, transform_reducido, h.hexdigest()
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def sombreado_relieve(clave, _Z, dx, dy, azimut=315.0, altitud=45.0):
+    """Sombreado (hillshade) en [0, 1] con la iluminación clásica noroeste a 45°."""
+    pendiente, orientacion = pendiente_orientacion(_Z, dx, dy)
+    zenit = math.radians(90.0 - altitud)
+    beta = np.radians(pendiente)
+    luz = (math.cos(zenit) * np.cos(beta) +
+           math.sin(zenit) * np.sin(beta) * np.cos(math.radians(azimut) - np.radians(orientacion)))
+    return np.clip(luz, 0.0, 1.0).astype(np.float32)
+
+def decimar_malla_quadtree(Z, tolerancia=TOLERANCIA_MALLA_M, max_triangulos=TRIANGULOS_MALLA):
+    """
+    Simplificación acotada por error: se parte de un único cuadrante y, nivel por nivel, se
+    subdividen los cuadrantes cuyo error vertical máximo respecto de la interpolación
+    bilineal de sus esquinas supera la tolerancia (los de mayor error primero, hasta agotar
+    el presupuesto). El error de todos los cuadrantes de un nivel se evalúa de una vez con
+    sliding_window_view. Los vértices resultantes se triangulan con Delaunay, lo que evita
+    grietas entre cuadrantes de distinto tamaño.
+    El presupuesto se lleva en vértices: una triangulación de Delaunay de V puntos tiene a lo
+    sumo 2V - 5 triángulos, así que nunca se supera max_triangulos. Los cuadrantes del borde
+    de la parcela (esquinas sin dato) se ordenan por el error de sus celdas con dato y se
+    subdividen después de los interiores que superan la tolerancia.
+    Devuelve (filas, columnas, z, triangulos) con índices de vértice por triángulo.
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+    filas, columnas = Z.shape
+    lado = 2 ** int(math.ceil(math.log2(max(filas, columnas, 2) - 1)))
+    P = np.full((lado + 1, lado + 1), np.nan)
+    P[:filas, :columnas] = Z
+    
+    cuadrantes = np.zeros((1, 2), dtype=np.int64)
+    hojas = []
+    max_vertices = (max_triangulos + 5) // 2
+    vertices_usados = 4
+    s = lado
+    while len(cuadrantes):
+        if s == 1:
+            hojas.append((cuadrantes, s))
+            break
+        v = sliding_window_view(P, (s + 1, s + 1))[cuadrantes[:, 0], cuadrantes[:, 1]]
+        hay_datos = np.isfinite(v).any(axis=(1, 2))
+        cuadrantes, v = cuadrantes[hay_datos], v[hay_datos]
+        u = np.linspace(0.0, 1.0, s + 1)
+        wf, wc = (1 - u)[:, None], (1 - u)[None, :]
+        bilineal = (v[:, :1, :1] * wf * wc + v[:, :1, -1:] * wf * (1 - wc) +
+                    v[:, -1:, :1] * (1 - wf) * wc + v[:, -1:, -1:] * (1 - wf) * (1 - wc))
+        with np.errstate(invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            error = np.nanmax(np.abs(v - bilineal), axis=(1, 2))
+            # Borde de la parcela: la bilineal no existe; se usa el relieve de las celdas con dato
+            relieve = np.nanmax(v, axis=(1, 2)) - np.nanmin(v, axis=(1, 2))
+        borde = ~np.isfinite(error)
+        error = np.where(borde, relieve, error)
+        
+        # Primero los que superan la tolerancia (mayor error antes); luego el resto del borde
+        candidatos = np.flatnonzero((error > tolerancia) | borde)
+        candidatos = candidatos[np.lexsort((-error[candidatos], ~(error[candidatos] > tolerancia)))]
+        mitad = s // 2
+        # Vértices nuevos por subdivisión: el centro más los puntos medios de los lados que
+        # no aporta antes otro cuadrante del mismo nivel con mayor prioridad
+        medios = (cuadrantes[candidatos][:, None, :] +
+                  np.array([[0, mitad], [mitad, 0], [mitad, s], [s, mitad]])[None, :, :]).reshape(-1, 2)
+        _, primera = np.unique(medios, axis=0, return_index=True)
+        nuevos = 1 + np.bincount(primera // 4, minlength=len(candidatos))
+        cupo = np.searchsorted(np.cumsum(nuevos), max_vertices - vertices_usados, side='right')
+        dividir = np.zeros(len(cuadrantes), dtype=bool)
+        dividir[candidatos[:cupo]] = True
+        vertices_usados += int(nuevos[:cupo].sum())
+        hojas.append((cuadrantes[~dividir], s))
+        padres = cuadrantes[dividir]
+        cuadrantes = np.concatenate([padres + [0, 0], padres + [0, mitad], padres + [mitad, 0], padres + [mitad, mitad]])
+        s = mitad
+    
+    esquinas = [np.concatenate([q + [df * s, dc * s] for df in (0, 1) for dc in (0, 1)]) for q, s in hojas if len(q)]
+    if not esquinas:
+        return np.array([]), np.array([]), np.array([]), np.empty((0, 3), dtype=np.int64)
+    vertices = np.unique(np.concatenate(esquinas), axis=0)
+    vertices = vertices[(vertices[:, 0] < filas) & (vertices[:, 1] < columnas)]
+    z = Z[vertices[:, 0], vertices[:, 1]]
+    vertices, z = vertices[np.isfinite(z)], z[np.isfinite(z)]
+    if len(vertices) < 3:
+        return vertices[:, 0], vertices[:, 1], z, np.empty((0, 3), dtype=np.int64)
+    
+    tri = Delaunay(vertices[:, ::-1].astype(np.float64)).simplices
+    # Descartar triángulos cuyo centro cae fuera de la parcela (regiones cóncavas)
+    centro = np.rint(vertices[tri].mean(axis=1)).astype(np.int64)
+    tri = tri[np.isfinite(Z[centro[:, 0], centro[:, 1]])]
+    return vertices[:, 0], vertices[:, 1], z, tri
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def malla_terreno(clave, _Z, _transform, max_triangulos=TRIANGULOS_MALLA, tolerancia=TOLERANCIA_MALLA_M):
+    """Malla decimada (lon, lat, z, triángulos) y sombreado por vértice; cacheada por DEM y nivel."""
+    filas, columnas, z, tri = decimar_malla_quadtree(_Z, tolerancia, max_triangulos)
+    a, b, c, d, e, f = _transform
+    fc, cc = filas + 0.5, columnas + 0.5
+    dx, dy = espaciado_celda_metros(_transform, _Z.shape)
+    sombreado = sombreado_relieve(clave, _Z, dx, dy)
+    return {
+        'lon': a * cc + b * fc + c,
+        'lat': d * cc + e * fc + f,
+        'z': z,
+        'triangulos': tri,
+        'sombreado': sombreado[filas, columnas] if len(filas) else np.array([])
+    }
+
+def crear_vista_3d_terreno(gdf, dem, transform, color='NDVI', max_triangulos=TRIANGULOS_MALLA, exageracion=2.0):
+    """
+    Figura Plotly con la malla decimada del terreno, coloreada por NDVI (interpolado con IDW
+    desde los bloques), elevación o sombreado, y los límites de bloques sobre la superficie.
+    """
+    Z, transform_malla, clave = preparar_dem_malla(dem, transform)
+    malla = malla_terreno(clave, Z, transform_malla, max_triangulos)
+    if len(malla['triangulos']) == 0:
+        return None
+    lon0, lat0 = float(np.mean(malla['lon'])), float(np.mean(malla['lat']))
+    kx, ky = 111320.0 * math.cos(math.radians(lat0)), 110540.0
+    x, y = (malla['lon'] - lon0) * kx, (malla['lat'] - lat0) * ky
+    
+    if color == 'NDVI' and 'ndvi_modis' in gdf.columns and gdf['ndvi_modis'].notna().any():
+        validos = gdf['ndvi_modis'].notna().values
+        intensidad = interpolar_idw(centroides_bloques(gdf)[validos], gdf['ndvi_modis'].values[validos],
+                                    np.column_stack([malla['lon'], malla['lat']]))
+        escala, titulo_color = 'RdYlGn', 'NDVI'
+    elif color == 'Sombreado':
+        intensidad, escala, titulo_color = malla['sombreado'], 'gray', 'Sombreado'
+    else:
+        intensidad, escala, titulo_color = malla['z'], 'earth', 'Elevación (m)'
+    
+    tri = malla['triangulos']
+    fig = go.Figure(go.Mesh3d(
+        x=x, y=y, z=malla['z'] * exageracion,
+        i=tri[:, 0], j=tri[:, 1], k=tri[:, 2],
+        intensity=intensidad, colorscale=escala,
+        colorbar=dict(title=titulo_color),
+        customdata=malla['z'],
+        hovertemplate='Elevación: %{customdata:.1f} m<extra></extra>',
+        lighting=dict(ambient=0.5, diffuse=0.8, roughness=0.9, specular=0.1),
+        flatshading=False,
+        name='Terreno'
+    ))
+    
+    # Límites de bloques apoyados sobre la superficie
+    from scipy.ndimage import map_coordinates
+    paso = abs(tuple(transform_malla)[0]) / 2
+    a, b, c, d, e, f = transform_malla
+    Z_relleno = np.where(np.isfinite(Z), Z, np.nanmean(Z))
+    bx, by, bz = [], [], []
+    for geom in shapely.segmentize(np.asarray(gdf.geometry.values, dtype=object), paso):
+        for parte in getattr(geom, 'geoms', [geom]):
+            coords = np.asarray(parte.exterior.coords)
+            det = a * e - b * d
+            col = (e * (coords[:, 0] - c) - b * (coords[:, 1] - f)) / det - 0.5
+            fila = (-d * (coords[:, 0] - c) + a * (coords[:, 1] - f)) / det - 0.5
+            zb = map_coordinates(Z_relleno, [fila, col], order=1, mode='nearest')
+            bx.extend(((coords[:, 0] - lon0) * kx).tolist() + [None])
+            by.extend(((coords[:, 1] - lat0) * ky).tolist() + [None])
+            bz.extend((zb * exageracion + 1.0).tolist() + [None])
+    fig.add_trace(go.Scatter3d(x=bx, y=by, z=bz, mode='lines', line=dict(color='white', width=3),
+                               name='Bloques', hoverinfo='skip'))
+    fig.update_layout(
+        height=650, margin=dict(l=0, r=0, t=30, b=0),
+        scene=dict(aspectmode='data', xaxis_title='Este (m)', yaxis_title='Norte (m)',
+                   zaxis_title=f'Elevación ×{exageracion:g}'),
+        title=f"Terreno 3D · {len(tri):,} triángulos"
+    )
+    return fig
 
-def mapa_curvas_coloreadas(gdf_original, curvas_con_elevacion):
+def mapa_curvas_coloreadas(gdf_original, gdf_curvas, agrupar_niveles=True):
+    """
+    Mapa de curvas de nivel (GeoDataFrame con 'elevacion') como una sola capa GeoJSON.
+    Con agrupar_niveles=True las líneas de una misma cota se unen en una MultiLineString,
+    de modo que hay una entidad por nivel en lugar de una por tramo.
+    """
     centroide = gdf_original.geometry.unary_union.centroid
     m = folium.Map(location=[centroide.y, centroide.x], zoom_start=15, tiles=None, control_scale=True)
     folium.TileLayer('https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
                      attr='Esri', name='Satélite Esri', overlay=False, control=True).add_to(m)
     folium.TileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png',
                      attr='OpenStreetMap', name='OpenStreetMap', overlay=False, control=True).add_to(m)
-    folium.GeoJson(gdf_original.to_json(), name='Plantación',
+    folium.GeoJson(geojson_compacto(gdf_original, [], zoom=ZOOM_DETALLE_MAPA), name='Plantación',
                    style_function=lambda x: {'color': 'blue', 'fillOpacity': 0.1, 'weight': 2}).add_to(m)
-    elevaciones = [e for _, e in curvas_con_elevacion]
-    if elevaciones:
-        vmin = min(elevaciones); vmax = max(elevaciones)
+    if len(gdf_curvas):
+        if agrupar_niveles:
+            gdf_curvas = gdf_curvas.dissolve(by='elevacion', as_index=False)
+        vmin = float(gdf_curvas['elevacion'].min()); vmax = float(gdf_curvas['elevacion'].max())
         colormap = LinearColormap(colors=['green','yellow','orange','brown'], vmin=vmin, vmax=vmax, caption='Elevación (m.s.n.m)')
         colormap.add_to(m)
-        for line, elev in curvas_con_elevacion:
-            folium.GeoJson(gpd.GeoSeries(line).to_json(), name='Curvas',
-                           style_function=lambda x, e=elev: {'color': colormap(e), 'weight': 1.5, 'opacity': 0.9},
-                           tooltip=f'Elevación: {elev:.0f} m').add_to(m)
+        folium.GeoJson(
+            geojson_compacto(gdf_curvas, ['elevacion'], zoom=ZOOM_DETALLE_MAPA),
+            name='Curvas de nivel',
+            style_function=lambda x: {'color': colormap(x['properties']['elevacion']), 'weight': 1.5, 'opacity': 0.9},
+            tooltip=folium.GeoJsonTooltip(fields=['elevacion'], aliases=['Elevación (m)'], localize=True)
+        ).add_to(m)
     folium.LayerControl(collapsed=False).add_to(m)
     Fullscreen().add_to(m)
     return m
 
+# ===== CACHÉ DE MAPAS RENDERIZADOS =====
+MAX_MAPAS_CACHE = 24
+
+def hash_gdf(gdf):
+    """Hash estable del contenido de un GeoDataFrame (atributos + geometría WKB + CRS)."""
+    h = hashlib.sha1()
+    atributos = gdf.drop(columns=gdf.geometry.name)
+    h.update(repr(list(atributos.columns)).encode())
+    if len(atributos.columns):
+        try:
+            h.update(pd.util.hash_pandas_object(atributos, index=True).values.tobytes())
+        except TypeError:
+            # Columnas con objetos no hashables (listas, dicts)
+            h.update(atributos.to_json(default_handler=str).encode())
+    for wkb in gdf.geometry.to_wkb():
+        h.update(wkb or b'')
+    h.update(str(gdf.crs).encode())
+    return h.hexdigest()
+
+def _firma_estilo(valor):
+    """Representación hashable de los argumentos de un constructor de mapas."""
+    if isinstance(valor, gpd.GeoDataFrame):
+        return ('gdf', hash_gdf(valor))
+    if isinstance(valor, pd.DataFrame):
+        return ('df', hashlib.sha1(pd.util.hash_pandas_object(valor, index=True).values.tobytes()).hexdigest())
+    if isinstance(valor, LinearColormap):
+        return ('cmap', tuple(valor.colors), valor.vmin, valor.vmax, valor.caption)
+    if hasattr(valor, 'wkb'):
+        return ('geom', hashlib.sha1(valor.wkb).hexdigest())
+    if isinstance(valor, (list, tuple)):
+        return tuple(_firma_estilo(v) for v in valor)
+    if isinstance(valor, dict):
+        return tuple(sorted((k, _firma_estilo(v)) for k, v in valor.items()))
+    return repr(valor)
+
+@st.cache_data(max_entries=MAX_MAPAS_CACHE, show_spinner=False)
+def _html_mapa_cacheado(clave, _constructor, _args, _kwargs):
+    """HTML final del mapa; st.cache_data descarta la entrada menos usada al superar el límite."""
+    m = _constructor(*_args, **_kwargs)
+    if m is None:
+        # Una excepción evita que el fallo quede memorizado
+        raise ValueError("El constructor no devolvió un mapa")
+    return m.get_root().render()
+
+def mostrar_mapa_cacheado(constructor, *args, width=1000, height=600, **kwargs):
+    """
+    Dibuja el mapa de `constructor(*args, **kwargs)` reutilizando el HTML ya renderizado
+    si los datos y el estilo no cambiaron. Devuelve False si no se pudo construir.
+    """
+    firma = (constructor.__module__, constructor.__qualname__, _firma_estilo(args), _firma_estilo(kwargs))
+    clave = hashlib.sha1(repr(firma).encode()).hexdigest()
+    try:
+        html = _html_mapa_cacheado(clave, constructor, args, kwargs)
+    except Exception:
+        return False
+    components.html(html, width=width, height=height)
+    return True
+
 # ===== FUNCIÓN PRINCIPAL DE ANÁLISIS =====
 def ejecutar_analisis_completo():
     if st.session_state.gdf_original is None:
@@ -2326,10 +4464,38 @@ def ejecutar_analisis_completo():
         # Análisis de suelo
         if st.session_state.get('analisis_suelo', True):
             st.session_state.textura_por_bloque = analizar_textura_suelo_venezuela_por_bloque(gdf_dividido)
-            if st.session_state.textura_por_bloque:
-                st.session_state.textura_suelo = st.session_state.textura_por_bloque[0]
-
-        st.session_state.datos_fertilidad = generar_mapa_fertilidad(gdf_dividido)
+            if st.session_state.textura_por_bloque is not None and len(st.session_state.textura_por_bloque):
+                st.session_state.textura_suelo = st.session_state.textura_por_bloque.iloc[0].to_dict()
+
+        # Análisis del terreno (DEM en caché / OpenTopography, o relieve simulado).
+        # Con relieve simulado, la pendiente y la erosión por bloque solo se calculan en modo
+        # DEMO y quedan marcadas como simuladas; en PREMIUM no se inventan valores de terreno.
+        dem, transform_dem = None, None
+        if not st.session_state.demo_mode:
+            dem, _, transform_dem = obtener_dem_opentopography(gdf)
+        st.session_state.fuente_terreno = 'SRTM' if dem is not None else 'Simulado'
+        if dem is None:
+            dem, transform_dem = generar_dem_simulado(gdf.total_bounds)
+        st.session_state.dem_terreno = (dem, transform_dem)
+        if st.session_state.fuente_terreno == 'SRTM' or st.session_state.demo_mode:
+            try:
+                terreno = terreno_por_bloque(gdf_dividido, dem, transform_dem)
+                gdf_dividido = gdf_dividido.drop(columns=[c for c in terreno.columns if c in gdf_dividido.columns])
+                gdf_dividido = gdf_dividido.join(terreno)
+            except Exception as e:
+                st.warning(f"No se pudo completar el análisis del terreno: {str(e)[:100]}")
+        else:
+            st.info("ℹ️ Sin DEM en caché ni API key de OpenTopography: se omite la pendiente y el riesgo de "
+                    "erosión por bloque. Genera las curvas de nivel con tu API key y vuelve a ejecutar el análisis.")
+
+        fertilidad, validacion = generar_mapa_fertilidad(gdf_dividido, st.session_state.get('cultivo_seleccionado', 'Trigo'),
+                                                         st.session_state.get('muestras_laboratorio'))
+        st.session_state.datos_fertilidad = fertilidad
+        st.session_state.validacion_muestras = validacion
+        if fertilidad is not None:
+            columnas_fert = [c for c in fertilidad.columns if c != 'id_bloque']
+            gdf_dividido = gdf_dividido.drop(columns=[c for c in columnas_fert if c in gdf_dividido.columns])
+            gdf_dividido = gdf_dividido.join(fertilidad[columnas_fert])
 
         st.session_state.resultados_todos = {
             'exitoso': True,
@@ -2339,61 +4505,518 @@ def ejecutar_analisis_completo():
         st.session_state.analisis_completado = True
         st.success("✅ Análisis completado!")
 
-# ===== FUNCIÓN DE ANÁLISIS DE COSTOS =====
-def calcular_costos(gdf_completo, cultivo):
+# ===== RENDIMIENTO DE COSECHA (MONITOR) =====
+ALIAS_COLUMNAS_RENDIMIENTO = {
+    'lon': 'x', 'longitud': 'x', 'long': 'x', 'x': 'x', 'lat': 'y', 'latitud': 'y', 'y': 'y',
+    'rendimiento': 'rendimiento', 'rend': 'rendimiento', 'yield': 'rendimiento', 'dry_yield': 'rendimiento',
+    'yld_mass_d': 'rendimiento', 'yld_mass_dr': 'rendimiento', 'yld_mass_w': 'rendimiento',
+    'velocidad': 'velocidad', 'vel': 'velocidad', 'speed': 'velocidad', 'speed_km_h': 'velocidad',
+    'tiempo': 'tiempo', 'time': 'tiempo', 'timestamp': 'tiempo', 'fecha_hora': 'tiempo',
+    'cabezal': 'cabezal', 'header': 'cabezal', 'header_status': 'cabezal', 'hdr_status': 'cabezal',
+}
+UNIDADES_RENDIMIENTO = {'t/ha': 1.0, 'kg/ha': 0.001}
+TAM_LOTE_RENDIMIENTO = 500_000      # registros leídos por lote
+VELOCIDAD_COSECHA_KMH = (2.0, 15.0)
+CAMBIO_VELOCIDAD_MAX = 0.4          # variación relativa máxima entre registros consecutivos
+RETARDO_FLUJO_REGISTROS = 12        # demora del grano hasta el sensor (registros, ≈ s a 1 Hz)
+REGISTROS_INICIO_PASADA = 5         # llenado de la cosechadora al entrar en una pasada
+GIRO_NUEVA_PASADA_GRADOS = 150     # giro acumulado en la ventana que marca una cabecera
+VENTANA_GIRO_REGISTROS = 12         # registros sobre los que se acumula el giro (≈ s a 1 Hz)
+DISTANCIA_CORTE_PASADA_M = 20.0     # salto de posición entre registros que corta la pasada
+TIEMPO_CORTE_PASADA_S = 10.0        # hueco de tiempo entre registros que corta la pasada
+ANCHO_CABEZAL_M = 9.0
+RENDIMIENTO_MAX_T_HA = 25.0
+BINS_HISTOGRAMA_RENDIMIENTO = 2500  # 0.01 t/ha por clase
+MADS_ATIPICO = 3.5
+MIN_PUNTOS_BLOQUE_RENDIMIENTO = 30
+DIR_HISTORIAL_RENDIMIENTO = os.environ.get(
+    "YIELD_HISTORY_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'rendimiento')
+)
+
+def _lotes_rendimiento(ruta, tam=TAM_LOTE_RENDIMIENTO, crs_csv='EPSG:4326'):
     """
-    Calcula costos de producción, ingresos y ganancia por bloque y total.
+    Lee el registro de cosecha (CSV o shapefile de puntos) por lotes de `tam` filas y
+    devuelve arreglos x/y en grados más rendimiento y velocidad cuando existen.
     """
-    # Parámetros de costos por hectárea (valores aproximados en USD)
-    costos_base = {
-        'Trigo': {'semilla': 80, 'fertilizante': 150, 'herbicidas': 40, 'labranza': 60, 'siembra': 25, 'cosecha': 50, 'otros': 30},
-        'Maíz': {'semilla': 120, 'fertilizante': 200, 'herbicidas': 50, 'labranza': 70, 'siembra': 30, 'cosecha': 60, 'otros': 40},
-        'Soja': {'semilla': 100, 'fertilizante': 120, 'herbicidas': 45, 'labranza': 65, 'siembra': 28, 'cosecha': 55, 'otros': 35},
-        'Girasol': {'semilla': 90, 'fertilizante': 130, 'herbicidas': 40, 'labranza': 60, 'siembra': 25, 'cosecha': 50, 'otros': 30}
+    from pyproj import Transformer
+    def normalizar(df):
+        return df.rename(columns=lambda c: ALIAS_COLUMNAS_RENDIMIENTO.get(_normalizar_nombre_columna(c), c))
+    
+    if ruta.lower().endswith('.csv'):
+        with open(ruta, encoding='utf-8', errors='replace') as f:
+            cabecera = f.readline()
+        separador = ';' if cabecera.count(';') > cabecera.count(',') else ','
+        a_wgs84 = Transformer.from_crs(crs_csv, 'EPSG:4326', always_xy=True)
+        for lote in pd.read_csv(ruta, sep=separador, chunksize=tam, low_memory=False):
+            lote = normalizar(lote)
+            x, y = a_wgs84.transform(pd.to_numeric(lote['x'], errors='coerce').to_numpy(np.float64),
+                                     pd.to_numeric(lote['y'], errors='coerce').to_numpy(np.float64))
+            yield lote, np.asarray(x), np.asarray(y)
+    else:
+        inicio = 0
+        while True:
+            lote = gpd.read_file(ruta, rows=slice(inicio, inicio + tam))
+            if len(lote) == 0:
+                break
+            a_wgs84 = Transformer.from_crs(lote.crs or crs_csv, 'EPSG:4326', always_xy=True)
+            geoms = lote.geometry.values
+            x, y = a_wgs84.transform(shapely.get_x(geoms), shapely.get_y(geoms))
+            yield normalizar(pd.DataFrame(lote.drop(columns=lote.geometry.name))), np.asarray(x), np.asarray(y)
+            if len(lote) < tam:
+                break
+            inicio += tam
+
+def _estado_limpieza(gdf, ancho_m):
+    """Estado que los filtros arrastran entre lotes (colas de retardo, pasada actual, ocupación)."""
+    minx, miny, maxx, maxy = gdf.total_bounds
+    lat_ref = (miny + maxy) / 2
+    (x0, y0), (x1, y1) = coordenadas_locales([minx, maxx], [miny, maxy], lat_ref)
+    celda = ancho_m / 2.0  # diagonal < ancho: dos puntos en la misma celda se superponen
+    nx, ny = int((x1 - x0) // celda) + 1, int((y1 - y0) // celda) + 1
+    return {
+        'lat_ref': lat_ref, 'origen': (x0, y0), 'celda': celda, 'forma': (ny, nx),
+        'ocupacion': np.full(ny * nx, np.iinfo(np.int64).max, dtype=np.int64),
+        'cola': np.full((RETARDO_FLUJO_REGISTROS, 5), np.nan), 'ultimo': np.full(4, np.nan),
+        'rumbo': np.nan, 'pasada': 0, 'desde_inicio': 0,
+        'giro_acumulado': np.zeros(VENTANA_GIRO_REGISTROS), 'en_giro': False, 'cosechando': False,
+        'arbol': shapely.STRtree(np.asarray(gdf.geometry.values, dtype=object)),
+        'descartes': {'velocidad': 0, 'cabezal_arriba': 0, 'retardo': 0, 'inicio_pasada': 0, 'superposicion': 0,
+                      'fuera_de_rango': 0, 'fuera_de_bloques': 0, 'atipicos': 0},
     }
-    # Precio de venta por tonelada (USD)
-    precios_venta = {'Trigo': 200, 'Maíz': 180, 'Soja': 400, 'Girasol': 450}
-    # Rendimiento potencial máximo (t/ha) para cada cultivo
-    rend_max = {'Trigo': 8, 'Maíz': 12, 'Soja': 4, 'Girasol': 3.5}
-    
-    costos = costos_base[cultivo]
-    precio = precios_venta[cultivo]
-    rend_maximo = rend_max[cultivo]
-    
-    # Estimación de rendimiento basado en NDVI (lineal simple)
-    def estimar_rendimiento(ndvi):
-        if pd.isna(ndvi):
-            return 0
-        rend = max(0, (ndvi - 0.2) * (rend_maximo / 0.7))
-        return min(rend, rend_maximo)
-    
-    resultados = []
-    total_costo = 0
-    total_ingreso = 0
-    for idx, row in gdf_completo.iterrows():
-        area = row['area_ha']
-        ndvi = row.get('ndvi_modis', 0.5)
-        rend = estimar_rendimiento(ndvi)
-        produccion = rend * area
-        ingreso = produccion * precio
-        costo_total = area * sum(costos.values())
-        ganancia = ingreso - costo_total
-        resultados.append({
-            'bloque': row['id_bloque'],
-            'area_ha': area,
-            'ndvi': ndvi,
-            'rend_est (t/ha)': round(rend, 2),
-            'produccion (t)': round(produccion, 2),
-            'costo_total (USD)': round(costo_total, 2),
-            'ingreso (USD)': round(ingreso, 2),
-            'ganancia (USD)': round(ganancia, 2)
-        })
-        total_costo += costo_total
-        total_ingreso += ingreso
-    
-    df_costos = pd.DataFrame(resultados)
+
+def _limpiar_lote(lote, x, y, estado, factor_unidad=1.0):
+    """
+    Filtros vectorizados sobre un lote, en orden de registro:
+    retardo de flujo (el rendimiento del registro i corresponde a la posición i - retardo),
+    velocidad fuera de rango o con saltos bruscos, cabezal levantado, llenado al inicio de
+    cada pasada y superposición con una pasada anterior (celdas de medio ancho de cabezal ya
+    cosechadas). Una pasada nueva empieza con un giro acumulado de más de
+    GIRO_NUEVA_PASADA_GRADOS en VENTANA_GIRO_REGISTROS registros (cabecera), con un hueco de
+    posición o de tiempo, o al volver a cosechar tras baja velocidad o cabezal levantado. Devuelve (índice de bloque, rendimiento t/ha) de los
+    puntos que quedan y acumula los descartes en el estado.
+    """
+    n = len(lote)
+    descartes = estado['descartes']
+    rend = pd.to_numeric(lote['rendimiento'], errors='coerce').to_numpy(np.float64) * factor_unidad
+    if 'velocidad' in lote:
+        velocidad = pd.to_numeric(lote['velocidad'], errors='coerce').to_numpy(np.float64)
+    else:
+        velocidad = np.full(n, np.mean(VELOCIDAD_COSECHA_KMH))
+    
+    tiempo = np.full(n, np.nan)
+    if 'tiempo' in lote:
+        tiempo = pd.to_numeric(lote['tiempo'], errors='coerce').to_numpy(np.float64)
+        if np.isnan(tiempo).all():
+            marcas = pd.to_datetime(lote['tiempo'], errors='coerce')
+            tiempo = np.where(marcas.notna(), marcas.astype('int64') / 1e9, np.nan)
+    cabezal = np.ones(n)
+    if 'cabezal' in lote:
+        cabezal = pd.to_numeric(lote['cabezal'], errors='coerce').fillna(1).to_numpy(np.float64)
+    
+    # Retardo de flujo: el estado de la máquina (posición, velocidad, tiempo, cabezal) se
+    # desplaza contra el rendimiento
+    estado_maquina = np.vstack((estado['cola'], np.column_stack((x, y, velocidad, tiempo, cabezal))))
+    estado['cola'] = estado_maquina[len(estado_maquina) - RETARDO_FLUJO_REGISTROS:]
+    x, y, velocidad, tiempo, cabezal = estado_maquina[:n].T
+    valido = np.isfinite(x) & np.isfinite(y)
+    descartes['retardo'] += int((~valido).sum())
+    
+    # Velocidad y cambios bruscos respecto del registro anterior
+    previa = np.concatenate(([estado['ultimo'][2]], velocidad[:-1]))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        salto = np.abs(velocidad - previa) / np.maximum(previa, 1e-6) > CAMBIO_VELOCIDAD_MAX
+    en_rango = (velocidad >= VELOCIDAD_COSECHA_KMH[0]) & (velocidad <= VELOCIDAD_COSECHA_KMH[1])
+    malo = valido & (~en_rango | salto)
+    descartes['velocidad'] += int(malo.sum())
+    valido &= ~malo
+    levantado = valido & (cabezal == 0)
+    descartes['cabezal_arriba'] += int(levantado.sum())
+    valido &= ~levantado
+    
+    # Pasadas. El giro por registro en una cabecera es de 15-20°, así que se acumula el giro
+    # con signo en una ventana móvil y se corta en el flanco de subida del umbral
+    xy = coordenadas_locales(x, y, estado['lat_ref'])
+    ultimo = coordenadas_locales([estado['ultimo'][0]], [estado['ultimo'][1]], estado['lat_ref'])
+    delta = np.diff(np.vstack((ultimo, xy)), axis=0)
+    distancia = np.hypot(*delta.T)
+    rumbo = np.degrees(np.arctan2(delta[:, 1], delta[:, 0]))
+    # Sin desplazamiento se conserva el rumbo anterior, también el del lote previo
+    rumbo = pd.Series(np.concatenate(([estado['rumbo']], np.where(distancia > 0.1, rumbo, np.nan)))).ffill().to_numpy()[1:]
+    rumbo_previo = np.concatenate(([estado['rumbo']], rumbo[:-1]))
+    giro = np.nan_to_num((rumbo - rumbo_previo + 180.0) % 360.0 - 180.0, nan=0.0)
+    acumulado = np.concatenate((estado['giro_acumulado'], estado['giro_acumulado'][-1] + np.cumsum(giro)))
+    en_giro = np.abs(acumulado[VENTANA_GIRO_REGISTROS:] - acumulado[:n]) > GIRO_NUEVA_PASADA_GRADOS
+    cabecera = en_giro & ~np.concatenate(([estado['en_giro']], en_giro[:-1]))
+    
+    tiempo_previo = np.concatenate(([estado['ultimo'][3]], tiempo[:-1]))
+    corte = (np.nan_to_num(distancia, nan=0.0) > DISTANCIA_CORTE_PASADA_M) | \
+            (np.nan_to_num(tiempo - tiempo_previo, nan=0.0) > TIEMPO_CORTE_PASADA_S)
+    cosechando = en_rango & (cabezal != 0)
+    reanuda = cosechando & ~np.concatenate(([estado['cosechando']], cosechando[:-1]))
+    nueva = cabecera | corte | reanuda
+    
+    indices = np.arange(n)
+    ultimo_inicio = np.maximum.accumulate(np.where(nueva, indices, -1))
+    en_pasada = np.where(ultimo_inicio >= 0, indices - ultimo_inicio, estado['desde_inicio'] + indices + 1)
+    pasadas = estado['pasada'] + np.cumsum(nueva)
+    llenado = valido & (en_pasada < REGISTROS_INICIO_PASADA)
+    descartes['inicio_pasada'] += int(llenado.sum())
+    valido &= ~llenado
+    if n:
+        estado['ultimo'] = np.array([x[-1], y[-1], velocidad[-1], tiempo[-1]])
+        estado['rumbo'] = rumbo[-1] if np.isfinite(rumbo[-1]) else estado['rumbo']
+        estado['giro_acumulado'] = acumulado[-VENTANA_GIRO_REGISTROS:] - acumulado[-1]
+        estado['en_giro'] = bool(en_giro[-1])
+        estado['cosechando'] = bool(cosechando[-1])
+        estado['pasada'] = int(pasadas[-1])
+        estado['desde_inicio'] = int(en_pasada[-1])
+    
+    # Rango físico del rendimiento
+    fuera = valido & ~((rend > 0) & (rend <= RENDIMIENTO_MAX_T_HA))
+    descartes['fuera_de_rango'] += int(fuera.sum())
+    valido &= ~fuera
+    
+    # Superposición: cada celda queda para la primera pasada que la cruzó
+    ny, nx = estado['forma']
+    columnas = np.floor((xy[:, 0] - estado['origen'][0]) / estado['celda'])
+    filas = np.floor((xy[:, 1] - estado['origen'][1]) / estado['celda'])
+    en_grilla = valido & (columnas >= 0) & (columnas < nx) & (filas >= 0) & (filas < ny)
+    descartes['fuera_de_bloques'] += int((valido & ~en_grilla).sum())
+    valido = en_grilla
+    celdas = (filas[valido] * nx + columnas[valido]).astype(np.int64)
+    np.minimum.at(estado['ocupacion'], celdas, pasadas[valido])
+    propia = estado['ocupacion'][celdas] == pasadas[valido]
+    descartes['superposicion'] += int((~propia).sum())
+    seleccion = np.flatnonzero(valido)[propia]
+    
+    # Un punto sobre el borde compartido de dos bloques cuenta solo para el de menor índice
+    idx_punto, idx_bloque = estado['arbol'].query(shapely.points(x[seleccion], y[seleccion]), predicate='intersects')
+    orden = np.lexsort((idx_bloque, idx_punto))
+    idx_punto, idx_bloque = idx_punto[orden], idx_bloque[orden]
+    idx_punto, primero = np.unique(idx_punto, return_index=True)
+    descartes['fuera_de_bloques'] += len(seleccion) - len(idx_punto)
+    return idx_bloque[primero], rend[seleccion][idx_punto]
+
+def _limites_histograma(histograma, ancho_clase):
+    """Mediana y MAD a partir del histograma acumulado (sin guardar los puntos)."""
+    centros = (np.arange(len(histograma)) + 0.5) * ancho_clase
+    acumulado = np.cumsum(histograma)
+    mediana = centros[np.searchsorted(acumulado, acumulado[-1] / 2.0)]
+    desvios = np.abs(centros - mediana)
+    orden = np.argsort(desvios)
+    mad = desvios[orden][np.searchsorted(np.cumsum(histograma[orden]), acumulado[-1] / 2.0)]
+    return mediana, max(mad, ancho_clase)
+
+def procesar_rendimiento(ruta, gdf, factor_unidad=1.0, ancho_m=ANCHO_CABEZAL_M, crs_csv='EPSG:4326',
+                         tam=TAM_LOTE_RENDIMIENTO):
+    """
+    Limpia un registro de cosecha leyéndolo en dos pasadas por lotes (memoria acotada por
+    `tam`): la primera arma el histograma global de rendimientos limpios para
+    fijar mediana y MAD; la segunda descarta atípicos (más de MADS_ATIPICO MAD) y agrega por
+    bloque con np.bincount. Devuelve un DataFrame alineado con gdf (rend_medio, rend_desvio,
+    puntos) con el resumen de descartes en attrs['resumen'].
+    """
+    ancho_clase = RENDIMIENTO_MAX_T_HA / BINS_HISTOGRAMA_RENDIMIENTO
+    histograma = np.zeros(BINS_HISTOGRAMA_RENDIMIENTO)
+    estado = _estado_limpieza(gdf, ancho_m)
+    for lote, x, y in _lotes_rendimiento(ruta, tam, crs_csv):
+        _, rend = _limpiar_lote(lote, x, y, estado, factor_unidad)
+        clases = np.minimum((rend / ancho_clase).astype(np.int64), BINS_HISTOGRAMA_RENDIMIENTO - 1)
+        histograma += np.bincount(clases, minlength=BINS_HISTOGRAMA_RENDIMIENTO)
+    if histograma.sum() == 0:
+        return None
+    mediana, mad = _limites_histograma(histograma, ancho_clase)
+    limite = MADS_ATIPICO * 1.4826 * mad
+    
+    estado = _estado_limpieza(gdf, ancho_m)
+    acumulado, leidos = None, 0
+    for lote, x, y in _lotes_rendimiento(ruta, tam, crs_csv):
+        leidos += len(lote)
+        bloques, rend = _limpiar_lote(lote, x, y, estado, factor_unidad)
+        atipico = np.abs(rend - mediana) > limite
+        estado['descartes']['atipicos'] += int(atipico.sum())
+        acumulado = acumular_zonal(acumulado, rend[~atipico], bloques[~atipico], len(gdf))
+    estadisticas = finalizar_zonal(acumulado)
+    resultado = pd.DataFrame({
+        'rend_medio': np.round(estadisticas['media'], 3),
+        'rend_desvio': np.round(estadisticas['desvio'], 3),
+        'puntos': estadisticas['celdas'],
+    }, index=gdf.index)
+    resultado.attrs['resumen'] = {'leidos': leidos, 'validos': int(estadisticas['celdas'].sum()),
+                                  'pasadas': estado['pasada'], 'mediana_t_ha': round(float(mediana), 2),
+                                  **estado['descartes']}
+    return resultado
+
+def procesar_archivo_rendimiento(uploaded_file, gdf, unidad='t/ha', ancho_m=ANCHO_CABEZAL_M, crs_csv='EPSG:4326'):
+    """Copia el archivo subido a disco por bloques (CSV o ZIP con shapefile) y lo procesa."""
+    try:
+        uploaded_file.seek(0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ext = os.path.splitext(uploaded_file.name)[1].lower()
+            ruta = os.path.join(tmp_dir, f"registro{ext}")
+            with open(ruta, 'wb') as destino:
+                shutil.copyfileobj(uploaded_file, destino, 1 << 20)
+            if ext == '.zip':
+                with zipfile.ZipFile(ruta) as zf:
+                    zf.extractall(tmp_dir)
+                shp = [os.path.join(r, f) for r, _, fs in os.walk(tmp_dir) for f in fs if f.lower().endswith('.shp')]
+                if not shp:
+                    st.error("❌ No se encontró archivo .shp dentro del ZIP")
+                    return None
+                ruta = shp[0]
+            elif ext != '.csv':
+                st.error(f"❌ Formato no soportado: {ext}. Use .csv o .zip (shapefile)")
+                return None
+            resultado = procesar_rendimiento(ruta, gdf, UNIDADES_RENDIMIENTO[unidad], ancho_m, crs_csv)
+        if resultado is None:
+            st.warning("Ningún registro de rendimiento pasó los filtros dentro de la parcela.")
+        return resultado
+    except Exception as e:
+        st.error(f"❌ Error al procesar el registro de cosecha: {str(e)[:200]}")
+        return None
+
+def ruta_historial_rendimiento(gdf):
+    return os.path.join(DIR_HISTORIAL_RENDIMIENTO, f"{hash_gdf(gdf[[gdf.geometry.name]])[:20]}.csv")
+
+def cargar_historial_rendimiento(gdf, cultivo=None):
+    """
+    Historial por bloque, campaña y cultivo (formato largo) guardado para esta división de la
+    parcela. Con `cultivo`, solo las campañas de ese cultivo.
+    """
+    ruta = ruta_historial_rendimiento(gdf)
+    if not os.path.exists(ruta):
+        return None
+    historial = pd.read_csv(ruta, dtype={'campana': str, 'cultivo': str})
+    if 'cultivo' not in historial.columns:
+        historial['cultivo'] = None  # historiales previos, sin cultivo: no se ofrecen para calibrar
+    if cultivo is not None:
+        historial = historial[historial['cultivo'] == cultivo]
+    return historial
+
+def guardar_historial_rendimiento(gdf, campana, cultivo, por_bloque):
+    """Agrega (o reemplaza) la campaña de un cultivo en el historial de rendimiento de la parcela."""
+    nuevo = por_bloque.assign(campana=str(campana), cultivo=cultivo, id_bloque=gdf['id_bloque'].values)
+    nuevo = nuevo[['campana', 'cultivo', 'id_bloque', 'rend_medio', 'rend_desvio', 'puntos']]
+    historial = cargar_historial_rendimiento(gdf)
+    if historial is not None:
+        misma = (historial['campana'] == str(campana)) & (historial['cultivo'] == cultivo)
+        nuevo = pd.concat([historial[~misma], nuevo], ignore_index=True)
+    ruta = ruta_historial_rendimiento(gdf)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    nuevo.to_csv(ruta, index=False)
+    return nuevo
+
+def calibrar_rendimiento(ndvi, rend_medio, puntos, min_puntos=MIN_PUNTOS_BLOQUE_RENDIMIENTO):
+    """
+    Recta rendimiento ~ NDVI ajustada con las medias de monitor de los bloques con datos
+    suficientes (ponderadas por raíz de la cantidad de puntos). None si hay menos de 3 bloques.
+    """
+    usar = np.isfinite(ndvi) & np.isfinite(rend_medio) & (puntos >= min_puntos)
+    if usar.sum() < 3 or np.ptp(ndvi[usar]) == 0:
+        return None
+    pendiente, ordenada = np.polyfit(ndvi[usar], rend_medio[usar], 1, w=np.sqrt(puntos[usar]))
+    return pendiente, ordenada
+
+def estimar_rendimiento(gdf, rend_maximo, medido=None):
+    """
+    Rendimiento por bloque (t/ha). Sin datos de cosecha es lineal en NDVI (0 en 0.2, máximo
+    en 0.9). Con `medido` (salida de procesar_rendimiento o una campaña del historial), los
+    bloques con suficientes puntos usan su media de monitor y el resto la recta NDVI calibrada
+    con esas medias.
+    """
+    ndvi = gdf['ndvi_modis'].to_numpy(dtype=np.float64) if 'ndvi_modis' in gdf.columns else np.full(len(gdf), 0.5)
+    rend = np.clip((ndvi - 0.2) * (rend_maximo / 0.7), 0, rend_maximo)
+    if medido is not None:
+        rend_medio = medido['rend_medio'].to_numpy(dtype=np.float64)
+        puntos = medido['puntos'].to_numpy()
+        calibracion = calibrar_rendimiento(ndvi, rend_medio, puntos)
+        if calibracion is not None:
+            rend = np.clip(calibracion[0] * ndvi + calibracion[1], 0, None)
+        suficientes = (puntos >= MIN_PUNTOS_BLOQUE_RENDIMIENTO) & np.isfinite(rend_medio)
+        rend = np.where(suficientes, rend_medio, rend)
+    return np.nan_to_num(rend, nan=0.0)
+
+# ===== FUNCIÓN DE ANÁLISIS DE COSTOS =====
+# Parámetros de costos por hectárea (valores aproximados en USD)
+COSTOS_BASE = {
+    'Trigo': {'semilla': 80, 'fertilizante': 150, 'herbicidas': 40, 'labranza': 60, 'siembra': 25, 'cosecha': 50, 'otros': 30},
+    'Maíz': {'semilla': 120, 'fertilizante': 200, 'herbicidas': 50, 'labranza': 70, 'siembra': 30, 'cosecha': 60, 'otros': 40},
+    'Soja': {'semilla': 100, 'fertilizante': 120, 'herbicidas': 45, 'labranza': 65, 'siembra': 28, 'cosecha': 55, 'otros': 35},
+    'Girasol': {'semilla': 90, 'fertilizante': 130, 'herbicidas': 40, 'labranza': 60, 'siembra': 25, 'cosecha': 50, 'otros': 30}
+}
+# Precio de venta por tonelada (USD)
+PRECIOS_VENTA = {'Trigo': 200, 'Maíz': 180, 'Soja': 400, 'Girasol': 450}
+# Rendimiento potencial máximo (t/ha) para cada cultivo
+REND_MAX = {'Trigo': 8.0, 'Maíz': 12.0, 'Soja': 4.0, 'Girasol': 3.5}
+# Incertidumbre (coeficiente de variación) de las simulaciones Monte Carlo
+CV_RENDIMIENTO = 0.15   # por bloque e independiente entre bloques
+CV_PRECIO = 0.12        # común a todo el campo en cada simulación
+CV_COSTO = 0.06
+N_SIMULACIONES = 10000
+MAX_ELEMENTOS_SIMULACION = 10_000_000   # bloques x simulaciones evaluados por lote
+PERCENTILES_RIESGO = (10, 50, 90)
+
+def calcular_costos(gdf_completo, cultivo, medido=None, costos=None, precio=None, rend_maximo=None):
+    """
+    Calcula costos de producción, ingresos y ganancia por bloque y total, en columnas.
+    Con `medido` (rendimiento de monitor por bloque) el rendimiento sale de la cosecha calibrada.
+    `costos`, `precio` y `rend_maximo` reemplazan a los valores por defecto del cultivo.
+    """
+    costos = costos if costos is not None else COSTOS_BASE[cultivo]
+    precio = precio if precio is not None else PRECIOS_VENTA[cultivo]
+    rend_maximo = rend_maximo if rend_maximo is not None else REND_MAX[cultivo]
+    
+    area = gdf_completo['area_ha'].to_numpy(dtype=np.float64)
+    rend = estimar_rendimiento(gdf_completo, rend_maximo, medido)
+    produccion = rend * area
+    ingreso = produccion * precio
+    costo_total = area * sum(costos.values())
+    ndvi = gdf_completo['ndvi_modis'] if 'ndvi_modis' in gdf_completo.columns else pd.Series(0.5, index=gdf_completo.index)
+    df_costos = pd.DataFrame({
+        'bloque': gdf_completo['id_bloque'].values,
+        'area_ha': area,
+        'ndvi': np.round(ndvi.to_numpy(dtype=np.float64), 3),
+        'rend_est (t/ha)': np.round(rend, 2),
+        'rend_equilibrio (t/ha)': round(sum(costos.values()) / precio, 2) if precio else np.nan,
+        'produccion (t)': np.round(produccion, 2),
+        'costo_total (USD)': np.round(costo_total, 2),
+        'ingreso (USD)': np.round(ingreso, 2),
+        'ganancia (USD)': np.round(ingreso - costo_total, 2)
+    })
+    total_costo, total_ingreso = float(costo_total.sum()), float(ingreso.sum())
     return df_costos, total_costo, total_ingreso, total_ingreso - total_costo
 
+def matriz_escenarios(rend, area, precios, costos_ha):
+    """
+    Ganancia (USD) de bloques x escenarios de precio x escenarios de costo por broadcasting.
+    Devuelve el arreglo (bloques, precios, costos); sumar el eje 0 da el total del campo.
+    """
+    rend, area = np.asarray(rend, dtype=np.float64), np.asarray(area, dtype=np.float64)
+    precios, costos_ha = np.asarray(precios, dtype=np.float64), np.asarray(costos_ha, dtype=np.float64)
+    return area[:, None, None] * (rend[:, None, None] * precios[None, :, None] - costos_ha[None, None, :])
+
+def simular_ganancias(gdf, rend, precio, costo_ha, n=N_SIMULACIONES, cv_rend=CV_RENDIMIENTO,
+                      cv_precio=CV_PRECIO, cv_costo=CV_COSTO, semilla=0, max_elementos=MAX_ELEMENTOS_SIMULACION):
+    """
+    Monte Carlo de la ganancia por bloque. Precio y costo se sortean una vez por simulación
+    (son comunes a todo el campo); el rendimiento se sortea por bloque con
+    uniformes_por_bloque, así que cada bloque ve siempre los mismos sorteos. Los bloques se
+    procesan en lotes de max_elementos // n para acotar la memoria.
+    Devuelve (DataFrame por bloque con P10/P50/P90, media y probabilidad de pérdida en USD/ha,
+    arreglo (n,) de la ganancia total del campo por simulación).
+    """
+    from scipy.special import ndtri
+    rend = np.asarray(rend, dtype=np.float64)
+    area = gdf['area_ha'].to_numpy(dtype=np.float64)
+    rng = np.random.default_rng(semilla)
+    factor_precio = np.clip(1.0 + cv_precio * rng.standard_normal(n), 0.0, None)
+    factor_costo = np.clip(1.0 + cv_costo * rng.standard_normal(n), 0.0, None)
+    precios, costos = precio * factor_precio, costo_ha * factor_costo
+    claves = claves_bloques(gdf)
+    
+    tam = max(1, max_elementos // n)
+    percentiles = np.empty((len(rend), len(PERCENTILES_RIESGO)))
+    media = np.empty(len(rend))
+    prob_perdida = np.empty(len(rend))
+    total = np.zeros(n)
+    for ini in range(0, len(rend), tam):
+        fin = min(ini + tam, len(rend))
+        u = uniformes_por_bloque(claves[ini:fin], n, flujo=3)
+        np.clip(u, 1e-12, 1.0 - 1e-12, out=u)
+        rend_sim = np.clip(rend[ini:fin, None] * (1.0 + cv_rend * ndtri(u)), 0.0, None)
+        ganancia_ha = rend_sim * precios[None, :] - costos[None, :]
+        percentiles[ini:fin] = np.percentile(ganancia_ha, PERCENTILES_RIESGO, axis=1).T
+        media[ini:fin] = ganancia_ha.mean(axis=1)
+        prob_perdida[ini:fin] = (ganancia_ha < 0).mean(axis=1)
+        total += area[ini:fin] @ ganancia_ha
+    
+    por_bloque = pd.DataFrame({
+        'bloque': gdf['id_bloque'].values,
+        **{f'P{p} (USD/ha)': np.round(percentiles[:, i], 1) for i, p in enumerate(PERCENTILES_RIESGO)},
+        'media (USD/ha)': np.round(media, 1),
+        'prob_perdida': np.round(prob_perdida, 3),
+    }, index=gdf.index)
+    return por_bloque, total
+
+def metricas_riesgo(total):
+    """Percentiles, probabilidad de pérdida y CVaR (media del peor 10 %) de la ganancia total."""
+    p = np.percentile(total, PERCENTILES_RIESGO)
+    peor = np.sort(total)[:max(1, len(total) // 10)]
+    return {**{f'P{q}': float(v) for q, v in zip(PERCENTILES_RIESGO, p)},
+            'prob_perdida': float((total < 0).mean()), 'CVaR10': float(peor.mean())}
+
+COLORES_CULTIVOS = {'Trigo': '#e6c229', 'Maíz': '#f17105', 'Soja': '#6a994e', 'Girasol': '#bc4749'}
+
+def comparar_cultivos(gdf, cultivos=CULTIVOS, parametros=None, medido=None, cultivo_medido=None):
+    """
+    Evalúa todos los cultivos contra los mismos bloques en una sola pasada: matrices
+    cultivo x bloque de rendimiento y ganancia (USD/ha) por broadcasting, sin volver a
+    consultar datos satelitales ni climáticos. `parametros` puede reemplazar
+    {'costos', 'precio', 'rend_maximo'} de algún cultivo; el rendimiento de monitor
+    (`medido`) solo se aplica a `cultivo_medido`.
+    Devuelve (DataFrame por bloque con la ganancia de cada cultivo y el recomendado,
+    DataFrame por cultivo con totales y rendimiento de equilibrio).
+    """
+    parametros = parametros or {}
+    cultivos = list(cultivos)
+    costo_ha = np.array([sum(parametros.get(c, {}).get('costos', COSTOS_BASE[c]).values()) for c in cultivos], dtype=np.float64)
+    precio = np.array([parametros.get(c, {}).get('precio', PRECIOS_VENTA[c]) for c in cultivos], dtype=np.float64)
+    rend_maximo = np.array([parametros.get(c, {}).get('rend_maximo', REND_MAX[c]) for c in cultivos], dtype=np.float64)
+    
+    # estimar_rendimiento es lineal en rend_maximo: una fracción por bloque escala a todos los cultivos
+    fraccion = estimar_rendimiento(gdf, 1.0)
+    rend = rend_maximo[:, None] * fraccion[None, :]
+    if medido is not None and cultivo_medido in cultivos:
+        i = cultivos.index(cultivo_medido)
+        rend[i] = estimar_rendimiento(gdf, rend_maximo[i], medido)
+    ganancia_ha = rend * precio[:, None] - costo_ha[:, None]
+    area = gdf['area_ha'].to_numpy(dtype=np.float64)
+    
+    mejor = np.argmax(ganancia_ha, axis=0)
+    por_bloque = pd.DataFrame({c: np.round(ganancia_ha[i], 1) for i, c in enumerate(cultivos)}, index=gdf.index)
+    por_bloque.insert(0, 'bloque', gdf['id_bloque'].values)
+    por_bloque['cultivo_recomendado'] = np.array(cultivos, dtype=object)[mejor]
+    por_bloque['ganancia_recomendada (USD/ha)'] = np.round(ganancia_ha[mejor, np.arange(len(mejor))], 1)
+    
+    total = ganancia_ha @ area
+    por_cultivo = pd.DataFrame({
+        'rend_medio (t/ha)': np.round(rend @ area / max(area.sum(), 1e-9), 2),
+        'rend_equilibrio (t/ha)': np.round(costo_ha / precio, 2),
+        'ganancia_total (USD)': np.round(total, 0),
+        'ganancia (USD/ha)': np.round(total / max(area.sum(), 1e-9), 1),
+        'bloques_recomendados': np.bincount(mejor, minlength=len(cultivos)),
+    }, index=pd.Index(cultivos, name='cultivo'))
+    return por_bloque, por_cultivo
+
+def mapa_cultivo_recomendado(gdf, por_bloque):
+    """Mapa de bloques coloreados por cultivo recomendado; bloques vecinos iguales se funden en zonas."""
+    zonas = gpd.GeoDataFrame({'cultivo_recomendado': por_bloque['cultivo_recomendado'].values},
+                             geometry=gdf.geometry.values, crs=gdf.crs).dissolve(by='cultivo_recomendado', as_index=False)
+    centro = gdf.geometry.unary_union.centroid
+    m = folium.Map(location=[centro.y, centro.x], zoom_start=15, tiles=None)
+    folium.TileLayer('https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+                     attr='Esri', name='Satélite').add_to(m)
+    def style_func(feature):
+        return {'fillColor': COLORES_CULTIVOS.get(feature['properties']['cultivo_recomendado'], '#888'),
+                'color': 'black', 'weight': 1, 'fillOpacity': 0.6}
+    capa_vectorial_compacta(zonas, 'Cultivo recomendado', style_func,
+                            tooltip_fields=['cultivo_recomendado'], tooltip_aliases=['Cultivo recomendado']).add_to(m)
+    folium.LayerControl().add_to(m)
+    return m
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _simulacion_cacheada(clave, _gdf, _rend, precio, costo_ha, n, cv_rend, cv_precio, cv_costo):
+    return simular_ganancias(_gdf, _rend, precio, costo_ha, n, cv_rend, cv_precio, cv_costo)
+
+def simulacion_economica(gdf, rend, precio, costo_ha, n=N_SIMULACIONES, cv_rend=CV_RENDIMIENTO,
+                         cv_precio=CV_PRECIO, cv_costo=CV_COSTO):
+    """simular_ganancias cacheada por bloques, rendimientos y parámetros."""
+    h = hashlib.sha1(hash_gdf(gdf[[gdf.geometry.name, 'id_bloque', 'area_ha']]).encode())
+    h.update(np.ascontiguousarray(rend, dtype=np.float64).tobytes())
+    clave = h.hexdigest()
+    return _simulacion_cacheada(clave, gdf, rend, float(precio), float(costo_ha), int(n),
+                                float(cv_rend), float(cv_precio), float(cv_costo))
+
 # ===== Mostrar advertencias de librerías opcionales =====
 if not EARTHDATA_OK:
     st.warning("Para usar datos satelitales reales, instala 'earthaccess', 'xarray' y 'rioxarray': pip install earthaccess xarray rioxarray")
@@ -2535,6 +5158,24 @@ with st.sidebar:
     if analisis_suelo:
         st.info("Incluye: Textura por bloque, fertilidad NPK, recomendaciones")
     st.session_state.analisis_suelo = analisis_suelo
+    if analisis_suelo:
+        archivo_muestras = st.file_uploader(
+            "Resultados de laboratorio (opcional)",
+            type=['csv', 'gpkg', 'geojson'],
+            help="Puntos con N, P, K, pH y/o MO. CSV con columnas lon/lat (o x/y en el CRS indicado).",
+            key="muestras_uploader"
+        )
+        if archivo_muestras is not None:
+            crs_muestras = st.text_input("CRS de las coordenadas del CSV", "EPSG:4326", key="crs_muestras")
+            if st.button("🧫 Cargar muestras", key="cargar_muestras_btn"):
+                st.session_state.muestras_laboratorio = cargar_muestras_laboratorio(archivo_muestras, crs_muestras)
+        muestras = st.session_state.get('muestras_laboratorio')
+        if muestras is not None:
+            resumen = muestras.attrs.get('validacion', {})
+            st.caption(f"{resumen.get('validas', len(muestras))} muestras válidas de {resumen.get('filas', len(muestras))} filas")
+            if st.button("Quitar muestras", key="quitar_muestras_btn"):
+                st.session_state.muestras_laboratorio = None
+                st.rerun()
     st.markdown("---")
     
     # === SECCIÓN DE CARGA DE POLÍGONO ===
@@ -2592,7 +5233,7 @@ if st.session_state.archivo_cargado and st.session_state.gdf_original is not Non
             m_preview = folium.Map(location=[gdf.geometry.centroid.y.iloc[0], gdf.geometry.centroid.x.iloc[0]], zoom_start=15, tiles=None)
             folium.TileLayer('https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
                              attr='Esri', name='Satélite').add_to(m_preview)
-            folium.GeoJson(gdf.to_json(), style_function=lambda x: {'fillColor': '#3388ff', 'color': 'black', 'weight': 2, 'fillOpacity': 0.4}).add_to(m_preview)
+            folium.GeoJson(geojson_compacto(gdf, [], zoom=ZOOM_DETALLE_MAPA), style_function=lambda x: {'fillColor': '#3388ff', 'color': 'black', 'weight': 2, 'fillOpacity': 0.4}).add_to(m_preview)
             folium.LayerControl().add_to(m_preview)
             folium_static(m_preview, width=500, height=300)
         except Exception as e:
@@ -2747,16 +5388,15 @@ if st.session_state.analisis_completado:
             st.markdown("### 🌍 Mapa Interactivo")
             try:
                 colormap_ndvi = LinearColormap(colors=['red','yellow','green'], vmin=0.3, vmax=0.9)
-                mapa_interactivo = crear_mapa_interactivo_base(
+                mapa_ok = mostrar_mapa_cacheado(
+                    crear_mapa_interactivo_base,
                     gdf_completo,
                     columna_color='ndvi_modis',
                     colormap=colormap_ndvi,
                     tooltip_fields=['id_bloque','ndvi_modis','salud'],
                     tooltip_aliases=['Bloque','NDVI','Salud']
                 )
-                if mapa_interactivo:
-                    folium_static(mapa_interactivo, width=1000, height=600)
-                else:
+                if not mapa_ok:
                     st.warning("No se pudo generar el mapa interactivo")
             except Exception as e:
                 st.error(f"Error al mostrar mapa interactivo: {str(e)[:100]}")
@@ -2764,10 +5404,16 @@ if st.session_state.analisis_completado:
         with tab3:
             st.subheader("🛰️ ÍNDICES DE VEGETACIÓN")
             st.caption(f"Fuente: {st.session_state.datos_modis.get('fuente', 'Earthdata')}")
+            metodo_interpolacion = st.radio(
+                "Método de interpolación:", list(METODOS_MAPA_CALOR.keys()), horizontal=True,
+                key="metodo_interpolacion",
+                help="El kriging agrega una capa con la varianza de predicción, útil para decidir dónde muestrear."
+            )
             
             st.markdown("### 🌿 NDVI")
             if 'ndvi_modis' in gdf_completo.columns:
-                mostrar_estadisticas_indice(gdf_completo, 'ndvi_modis', 'NDVI', 0.3, 0.9, ['red','yellow','green'])
+                mostrar_estadisticas_indice(gdf_completo, 'ndvi_modis', 'NDVI', 0.3, 0.9, ['red','yellow','green'],
+                                            metodo_interpolacion)
             else:
                 st.error("No hay datos de NDVI disponibles.")
             
@@ -2775,7 +5421,8 @@ if st.session_state.analisis_completado:
             st.markdown("### 💧 NDWI")
             st.info("NDWI calculado como (NIR - SWIR)/(NIR+SWIR) con bandas de MODIS (producto MOD09GA).")
             if 'ndwi_modis' in gdf_completo.columns:
-                mostrar_estadisticas_indice(gdf_completo, 'ndwi_modis', 'NDWI', 0.1, 0.7, ['brown','yellow','blue'])
+                mostrar_estadisticas_indice(gdf_completo, 'ndwi_modis', 'NDWI', 0.1, 0.7, ['brown','yellow','blue'],
+                                            metodo_interpolacion)
             else:
                 st.error("No hay datos de NDWI disponibles.")
             
@@ -2786,7 +5433,7 @@ if st.session_state.analisis_completado:
             try:
                 gdf_indices = gdf_completo[['id_bloque','ndvi_modis','ndwi_modis','salud','geometry']].copy()
                 gdf_indices.columns = ['id_bloque','NDVI','NDWI','Salud','geometry']
-                geojson_indices = gdf_indices.to_json()
+                geojson_indices = json.dumps(geojson_compacto(gdf_indices), separators=(',', ':'))
                 csv_indices = gdf_indices.drop(columns='geometry').to_csv(index=False)
                 col_dl1, col_dl2 = st.columns(2)
                 with col_dl1: st.download_button("🗺️ GeoJSON", geojson_indices, f"indices_{datetime.now():%Y%m%d}.geojson", "application/geo+json")
@@ -2806,8 +5453,10 @@ if st.session_state.analisis_completado:
                 st.markdown("### 📈 GRÁFICOS CLIMÁTICOS COMPLETOS")
                 try:
                     fig_clima = crear_graficos_climaticos_completos(datos_climaticos)
-                    st.pyplot(fig_clima)
-                    plt.close(fig_clima)
+                    if fig_clima is not None:
+                        st.plotly_chart(fig_clima, use_container_width=True, key="graficos_clima")
+                    else:
+                        st.warning("No hay datos climáticos suficientes para graficar.")
                 except Exception as e:
                     st.error(f"Error al mostrar gráficos climáticos: {str(e)[:100]}")
                 st.markdown("### 📋 INFORMACIÓN ADICIONAL")
@@ -2820,17 +5469,28 @@ if st.session_state.analisis_completado:
         with tab5:  # Fertilidad NPK
             st.subheader("🧪 FERTILIDAD DEL SUELO Y RECOMENDACIONES NPK")
             st.caption("Basado en NDVI real y modelos de fertilidad típicos para cultivos extensivos.")
-            datos_fertilidad = st.session_state.datos_fertilidad
-            if datos_fertilidad:
-                df_fertilidad = pd.DataFrame(datos_fertilidad)
-                gdf_fertilidad = gpd.GeoDataFrame(df_fertilidad, geometry='geometria', crs='EPSG:4326')
+            df_fertilidad = st.session_state.datos_fertilidad
+            if df_fertilidad is not None and len(df_fertilidad) and 'N_kg_ha' in gdf_completo.columns:
+                # Las columnas de fertilidad ya están unidas a gdf_completo; solo se recalculan
+                # las dosis si el cultivo cambió después del análisis
+                gdf_fertilidad = gdf_completo
+                cultivo_fert = st.session_state.cultivo_seleccionado
+                if df_fertilidad.attrs.get('cultivo') != cultivo_fert:
+                    dosis = recomendaciones_fertilizacion(gdf_completo, cultivo_fert)
+                    gdf_fertilidad = gdf_completo.assign(**{c: dosis[c] for c in dosis.columns})
+                st.caption(f"Dosis calculadas para {cultivo_fert}.")
+                validacion_loo = st.session_state.get('validacion_muestras')
+                if validacion_loo is not None and len(validacion_loo):
+                    st.caption("Valores medidos en laboratorio interpolados a los bloques (IDW). "
+                               "Validación cruzada dejando uno afuera:")
+                    st.dataframe(validacion_loo.round(3), use_container_width=True)
                 
                 col1, col2, col3, col4, col5 = st.columns(5)
-                with col1: N_prom = df_fertilidad['N_kg_ha'].mean(); st.metric("Nitrógeno (N)", f"{N_prom:.0f} kg/ha")
-                with col2: P_prom = df_fertilidad['P_kg_ha'].mean(); st.metric("Fósforo (P₂O₅)", f"{P_prom:.0f} kg/ha")
-                with col3: K_prom = df_fertilidad['K_kg_ha'].mean(); st.metric("Potasio (K₂O)", f"{K_prom:.0f} kg/ha")
-                with col4: pH_prom = df_fertilidad['pH'].mean(); st.metric("pH", f"{pH_prom:.2f}")
-                with col5: MO_prom = df_fertilidad['MO_porcentaje'].mean(); st.metric("Materia Orgánica", f"{MO_prom:.1f}%")
+                with col1: N_prom = gdf_fertilidad['N_kg_ha'].mean(); st.metric("Nitrógeno (N)", f"{N_prom:.0f} kg/ha")
+                with col2: P_prom = gdf_fertilidad['P_kg_ha'].mean(); st.metric("Fósforo (P₂O₅)", f"{P_prom:.0f} kg/ha")
+                with col3: K_prom = gdf_fertilidad['K_kg_ha'].mean(); st.metric("Potasio (K₂O)", f"{K_prom:.0f} kg/ha")
+                with col4: pH_prom = gdf_fertilidad['pH'].mean(); st.metric("pH", f"{pH_prom:.2f}")
+                with col5: MO_prom = gdf_fertilidad['MO_porcentaje'].mean(); st.metric("Materia Orgánica", f"{MO_prom:.1f}%")
                 
                 st.markdown("---")
                 st.markdown("### 🗺️ MAPA INTERACTIVO DE NUTRIENTES (Esri Satélite)")
@@ -2847,33 +5507,93 @@ if st.session_state.analisis_completado:
                     }[x]
                 )
                 
-                mapa_fertilidad = crear_mapa_fertilidad_interactivo(gdf_fertilidad, variable)
-                if mapa_fertilidad:
-                    folium_static(mapa_fertilidad, width=1000, height=600)
+                vista_fertilidad = st.radio("Vista:", ["Bloques", "Mapa de calor"], horizontal=True, key="vista_fertilidad")
+                if vista_fertilidad == "Mapa de calor":
+                    info_var = info_variable_fertilidad(gdf_fertilidad, variable)
+                    mapa_ok = mostrar_mapa_cacheado(
+                        crear_mapa_calor_indice_rbf,
+                        gdf_fertilidad, variable, f"{info_var['titulo']} ({info_var['unidad']})",
+                        info_var['vmin'], info_var['vmax'], info_var['colores']
+                    )
                 else:
+                    mapa_ok = mostrar_mapa_cacheado(crear_mapa_fertilidad_interactivo, gdf_fertilidad, variable)
+                if not mapa_ok:
                     st.warning("No se pudo generar el mapa de fertilidad.")
                 
                 st.markdown("### 📋 RECOMENDACIONES DETALLADAS POR BLOQUE")
-                df_recom = df_fertilidad[['id_bloque', 'N_kg_ha', 'P_kg_ha', 'K_kg_ha', 'pH', 
-                                          'recomendacion_N', 'recomendacion_P', 'recomendacion_K']].copy()
-                df_recom.columns = ['Bloque', 'N', 'P₂O₅', 'K₂O', 'pH', 'Recomendación N', 'Recomendación P', 'Recomendación K']
+                df_recom = gdf_fertilidad[['id_bloque', 'N_kg_ha', 'P_kg_ha', 'K_kg_ha', 'pH', 'codigo_recomendacion',
+                                           'urea_kg_ha', 'DAP_kg_ha', 'KCl_kg_ha']].copy()
+                df_recom.columns = ['Bloque', 'N', 'P₂O₅', 'K₂O', 'pH', 'Aplicar', 'Urea (kg/ha)', 'DAP (kg/ha)', 'KCl (kg/ha)']
                 st.dataframe(df_recom.head(15), use_container_width=True)
                 
+                st.markdown("### 📅 VENTANAS DE APLICACIÓN DE NITRÓGENO (PRONÓSTICO)")
+                st.caption("Pronóstico horario Open-Meteo. Se descarga una vez por corrida de modelo y celda de ~10 km; "
+                           "el puntaje combina viento, temperatura y lluvia de incorporación (0 = no apto, 1 = ideal).")
+                dias_pronostico = st.slider("Días de pronóstico", 3, 16, 7, key="dias_pronostico")
+                if st.checkbox("Consultar pronóstico y calcular ventanas", key="ver_pronostico"):
+                    if st.session_state.demo_mode:
+                        pronostico = generar_pronostico_simulado(len(gdf_completo), dias_pronostico)
+                    else:
+                        pronostico = obtener_pronostico_bloques(gdf_completo, dias_pronostico)
+                    if pronostico is not None:
+                        puntaje = calcular_ventanas_aplicacion(pronostico)
+                        df_ventanas = resumir_ventanas_diarias(pronostico, puntaje, gdf_completo['id_bloque'].values)
+                        if len(df_ventanas) > 0:
+                            st.caption(f"Fuente: {pronostico['fuente']}")
+                            matriz_ventanas = df_ventanas.pivot(index='id_bloque', columns='fecha', values='puntaje')
+                            fig_ventanas = px.imshow(
+                                matriz_ventanas.values, x=[str(f) for f in matriz_ventanas.columns],
+                                y=matriz_ventanas.index.astype(str), zmin=0, zmax=1,
+                                color_continuous_scale='RdYlGn', aspect='auto',
+                                labels={'x': 'Día', 'y': 'Bloque', 'color': 'Puntaje'},
+                                title='Aptitud diaria para aplicar N por bloque'
+                            )
+                            st.plotly_chart(fig_ventanas, use_container_width=True)
+                            mejores = df_ventanas.loc[df_ventanas.groupby('id_bloque')['puntaje'].idxmax()]
+                            mejores.columns = ['Bloque', 'Mejor día', 'Hora (UTC)', 'Puntaje']
+                            st.dataframe(mejores.head(15), use_container_width=True)
+                        else:
+                            st.warning("El pronóstico recibido es demasiado corto para evaluar ventanas.")
+                
                 st.markdown("### 📥 EXPORTAR DATOS DE FERTILIDAD")
-                csv_data = df_fertilidad.drop(columns=['geometria']).to_csv(index=False)
+                csv_data = gdf_fertilidad[list(df_fertilidad.columns)].to_csv(index=False)
                 st.download_button("📊 CSV completo", csv_data, f"fertilidad_{datetime.now():%Y%m%d}.csv", "text/csv")
+                
+                st.markdown("#### 🚜 Mapa de prescripción (dosis variable)")
+                col_p1, col_p2, col_p3, col_p4 = st.columns(4)
+                with col_p1:
+                    producto_presc = st.selectbox("Producto", list(PRODUCTOS_PRESCRIPCION), key="producto_prescripcion")
+                with col_p2:
+                    formato_presc = st.selectbox("Formato", ["Shapefile", "ISOXML"], key="formato_prescripcion")
+                with col_p3:
+                    paso_presc = st.number_input("Rango de dosis (kg/ha)", 5, 100, PASO_DOSIS_KG_HA, 5, key="paso_prescripcion")
+                with col_p4:
+                    vertices_presc = st.number_input("Máx. vértices", 500, 200000, MAX_VERTICES_PRESCRIPCION, 500,
+                                                     key="vertices_prescripcion")
+                if st.button("Generar prescripción", key="generar_prescripcion"):
+                    prescripcion = exportar_prescripcion(gdf_fertilidad, producto_presc, formato_presc,
+                                                         paso_presc, vertices_presc)
+                    if prescripcion is not None:
+                        datos_zip, n_zonas, n_vertices = prescripcion
+                        st.caption(f"{n_zonas} zonas · {n_vertices:,} vértices")
+                        st.download_button(f"🗜️ Descargar {formato_presc} ({producto_presc})", datos_zip,
+                                           f"prescripcion_{producto_presc.lower()}_{datetime.now():%Y%m%d}.zip",
+                                           "application/zip", key="descargar_prescripcion")
             else:
                 st.info("Ejecute el análisis completo para ver los datos de fertilidad.")
         
         with tab6:  # Textura Suelo
             st.subheader("🌱 ANÁLISIS DE TEXTURA DE SUELO")
-            textura_por_bloque = st.session_state.get('textura_por_bloque', [])
-            if textura_por_bloque:
-                df_textura = pd.DataFrame(textura_por_bloque)
+            df_textura = st.session_state.get('textura_por_bloque')
+            if df_textura is not None and len(df_textura):
                 st.success(f"**Análisis de textura por bloque completado**")
+                medidos = int((df_textura['fuente'] == 'SoilGrids').sum()) if 'fuente' in df_textura else 0
+                if medidos:
+                    st.caption(f"Composición medida (SoilGrids local, 0-30 cm) en {medidos} de {len(df_textura)} bloques; "
+                               "el resto se estima.")
                 st.markdown("### 🗺️ Mapa de Tipos de Suelo por Bloque")
                 try:
-                    gdf_textura = gpd.GeoDataFrame(df_textura, geometry='geometria', crs='EPSG:4326')
+                    gdf_textura = gdf_completo[[gdf_completo.geometry.name]].join(df_textura, how='inner')
                     tipos_unicos = gdf_textura['tipo_suelo'].unique()
                     colores = ['#8B4513', '#D2691E', '#F4A460', '#DEB887', '#BC8F8F', '#CD853F']
                     color_dict = {tipo: colores[i % len(colores)] for i, tipo in enumerate(tipos_unicos)}
@@ -2885,12 +5605,10 @@ if st.session_state.analisis_completado:
                         tipo = feature['properties']['tipo_suelo']
                         return {'fillColor': color_dict.get(tipo, '#888'), 
                                 'color': 'black', 'weight': 1, 'fillOpacity': 0.6}
-                    folium.GeoJson(
-                        gdf_textura.to_json(),
-                        name='Textura del suelo',
-                        style_function=style_func,
-                        tooltip=folium.GeoJsonTooltip(fields=['id_bloque','tipo_suelo','arena','limo','arcilla','drenaje'],
-                                                      aliases=['Bloque','Tipo','Arena %','Limo %','Arcilla %','Drenaje'])
+                    capa_vectorial_compacta(
+                        gdf_textura, 'Textura del suelo', style_func,
+                        tooltip_fields=['id_bloque','tipo_suelo','clase_usda','arena','limo','arcilla','drenaje'],
+                        tooltip_aliases=['Bloque','Tipo','Clase USDA','Arena %','Limo %','Arcilla %','Drenaje']
                     ).add_to(m_textura)
                     folium.LayerControl().add_to(m_textura); Fullscreen().add_to(m_textura)
                     folium_static(m_textura, width=1000, height=600)
@@ -2910,9 +5628,9 @@ if st.session_state.analisis_completado:
                 st.markdown("### 🔺 Triángulo Textural (primer bloque)")
                 if len(df_textura) > 0:
                     row = df_textura.iloc[0]
-                    fig_tri = crear_grafico_textural(row['arena'], row['limo'], row['arcilla'], row['tipo_suelo'])
+                    fig_tri = crear_grafico_textural(row['arena'], row['limo'], row['arcilla'], row['clase_usda'])
                     st.plotly_chart(fig_tri, use_container_width=True)
-                csv_textura = df_textura.drop(columns=['geometria']).to_csv(index=False)
+                csv_textura = df_textura.to_csv(index=False)
                 st.download_button("📊 Descargar CSV de textura", csv_textura, f"textura_suelo_{datetime.now():%Y%m%d}.csv", "text/csv")
             else:
                 st.info("Ejecute el análisis completo para ver el análisis de textura del suelo.")
@@ -2935,36 +5653,75 @@ if st.session_state.analisis_completado:
                     if gdf_original is None:
                         st.error("Primero debe cargar una plantación.")
                     else:
-                        if not st.session_state.demo_mode and api_key:
+                        dem = None
+                        if not st.session_state.demo_mode:
+                            # Sin API key solo se usa lo que ya esté en la caché de teselas DEM
                             dem, meta, transform = obtener_dem_opentopography(gdf_original, api_key if api_key else None)
-                            if dem is not None:
-                                curvas = generar_curvas_nivel_reales(dem, transform, intervalo)
-                                st.success(f"✅ Se generaron {len(curvas)} curvas de nivel (DEM real)")
-                            else:
-                                st.warning("No se pudo obtener DEM real. Usando simulado.")
-                                curvas = generar_curvas_nivel_simuladas(gdf_original)
+                        if dem is not None:
+                            curvas = generar_curvas_nivel_reales(dem, transform, intervalo)
+                            st.success(f"✅ Se generaron {len(curvas)} curvas de nivel (DEM real)")
                         else:
-                            curvas = generar_curvas_nivel_simuladas(gdf_original)
+                            if not st.session_state.demo_mode and api_key:
+                                st.warning("No se pudo obtener DEM real. Usando simulado.")
+                            curvas = generar_curvas_nivel_simuladas(gdf_original, intervalo)
                             st.info(f"ℹ️ Usando relieve simulado. Se generaron {len(curvas)} curvas de nivel.")
                         
-                        if curvas:
+                        if len(curvas):
                             st.session_state.curvas_nivel = curvas
-                            m_curvas = mapa_curvas_coloreadas(gdf_original, curvas)
-                            folium_static(m_curvas, width=1000, height=600)
-                            gdf_curvas = gpd.GeoDataFrame(
-                                {'elevacion': [e for _, e in curvas], 'geometry': [l for l, _ in curvas]},
-                                crs='EPSG:4326'
-                            )
-                            geojson_curvas = gdf_curvas.to_json()
-                            csv_curvas = gdf_curvas.drop(columns='geometry').to_csv(index=False)
+                            mostrar_mapa_cacheado(mapa_curvas_coloreadas, gdf_original, curvas)
+                            geojson_curvas = json.dumps(geojson_compacto(curvas), separators=(',', ':'))
+                            csv_curvas = curvas.drop(columns='geometry').to_csv(index=False)
                             col_exp1, col_exp2 = st.columns(2)
                             with col_exp1: st.download_button("🗺️ GeoJSON", geojson_curvas, f"curvas_nivel_{datetime.now():%Y%m%d}.geojson", "application/geo+json")
                             with col_exp2: st.download_button("📊 CSV", csv_curvas, f"curvas_nivel_{datetime.now():%Y%m%d}.csv", "text/csv")
                         else:
                             st.warning("No se encontraron curvas de nivel en el área.")
             else:
-                if st.session_state.get('curvas_nivel'):
+                if st.session_state.get('curvas_nivel') is not None:
                     st.info("Ya hay curvas de nivel generadas. Presiona el botón para regenerarlas.")
+            
+            if 'pendiente_media' in gdf_completo.columns:
+                st.markdown("---")
+                terreno_simulado = st.session_state.get('fuente_terreno') != 'SRTM'
+                st.markdown("### ⛰️ PENDIENTE Y RIESGO DE EROSIÓN POR BLOQUE" + (" (SIMULADO)" if terreno_simulado else ""))
+                if terreno_simulado:
+                    st.warning("⚠️ Valores calculados sobre un relieve simulado, no sobre un DEM real. "
+                               "No representan la pendiente ni el riesgo de erosión de la parcela.")
+                else:
+                    st.caption("Fuente: DEM SRTM 1 arc-seg (OpenTopography).")
+                pendiente_max = float(np.nanmax(gdf_completo['pendiente_media'])) if gdf_completo['pendiente_media'].notna().any() else 1.0
+                mostrar_estadisticas_indice(gdf_completo, 'pendiente_media',
+                                            'Pendiente media (°)' + (' - simulada' if terreno_simulado else ''), 0.0,
+                                            max(pendiente_max, 1.0), ['green', 'yellow', 'orange', 'red'])
+                st.dataframe(
+                    gdf_completo[['id_bloque', 'pendiente_media', 'pendiente_max', 'orientacion_media',
+                                  'twi_medio', 'ls_medio', 'riesgo_erosion']],
+                    use_container_width=True, hide_index=True
+                )
+            
+            if st.session_state.get('dem_terreno') is not None:
+                st.markdown("---")
+                st.markdown("### 🏔️ VISTA 3D DEL TERRENO")
+                if st.session_state.get('fuente_terreno') != 'SRTM':
+                    st.caption("⚠️ Relieve simulado: no corresponde al terreno real de la parcela.")
+                col_3d1, col_3d2, col_3d3 = st.columns(3)
+                with col_3d1:
+                    color_3d = st.selectbox("Colorear por", ["NDVI", "Elevación", "Sombreado"], key="color_terreno_3d")
+                with col_3d2:
+                    triangulos_3d = st.select_slider("Triángulos máximos", options=[5000, 10000, 20000, 50000],
+                                                     value=TRIANGULOS_MALLA, key="triangulos_terreno_3d")
+                with col_3d3:
+                    exageracion_3d = st.slider("Exageración vertical", 1.0, 10.0, 2.0, 0.5, key="exageracion_terreno_3d")
+                try:
+                    dem_3d, transform_3d = st.session_state.dem_terreno
+                    fig_3d = crear_vista_3d_terreno(gdf_completo, dem_3d, transform_3d, color_3d,
+                                                    triangulos_3d, exageracion_3d)
+                    if fig_3d is not None:
+                        st.plotly_chart(fig_3d, use_container_width=True, key="terreno_3d")
+                    else:
+                        st.warning("No hay datos de elevación suficientes para la vista 3D.")
+                except Exception as e:
+                    st.error(f"Error al generar la vista 3D: {str(e)[:100]}")
         
         with tab8:
             st.subheader("🛰️ Obtención de imagen satelital RGB (MODIS vía NASA GIBS)")
@@ -3148,78 +5905,66 @@ if st.session_state.analisis_completado:
                 cultivo = st.session_state.cultivo_seleccionado
                 st.markdown(f"### Cultivo seleccionado: **{cultivo}**")
                 
-                # Parámetros editables
+                # Parámetros editables: dentro de un formulario, solo se aplican al confirmar
                 with st.expander("⚙️ Ajustar parámetros de costos y precios"):
-                    st.markdown("#### Costos por hectárea (USD)")
-                    col_c1, col_c2 = st.columns(2)
-                    with col_c1:
-                        semilla = st.number_input("Semilla (USD/ha)", value=80 if cultivo=='Trigo' else 120 if cultivo=='Maíz' else 100 if cultivo=='Soja' else 90, step=5)
-                        fertilizante = st.number_input("Fertilizante (USD/ha)", value=150 if cultivo=='Trigo' else 200 if cultivo=='Maíz' else 120 if cultivo=='Soja' else 130, step=5)
-                        herbicidas = st.number_input("Herbicidas (USD/ha)", value=40 if cultivo=='Trigo' else 50 if cultivo=='Maíz' else 45 if cultivo=='Soja' else 40, step=5)
-                    with col_c2:
-                        labranza = st.number_input("Labranza (USD/ha)", value=60 if cultivo=='Trigo' else 70 if cultivo=='Maíz' else 65 if cultivo=='Soja' else 60, step=5)
-                        siembra = st.number_input("Siembra (USD/ha)", value=25 if cultivo=='Trigo' else 30 if cultivo=='Maíz' else 28 if cultivo=='Soja' else 25, step=5)
-                        cosecha = st.number_input("Cosecha (USD/ha)", value=50 if cultivo=='Trigo' else 60 if cultivo=='Maíz' else 55 if cultivo=='Soja' else 50, step=5)
-                        otros = st.number_input("Otros costos (USD/ha)", value=30, step=5)
-                    
-                    st.markdown("#### Precio de venta")
-                    precio_venta = st.number_input("Precio por tonelada (USD)", value=200 if cultivo=='Trigo' else 180 if cultivo=='Maíz' else 400 if cultivo=='Soja' else 450, step=10)
-                    
-                    st.markdown("#### Rendimiento potencial máximo (t/ha)")
-                    # Usar diccionario para asegurar tipo float consistente
-                    valor_rend = {
-                        'Trigo': 8.0,
-                        'Maíz': 12.0,
-                        'Soja': 4.0,
-                        'Girasol': 3.5
-                    }[cultivo]
-                    rend_max = st.number_input("Rendimiento máximo (t/ha)", value=valor_rend, step=0.5)
-                
-                # Calcular costos
-                costos_dict = {
-                    'semilla': semilla,
-                    'fertilizante': fertilizante,
-                    'herbicidas': herbicidas,
-                    'labranza': labranza,
-                    'siembra': siembra,
-                    'cosecha': cosecha,
-                    'otros': otros
-                }
-                costo_total_ha = sum(costos_dict.values())
-                
-                # Estimar rendimiento por bloque
-                def estimar_rendimiento(ndvi):
-                    if pd.isna(ndvi):
-                        return 0
-                    rend = max(0, (ndvi - 0.2) * (rend_max / 0.7))
-                    return min(rend, rend_max)
-                
-                resultados_costos = []
-                for idx, row in gdf_completo.iterrows():
-                    area = row['area_ha']
-                    ndvi = row.get('ndvi_modis', 0.5)
-                    rend = estimar_rendimiento(ndvi)
-                    produccion = rend * area
-                    ingreso = produccion * precio_venta
-                    costo_total = area * costo_total_ha
-                    ganancia = ingreso - costo_total
-                    resultados_costos.append({
-                        'bloque': row['id_bloque'],
-                        'area_ha': area,
-                        'ndvi': round(ndvi, 3),
-                        'rend_est (t/ha)': round(rend, 2),
-                        'produccion (t)': round(produccion, 2),
-                        'costo_total (USD)': round(costo_total, 2),
-                        'ingreso (USD)': round(ingreso, 2),
-                        'ganancia (USD)': round(ganancia, 2)
-                    })
+                    with st.form(f"parametros_costos_{cultivo}"):
+                        st.markdown("#### Costos por hectárea (USD)")
+                        col_c1, col_c2 = st.columns(2)
+                        costos_dict = {}
+                        for i_costo, (rubro, valor) in enumerate(COSTOS_BASE[cultivo].items()):
+                            with (col_c1 if i_costo < 3 else col_c2):
+                                costos_dict[rubro] = st.number_input(f"{rubro.capitalize()} (USD/ha)", value=float(valor),
+                                                                     step=5.0, key=f"costo_{rubro}_{cultivo}")
+                        
+                        st.markdown("#### Precio de venta")
+                        precio_venta = st.number_input("Precio por tonelada (USD)", value=float(PRECIOS_VENTA[cultivo]),
+                                                       step=10.0, key=f"precio_{cultivo}")
+                        
+                        st.markdown("#### Rendimiento potencial máximo (t/ha)")
+                        rend_max = st.number_input("Rendimiento máximo (t/ha)", value=REND_MAX[cultivo], step=0.5,
+                                                   key=f"rend_max_{cultivo}")
+                        st.form_submit_button("Aplicar")
                 
-                df_costos = pd.DataFrame(resultados_costos)
+                with st.expander("🌾 Datos de monitor de rendimiento"):
+                    archivo_rend = st.file_uploader("Registro de cosecha (CSV o shapefile de puntos en .zip)",
+                                                    type=['csv', 'zip'], key="rendimiento_uploader")
+                    col_r1, col_r2, col_r3, col_r4 = st.columns(4)
+                    with col_r1:
+                        campana = st.text_input("Campaña", str(datetime.now().year), key="campana_rendimiento")
+                    with col_r4:
+                        cultivo_cosecha = st.selectbox("Cultivo cosechado", CULTIVOS, index=CULTIVOS.index(cultivo),
+                                                       key="cultivo_cosecha")
+                    with col_r2:
+                        unidad_rend = st.selectbox("Unidad del rendimiento", list(UNIDADES_RENDIMIENTO), key="unidad_rendimiento")
+                    with col_r3:
+                        ancho_cabezal = st.number_input("Ancho de cabezal (m)", 3.0, 20.0, ANCHO_CABEZAL_M, 0.5, key="ancho_cabezal")
+                    if archivo_rend is not None and st.button("Procesar registro", key="procesar_rendimiento_btn"):
+                        with st.spinner("Limpiando y agregando el registro de cosecha..."):
+                            por_bloque = procesar_archivo_rendimiento(archivo_rend, gdf_completo, unidad_rend, ancho_cabezal)
+                        if por_bloque is not None:
+                            guardar_historial_rendimiento(gdf_completo, campana, cultivo_cosecha, por_bloque)
+                            st.json(por_bloque.attrs['resumen'])
+                    historial_rend = cargar_historial_rendimiento(gdf_completo)
+                    rendimiento_medido = None
+                    if historial_rend is not None and len(historial_rend):
+                        st.dataframe(historial_rend.pivot_table(index='id_bloque', columns=['cultivo', 'campana'],
+                                                                values='rend_medio', dropna=False),
+                                     use_container_width=True)
+                    historial_cultivo = cargar_historial_rendimiento(gdf_completo, cultivo)
+                    if historial_cultivo is not None and len(historial_cultivo):
+                        # Solo campañas del cultivo seleccionado; por defecto no se calibra
+                        campanas = sorted(historial_cultivo['campana'].unique(), reverse=True)
+                        campana_uso = st.selectbox(f"Campaña de {cultivo} para calibrar el rendimiento",
+                                                   ['(NDVI)'] + campanas, index=0, key=f"campana_calibracion_{cultivo}")
+                        if campana_uso != '(NDVI)':
+                            rendimiento_medido = (historial_cultivo[historial_cultivo['campana'] == campana_uso]
+                                                  .set_index('id_bloque')
+                                                  .reindex(gdf_completo['id_bloque'].values)
+                                                  .fillna({'puntos': 0}))
                 
-                # Totales
-                total_costo = df_costos['costo_total (USD)'].sum()
-                total_ingreso = df_costos['ingreso (USD)'].sum()
-                total_ganancia = df_costos['ganancia (USD)'].sum()
+                costo_total_ha = sum(costos_dict.values())
+                df_costos, total_costo, total_ingreso, total_ganancia = calcular_costos(
+                    gdf_completo, cultivo, rendimiento_medido, costos_dict, precio_venta, rend_max)
                 
                 st.markdown("### 📊 Resumen económico")
                 col_m1, col_m2, col_m3, col_m4 = st.columns(4)
@@ -3237,6 +5982,7 @@ if st.session_state.analisis_completado:
                     'area_ha': '{:.1f}',
                     'ndvi': '{:.3f}',
                     'rend_est (t/ha)': '{:.2f}',
+                    'rend_equilibrio (t/ha)': '{:.2f}',
                     'produccion (t)': '{:.2f}',
                     'costo_total (USD)': '${:,.0f}',
                     'ingreso (USD)': '${:,.0f}',
@@ -3256,9 +6002,76 @@ if st.session_state.analisis_completado:
                 st.pyplot(fig)
                 plt.close(fig)
                 
+                st.markdown("### 🎲 Escenarios y riesgo")
+                rend_bloques = df_costos['rend_est (t/ha)'].to_numpy()
+                area_bloques = df_costos['area_ha'].to_numpy()
+                col_e1, col_e2 = st.columns(2)
+                with col_e1:
+                    var_precio = st.slider("Variación de precio (±%)", 0, 50, 20, 5, key="variacion_precio")
+                with col_e2:
+                    var_costo = st.slider("Variación de costos (±%)", 0, 50, 10, 5, key="variacion_costo")
+                factores_precio = 1.0 + np.linspace(-var_precio, var_precio, 5) / 100.0
+                factores_costo = 1.0 + np.linspace(-var_costo, var_costo, 5) / 100.0
+                ganancias = matriz_escenarios(rend_bloques, area_bloques, precio_venta * factores_precio,
+                                              costo_total_ha * factores_costo).sum(axis=0)
+                st.dataframe(pd.DataFrame(
+                    ganancias,
+                    index=[f"Precio ${precio_venta * f:,.0f}/t" for f in factores_precio],
+                    columns=[f"Costo ${costo_total_ha * f:,.0f}/ha" for f in factores_costo]
+                ).style.format('${:,.0f}').background_gradient(cmap='RdYlGn', axis=None), use_container_width=True)
+                
+                with st.form("monte_carlo"):
+                    col_s1, col_s2, col_s3, col_s4 = st.columns(4)
+                    with col_s1:
+                        n_sim = st.number_input("Simulaciones", 1000, 100000, N_SIMULACIONES, 1000, key="n_simulaciones")
+                    with col_s2:
+                        cv_rend = st.number_input("CV rendimiento", 0.0, 1.0, CV_RENDIMIENTO, 0.01, key="cv_rendimiento")
+                    with col_s3:
+                        cv_precio = st.number_input("CV precio", 0.0, 1.0, CV_PRECIO, 0.01, key="cv_precio")
+                    with col_s4:
+                        cv_costo = st.number_input("CV costos", 0.0, 1.0, CV_COSTO, 0.01, key="cv_costo")
+                    simular = st.form_submit_button("Simular")
+                if simular or st.session_state.get('simulacion_mostrada'):
+                    st.session_state.simulacion_mostrada = True
+                    riesgo_bloques, ganancia_simulada = simulacion_economica(
+                        gdf_completo, rend_bloques, precio_venta, costo_total_ha, n_sim, cv_rend, cv_precio, cv_costo)
+                    riesgo = metricas_riesgo(ganancia_simulada)
+                    col_r1, col_r2, col_r3, col_r4, col_r5 = st.columns(5)
+                    with col_r1: st.metric("P10 ganancia", f"${riesgo['P10']:,.0f}")
+                    with col_r2: st.metric("P50 ganancia", f"${riesgo['P50']:,.0f}")
+                    with col_r3: st.metric("P90 ganancia", f"${riesgo['P90']:,.0f}")
+                    with col_r4: st.metric("Prob. de pérdida", f"{riesgo['prob_perdida']:.1%}")
+                    with col_r5: st.metric("CVaR 10%", f"${riesgo['CVaR10']:,.0f}")
+                    fig_mc, ax_mc = plt.subplots(figsize=(10, 3))
+                    ax_mc.hist(ganancia_simulada, bins=60, color='steelblue')
+                    for q, color in zip(PERCENTILES_RIESGO, ['red', 'black', 'green']):
+                        ax_mc.axvline(riesgo[f'P{q}'], color=color, linestyle='--', label=f'P{q}')
+                    ax_mc.set_xlabel('Ganancia total (USD)'); ax_mc.legend()
+                    st.pyplot(fig_mc); plt.close(fig_mc)
+                    st.dataframe(riesgo_bloques, use_container_width=True)
+                
+                st.markdown("### 🌾 Comparación de cultivos")
+                st.caption("Todos los cultivos evaluados sobre los mismos bloques, sin repetir el análisis. "
+                           f"Para {cultivo} se usan los parámetros ajustados arriba.")
+                comparacion_bloques, comparacion_cultivos = comparar_cultivos(
+                    gdf_completo, CULTIVOS,
+                    {cultivo: {'costos': costos_dict, 'precio': precio_venta, 'rend_maximo': rend_max}},
+                    rendimiento_medido, cultivo)
+                st.dataframe(comparacion_cultivos.style.format({
+                    'rend_medio (t/ha)': '{:.2f}', 'rend_equilibrio (t/ha)': '{:.2f}',
+                    'ganancia_total (USD)': '${:,.0f}', 'ganancia (USD/ha)': '${:,.1f}'
+                }), use_container_width=True)
+                mixto = float((comparacion_bloques['ganancia_recomendada (USD/ha)'] * df_costos['area_ha'].values).sum())
+                st.metric("Ganancia con el cultivo recomendado por bloque", f"${mixto:,.0f}",
+                          f"${mixto - comparacion_cultivos['ganancia_total (USD)'].max():,.0f} vs. mejor cultivo único")
+                mostrar_mapa_cacheado(mapa_cultivo_recomendado, gdf_completo, comparacion_bloques[['cultivo_recomendado']])
+                st.dataframe(comparacion_bloques, use_container_width=True)
+                
                 st.markdown("### 📥 Exportar")
                 csv_costos = df_costos.to_csv(index=False)
                 st.download_button("📊 Descargar CSV", csv_costos, f"costos_{datetime.now():%Y%m%d}.csv", "text/csv")
+                st.download_button("🌾 Descargar comparación de cultivos (CSV)", comparacion_bloques.to_csv(index=False),
+                                   f"comparacion_cultivos_{datetime.now():%Y%m%d}.csv", "text/csv")
             else:
                 st.info("Primero debe ejecutar el análisis completo para ver los costos.")
 
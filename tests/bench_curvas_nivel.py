@@ -0,0 +1,66 @@
+"""
+Benchmark de curvas de nivel sobre un DEM de 5.000 x 5.000: extracción de todos los niveles
+en una pasada (extraer_curvas_nivel) frente al camino anterior, un find_contours por nivel
+con la transformación afín aplicada vértice a vértice en Python.
+
+    python tests/bench_curvas_nivel.py [lado]
+"""
+import sys
+
+import numpy as np
+from rasterio.transform import from_origin
+from shapely.geometry import LineString
+from skimage import measure
+
+from medicion import cargar_definiciones_app, cronometrar, medir, tabla
+
+INTERVALO = 10
+
+
+def dem_sintetico(lado, semilla=0):
+    rng = np.random.default_rng(semilla)
+    fila = np.linspace(0, 1, lado, dtype=np.float32)
+    yy, xx = fila[:, None], fila[None, :]
+    Z = 120 + 60 * np.sin(7 * xx) * np.cos(5 * yy) + 25 * np.sin(23 * xx + 11 * yy)
+    return (Z + rng.normal(0, 0.5, (lado, lado)).astype(np.float32)).astype(np.float32)
+
+
+def curvas_por_nivel(dem_array, transform, niveles):
+    """Camino anterior (generar_curvas_nivel_reales antes del motor de una sola pasada)."""
+    contours = []
+    for nivel in niveles:
+        for contour in measure.find_contours(dem_array, nivel):
+            coords = []
+            for row, col in contour:
+                x, y = transform * (col, row)
+                coords.append((x, y))
+            if len(coords) > 2:
+                line = LineString(coords)
+                if line.length > 0.01 * abs(transform.a):
+                    contours.append((line, nivel))
+    return contours
+
+
+def main():
+    lado = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    app = cargar_definiciones_app()
+    Z = dem_sintetico(lado)
+    transform = from_origin(-66.95, 8.05, 1e-5, 1e-5)   # ~1 m por píxel
+    niveles = np.arange(np.floor(Z.min() / INTERVALO) * INTERVALO, Z.max() + INTERVALO, INTERVALO)
+    print(f"DEM {lado}x{lado}, {len(niveles)} niveles\n")
+    
+    curvas, s_una = cronometrar(app.extraer_curvas_nivel, Z, transform, niveles)
+    _, _, mb_una = medir(app.extraer_curvas_nivel, Z, transform, niveles)
+    vertices_una = int(np.sum([len(g.coords) for g in curvas.geometry]))
+    anteriores, s_nivel = cronometrar(curvas_por_nivel, Z, transform, niveles)
+    vertices_nivel = int(np.sum([len(g.coords) for g, _ in anteriores]))
+    # El camino anterior no simplifica ni descarta los trozos cortos del ruido del DEM
+    tabla(['camino', 'segundos', 'pico_MB', 'lineas', 'vertices'], [
+        ['una pasada', f"{s_una:.1f}", f"{mb_una:.0f}", len(curvas), vertices_una],
+        ['por nivel', f"{s_nivel:.1f}", '-', len(anteriores), vertices_nivel],
+    ])
+    print(f"\nAceleración: {s_nivel / s_una:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
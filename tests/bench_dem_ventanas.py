@@ -0,0 +1,78 @@
+"""
+Benchmark de memoria del procesamiento DEM por ventanas: DEM memory-mapped (.npy en disco)
+de área creciente con el mismo relieve por píxel. Se mide el pico de memoria (tracemalloc)
+del rango, las curvas de nivel por ventanas y el terreno por bloque; como referencia, las
+curvas en memoria mientras el DEM cabe. Las curvas devueltas crecen con el área, así que
+también se informa el pico sin contar la salida.
+
+    python tests/bench_dem_ventanas.py [lado ...]
+"""
+import os
+import sys
+import tempfile
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from medicion import cargar_definiciones_app, medir, tabla
+
+LADOS = [2048, 4096, 8192, 16384]
+MAX_LADO_EN_MEMORIA = 8192
+PIXEL_GRADOS = 1e-5     # ~1 m
+ORIGEN = (-66.95, 8.05)
+INTERVALO = 10
+
+
+def escribir_dem(ruta, lado, app):
+    """Relieve con la misma frecuencia por píxel para todo tamaño, escrito por ventanas."""
+    dem = np.lib.format.open_memmap(ruta, mode='w+', dtype=np.float32, shape=(lado, lado))
+    for interior, _, _ in app.ventanas_dem(dem.shape, halo=0):
+        filas, columnas = interior
+        yy = np.arange(filas.start, filas.stop, dtype=np.float32)[:, None]
+        xx = np.arange(columnas.start, columnas.stop, dtype=np.float32)[None, :]
+        dem[interior] = (120 + 60 * np.sin(xx / 700) * np.cos(yy / 500) + 25 * np.sin((xx + 2 * yy) / 230)
+                         + 15 * np.sin(xx / 90) * np.cos(yy / 70))
+    dem.flush()
+    del dem
+    return np.load(ruta, mmap_mode='r')
+
+
+def main():
+    lados = [int(x) for x in sys.argv[1:]] or LADOS
+    app = cargar_definiciones_app()
+    transform = (PIXEL_GRADOS, 0.0, ORIGEN[0], 0.0, -PIXEL_GRADOS, ORIGEN[1])
+    filas = []
+    with tempfile.TemporaryDirectory() as carpeta:
+        for lado in lados:
+            dem = escribir_dem(os.path.join(carpeta, f"dem_{lado}.npy"), lado, app)
+            (vmin, vmax), _, mb_rango = medir(app.rango_dem, dem)
+            niveles = np.arange(np.floor(vmin / INTERVALO) * INTERVALO, vmax + INTERVALO, INTERVALO)
+            curvas, s_curvas, mb_curvas = medir(app.extraer_curvas_nivel_por_ventanas, dem, transform, niveles)
+            salida_mb = shapely.get_num_coordinates(curvas.geometry.values).sum() * 16 / 2 ** 20
+            
+            extension = lado * PIXEL_GRADOS
+            campo = gpd.GeoDataFrame(geometry=[shapely.box(ORIGEN[0], ORIGEN[1] - extension,
+                                                           ORIGEN[0] + extension, ORIGEN[1])], crs='EPSG:4326')
+            bloques = app.dividir_plantacion_en_bloques(campo, 100)
+            _, s_terreno, mb_terreno = medir(app.terreno_por_bloque, bloques, dem, transform)
+            
+            if lado <= MAX_LADO_EN_MEMORIA:
+                _, _, mb_memoria = medir(lambda: app.extraer_curvas_nivel(
+                    np.ma.masked_invalid(app.dem_flotante(dem)), transform, niveles))
+                mb_memoria = f"{mb_memoria:.0f}"
+            else:
+                mb_memoria = '-'
+            fila = [f"{lado}x{lado}", f"{lado * lado / 1e6:.0f}", f"{mb_rango:.0f}",
+                    f"{s_curvas:.1f}", f"{mb_curvas:.0f}", f"{salida_mb:.0f}", f"{mb_curvas - salida_mb:.0f}",
+                    f"{s_terreno:.1f}", f"{mb_terreno:.0f}", mb_memoria]
+            filas.append(fila)
+            print(*fila, sep='\t', flush=True)
+            del dem
+    print()
+    tabla(['DEM', 'Mceldas', 'rango_MB', 'curvas_s', 'curvas_MB', 'salida_MB', 'curvas-salida_MB',
+           'terreno_s', 'terreno_MB', 'en_memoria_MB'], filas)
+
+
+if __name__ == '__main__':
+    main()
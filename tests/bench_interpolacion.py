@@ -0,0 +1,53 @@
+"""
+Benchmark del motor de interpolación de mapas de calor (16 a 50.000 puntos): RBF local,
+IDW y, como referencia mientras entra en memoria, la Rbf global de scipy que reemplazó.
+
+    python tests/bench_interpolacion.py
+"""
+import numpy as np
+from scipy.interpolate import Rbf
+
+from medicion import cargar_definiciones_app, medir, tabla
+
+TAMANOS = [16, 64, 256, 1024, 4096, 16384, 50000]
+MAX_RBF_GLOBAL = 4096
+BOUNDS = (-66.905, 8.000, -66.895, 8.010)   # ~1,1 km x 1,1 km
+
+
+def superficie(xy):
+    x = (xy[:, 0] - BOUNDS[0]) / (BOUNDS[2] - BOUNDS[0])
+    y = (xy[:, 1] - BOUNDS[1]) / (BOUNDS[3] - BOUNDS[1])
+    return 0.6 + 0.2 * np.sin(5 * x) * np.cos(4 * y)
+
+
+def main():
+    app = cargar_definiciones_app()
+    nx, ny = app.resolucion_grilla_adaptativa(BOUNDS)
+    nodos = app.crear_grilla_interpolacion(BOUNDS, nx, ny)
+    verdad = superficie(nodos)
+    print(f"Grilla {nx}x{ny} ({len(nodos):,} nodos)\n")
+    filas = []
+    rng = np.random.default_rng(0)
+    for n in TAMANOS:
+        puntos = np.column_stack([rng.uniform(BOUNDS[0], BOUNDS[2], n), rng.uniform(BOUNDS[1], BOUNDS[3], n)])
+        valores = superficie(puntos)
+        fila = [n]
+        for funcion in (app.interpolar_rbf_local, app.interpolar_idw):
+            z, s, mb = medir(funcion, puntos, valores, nodos)
+            fila += [f"{s:.2f}", f"{mb:.0f}", f"{np.sqrt(np.mean((z - verdad) ** 2)):.4f}"]
+        if n <= MAX_RBF_GLOBAL:
+            def rbf_global():
+                rbf = Rbf(puntos[:, 0], puntos[:, 1], valores, function='multiquadric', smooth=0.1)
+                return np.concatenate([rbf(lote[:, 0], lote[:, 1]) for lote in np.array_split(nodos, 64)])
+            z, s, mb = medir(rbf_global)
+            fila += [f"{s:.2f}", f"{mb:.0f}"]
+        else:
+            fila += ['-', '-']
+        filas.append(fila)
+        print(*fila, sep='\t', flush=True)
+    print()
+    tabla(['puntos', 'rbf_s', 'rbf_MB', 'rbf_rmse', 'idw_s', 'idw_MB', 'idw_rmse', 'global_s', 'global_MB'], filas)
+
+
+if __name__ == '__main__':
+    main()
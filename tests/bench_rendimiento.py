@@ -0,0 +1,66 @@
+"""
+Benchmark de la limpieza del monitor de rendimiento: CSV sintético en serpentina (1 Hz,
+6 km/h, vueltas en U) de 1 y 5 millones de registros sobre 100 bloques.
+
+    python tests/bench_rendimiento.py [millones ...]
+"""
+import os
+import sys
+import tempfile
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from medicion import cargar_definiciones_app, medir, tabla
+
+LAT0, LON0 = -33.0, -63.0
+M_X = 111320 * np.cos(np.radians(LAT0))
+M_Y = 110540
+LARGO_M, ANCHO_M, PASO_M, RADIO_M = 2000.0, 9.0, 1.67, 4.5
+
+
+def serpentina(n_registros):
+    """Recorrido vectorizado: pasadas de LARGO_M unidas por vueltas en U."""
+    recta = np.arange(0, LARGO_M, PASO_M)
+    t = np.arange(0, np.pi, PASO_M / RADIO_M)
+    por_pasada = len(recta) + len(t)
+    n_pasadas = int(np.ceil(n_registros / por_pasada))
+    p = np.arange(n_pasadas)[:, None]
+    impar = (p % 2).astype(bool)
+    y_recta = np.where(impar, recta[::-1], recta)
+    y_vuelta = np.where(impar, -RADIO_M * np.sin(t), LARGO_M + RADIO_M * np.sin(t))
+    x = np.hstack([np.broadcast_to(p * ANCHO_M, y_recta.shape), p * ANCHO_M + RADIO_M - RADIO_M * np.cos(t)])
+    y = np.hstack([y_recta, y_vuelta])
+    v = np.hstack([np.full(y_recta.shape, 6.0), np.full(y_vuelta.shape, 5.0)])
+    return x.ravel()[:n_registros], y.ravel()[:n_registros], v.ravel()[:n_registros], n_pasadas
+
+
+def main():
+    millones = [float(m) for m in sys.argv[1:]] or [1, 5]
+    app = cargar_definiciones_app()
+    filas = []
+    with tempfile.TemporaryDirectory() as carpeta:
+        for m in millones:
+            n = int(m * 1e6)
+            x, y, v, n_pasadas = serpentina(n)
+            rng = np.random.default_rng(0)
+            ruta = os.path.join(carpeta, 'registro.csv')
+            pd.DataFrame({'lon': LON0 + x / M_X, 'lat': LAT0 + y / M_Y, 'speed': v,
+                          'yield': rng.normal(8, 1, n).round(3)}).to_csv(ruta, index=False, float_format='%.8f')
+            campo = shapely.box(LON0 - 1e-4, LAT0 - 1e-4, LON0 + n_pasadas * ANCHO_M / M_X + 1e-4,
+                                LAT0 + LARGO_M / M_Y + 1e-4)
+            bloques = app.dividir_plantacion_en_bloques(gpd.GeoDataFrame(geometry=[campo], crs='EPSG:4326'), 100)
+            resultado, segundos, pico = medir(app.procesar_rendimiento, ruta, bloques)
+            resumen = resultado.attrs['resumen']
+            fila = [f"{n:,}", f"{os.path.getsize(ruta) / 2 ** 20:.0f}", f"{segundos:.1f}", f"{pico:.0f}",
+                    f"{resumen['validos']:,}", resumen['pasadas']]
+            filas.append(fila)
+            print(*fila, sep='\t', flush=True)
+    print()
+    tabla(['registros', 'csv_MB', 'segundos', 'pico_MB', 'validos', 'pasadas'], filas)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Benchmark del Monte Carlo de ganancias: bloques x simulaciones hasta 10.000 x 10.000.
+
+    python tests/bench_simulacion.py [bloques ...]
+"""
+import sys
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from medicion import cargar_definiciones_app, medir, tabla
+
+
+def grilla(n_bloques, lado_m=100.0):
+    """Bloques de 1 ha en UTM 20S."""
+    lado = int(np.ceil(np.sqrt(n_bloques)))
+    i = np.arange(n_bloques)
+    x, y = 500000.0 + (i % lado) * lado_m, 6300000.0 + (i // lado) * lado_m
+    return gpd.GeoDataFrame({'id_bloque': i + 1, 'area_ha': np.full(n_bloques, lado_m ** 2 / 10000)},
+                            geometry=shapely.box(x, y, x + lado_m, y + lado_m), crs='EPSG:32720')
+
+
+def main():
+    bloques = [int(b) for b in sys.argv[1:]] or [1000, 10000]
+    app = cargar_definiciones_app()
+    filas = []
+    for n_bloques in bloques:
+        gdf = grilla(n_bloques)
+        rend = np.random.default_rng(0).uniform(3, 9, n_bloques)
+        (por_bloque, total), segundos, pico = medir(app.simular_ganancias, gdf, rend, 280.0, 1200.0,
+                                                    n=app.N_SIMULACIONES)
+        metricas = app.metricas_riesgo(total)
+        fila = [f"{n_bloques:,}", f"{app.N_SIMULACIONES:,}", f"{segundos:.1f}", f"{pico:.0f}",
+                f"{metricas['prob_perdida']:.3f}"]
+        filas.append(fila)
+        print(*fila, sep='\t', flush=True)
+    print()
+    tabla(['bloques', 'simulaciones', 'segundos', 'pico_MB', 'prob_perdida'], filas)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""
+app.py es un script de Streamlit: importarlo ejecuta toda la interfaz. Para las pruebas se
+cargan solo sus definiciones (imports, funciones, clases y constantes en MAYÚSCULAS).
+"""
+import ast
+import os
+import types
+
+import pytest
+
+RUTA_APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+
+def _es_definicion(nodo):
+    if isinstance(nodo, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef)):
+        return True
+    if isinstance(nodo, (ast.Assign, ast.AnnAssign)):
+        objetivos = nodo.targets if isinstance(nodo, ast.Assign) else [nodo.target]
+        return all(isinstance(t, ast.Name) and t.id.isupper() for t in objetivos)
+    if isinstance(nodo, ast.Try):
+        # Bloques try/except de dependencias opcionales
+        return all(_es_definicion(n) for n in nodo.body)
+    return False
+
+
+def cargar_definiciones_app():
+    with open(RUTA_APP, encoding='utf-8') as f:
+        arbol = ast.parse(f.read(), RUTA_APP)
+    arbol.body = [n for n in arbol.body if _es_definicion(n)]
+    modulo = types.ModuleType('app_definiciones')
+    modulo.__file__ = RUTA_APP
+    exec(compile(arbol, RUTA_APP, 'exec'), modulo.__dict__)
+    return modulo
+
+
+@pytest.fixture(scope='session')
+def app():
+    return cargar_definiciones_app()
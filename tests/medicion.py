@@ -0,0 +1,49 @@
+"""
+Utilidades de los benchmarks (tests/bench_*.py): cargan las definiciones de app.py como las
+pruebas y miden tiempo y pico de memoria. Se ejecutan a mano, p. ej.
+`python tests/bench_interpolacion.py`; pytest no los recoge.
+"""
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import conftest  # noqa: E402
+
+
+def cargar_definiciones_app():
+    """Como en las pruebas, sin los avisos de streamlit por ejecutarse fuera de `streamlit run`."""
+    logging.disable(logging.WARNING)
+    try:
+        return conftest.cargar_definiciones_app()
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def medir(funcion, *args, **kwargs):
+    """Ejecuta funcion(*args, **kwargs); devuelve (resultado, segundos, pico de memoria en MB)."""
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    try:
+        resultado = funcion(*args, **kwargs)
+        segundos = time.perf_counter() - inicio
+        pico = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+    return resultado, segundos, pico
+
+
+def cronometrar(funcion, *args, **kwargs):
+    """Como medir, pero sin tracemalloc (que encarece los bucles de Python): (resultado, segundos)."""
+    inicio = time.perf_counter()
+    resultado = funcion(*args, **kwargs)
+    return resultado, time.perf_counter() - inicio
+
+
+def tabla(encabezados, filas):
+    anchos = [max(len(str(x)) for x in col) for col in zip(encabezados, *filas)]
+    for fila in [encabezados] + filas:
+        print('  '.join(str(x).rjust(a) for x, a in zip(fila, anchos)))
@@ -0,0 +1,66 @@
+"""Generador por bloque: los valores dependen solo de la geometría, no del orden ni del hilo."""
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+
+@pytest.fixture
+def bloques():
+    x0, y0, d = -63.0, 9.0, 1e-4
+    celdas = [shapely.box(x0 + i * d, y0 + j * d, x0 + (i + 1) * d, y0 + (j + 1) * d)
+              for i in range(30) for j in range(20)]
+    gdf = gpd.GeoDataFrame({'id_bloque': np.arange(1, len(celdas) + 1)}, geometry=celdas, crs='EPSG:4326')
+    gdf['ndvi_modis'] = np.linspace(0.2, 0.9, len(gdf))
+    return gdf
+
+
+def _por_bloque(app, gdf, n=6, flujo=0):
+    u = app.uniformes_por_bloque(app.claves_bloques(gdf), n, flujo=flujo)
+    return pd.DataFrame(u, index=gdf['id_bloque'].to_numpy())
+
+
+def test_invariante_al_reordenar_y_filtrar(app, bloques):
+    base = _por_bloque(app, bloques)
+    assert ((base.to_numpy() >= 0) & (base.to_numpy() < 1)).all()
+    assert len(np.unique(app.claves_bloques(bloques))) == len(bloques)
+    
+    mezclado = bloques.sample(frac=1, random_state=7)
+    pd.testing.assert_frame_equal(_por_bloque(app, mezclado).sort_index(), base)
+    
+    subconjunto = bloques.iloc[::7]
+    pd.testing.assert_frame_equal(_por_bloque(app, subconjunto), base.loc[subconjunto['id_bloque']])
+
+
+def test_flujos_independientes(app, bloques):
+    a = _por_bloque(app, bloques, flujo=0).to_numpy()
+    b = _por_bloque(app, bloques, flujo=1).to_numpy()
+    assert not np.isclose(a, b).any()
+    assert abs(np.corrcoef(a.ravel(), b.ravel())[0, 1]) < 0.1
+
+
+def test_fertilidad_por_bloque_no_depende_del_orden(app, bloques):
+    df, _ = app.generar_mapa_fertilidad(bloques)
+    mezclado = bloques.sample(frac=1, random_state=3)
+    df_mezclado, _ = app.generar_mapa_fertilidad(mezclado)
+    pd.testing.assert_frame_equal(df_mezclado.loc[df.index], df)
+    subconjunto = bloques.iloc[5::4]
+    df_sub, _ = app.generar_mapa_fertilidad(subconjunto)
+    pd.testing.assert_frame_equal(df_sub, df.loc[subconjunto.index])
+
+
+def test_hilos_igual_que_serie(app, bloques):
+    trozos = np.array_split(np.arange(len(bloques)), 12)
+    
+    def tarea(indices):
+        return _por_bloque(app, bloques.iloc[indices], n=16, flujo=3)
+    
+    serie = pd.concat([tarea(t) for t in trozos])
+    with ThreadPoolExecutor(max_workers=6) as ejecutor:
+        for _ in range(5):
+            en_hilos = pd.concat(list(ejecutor.map(tarea, trozos)))
+            pd.testing.assert_frame_equal(en_hilos, serie)
+    pd.testing.assert_frame_equal(serie, _por_bloque(app, bloques, n=16, flujo=3))
@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+
+
+def _piramide(raiz, nombre, kb, uso):
+    ruta = os.path.join(raiz, nombre)
+    os.makedirs(os.path.join(ruta, '0', '0'))
+    with open(os.path.join(ruta, '0', '0', '0.png'), 'wb') as f:
+        f.write(b'\0' * kb * 1024)
+    marcador = os.path.join(ruta, 'completo')
+    with open(marcador, 'w') as f:
+        f.write('0')
+    os.utime(marcador, (uso, uso))
+    return ruta
+
+
+def test_poda_borra_las_menos_usadas(app, tmp_path):
+    raiz = str(tmp_path)
+    rutas = [_piramide(raiz, f'p{i}', 400, 1_000_000 + i) for i in range(5)]
+    os.makedirs(os.path.join(raiz, 'mvt', 'x'))
+    
+    borradas = app.podar_cache_teselas(raiz, conservar=rutas[0], max_mb=1)
+    
+    assert borradas == 3
+    # p0 es la más antigua pero es la recién generada; p4 es la de uso más reciente
+    assert [os.path.exists(r) for r in rutas] == [True, False, False, False, True]
+    assert os.path.isdir(os.path.join(raiz, 'mvt', 'x'))
+
+
+def test_acierto_renueva_la_piramide(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DIR_TESELAS', str(tmp_path))
+    Z = np.arange(64, dtype=float).reshape(8, 8)
+    bounds = (-66.0, 9.0, -65.99, 9.01)
+    info = app.generar_piramide_teselas(Z, bounds, 0, 63, ['#000000', '#ffffff'])
+    clave = info['url'].split('/')[-4]
+    marcador = os.path.join(str(tmp_path), clave, 'completo')
+    os.utime(marcador, (1, 1))
+    
+    assert app.generar_piramide_teselas(Z, bounds, 0, 63, ['#000000', '#ffffff']) == info
+    assert os.path.getmtime(marcador) > 1
+    # Otra pirámide que no cabe junto a la anterior desplaza a la menos usada
+    otra = _piramide(str(tmp_path), 'vieja', 64, 2)
+    assert app.podar_cache_teselas(str(tmp_path), max_mb=0.05) == 1
+    assert not os.path.exists(otra) and os.path.exists(marcador)
@@ -0,0 +1,19 @@
+"""Curvas de nivel por ventanas: los trozos de cada ventana se unen en isolíneas continuas."""
+import numpy as np
+
+
+def _dem():
+    rng = np.random.default_rng(3)
+    yy, xx = np.mgrid[0:600, 0:640]
+    return 50 * np.sin(xx / 60) * np.cos(yy / 90) + 100 + rng.normal(0, 0.3, xx.shape)
+
+
+def test_ventanas_equivalen_a_memoria(app):
+    Z = _dem()
+    transform = (0.0001, 0.0, -60.0, 0.0, -0.0001, -30.0)
+    niveles = np.arange(50, 160, 10)
+    en_memoria = app.extraer_curvas_nivel(Z, transform, niveles)
+    por_ventanas = app.extraer_curvas_nivel_por_ventanas(Z, transform, niveles, tam=128)
+    assert abs(len(por_ventanas) - len(en_memoria)) <= 0.02 * len(en_memoria)
+    longitud = lambda g: float(np.sum(g.geometry.values.length))
+    assert np.isclose(longitud(por_ventanas), longitud(en_memoria), rtol=1e-3)
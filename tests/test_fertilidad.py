@@ -0,0 +1,28 @@
+"""Dosis de fertilización contra valores calculados a mano."""
+import pandas as pd
+
+
+def test_dosis_trigo_a_mano(app):
+    # Trigo: N (100, 120), P (30, 50), K (150, 200); urea y DAP 46 %, KCl 60 %
+    df = pd.DataFrame({'N_kg_ha': [80, 100, 130, 0], 'P_kg_ha': [40, 20, 50, 0],
+                       'K_kg_ha': [160, 100, 200, 0]}, index=[10, 11, 12, 13])
+    dosis = app.recomendaciones_fertilizacion(df, 'Trigo')
+    esperado = pd.DataFrame({
+        'dosis_N_kg_ha': [40.0, 0, 0, 120],  'urea_kg_ha': [87.0, 0, 0, 261],   # 40/0.46 = 86.96
+        'dosis_P_kg_ha': [0.0, 30, 0, 50],   'DAP_kg_ha': [0.0, 65, 0, 109],    # 30/0.46 = 65.22
+        'dosis_K_kg_ha': [0.0, 100, 0, 200], 'KCl_kg_ha': [0.0, 167, 0, 333],   # 100/0.60 = 166.67
+    }, index=df.index)
+    pd.testing.assert_frame_equal(dosis[esperado.columns], esperado)
+    assert dosis['codigo_recomendacion'].astype(str).tolist() == ['N', 'P+K', 'Mantener', 'N+P+K']
+
+
+def test_dosis_maiz_y_cultivo_desconocido(app):
+    df = pd.DataFrame({'N_kg_ha': [129.9], 'P_kg_ha': [35.0], 'K_kg_ha': [159.0]})
+    maiz = app.recomendaciones_fertilizacion(df, 'Maíz').iloc[0]
+    # N: 160 - 129.9 = 30.1 -> 30 kg/ha y 30.1/0.46 = 65.4 -> 65 kg/ha de urea; P en suficiencia
+    assert (maiz['dosis_N_kg_ha'], maiz['urea_kg_ha']) == (30, 65)
+    assert (maiz['dosis_P_kg_ha'], maiz['DAP_kg_ha']) == (0, 0)
+    assert (maiz['dosis_K_kg_ha'], maiz['KCl_kg_ha']) == (61, 102)   # 61/0.60 = 101.7
+    assert maiz['codigo_recomendacion'] == 'N+K'
+    pd.testing.assert_frame_equal(app.recomendaciones_fertilizacion(df, 'Cebada'),
+                                  app.recomendaciones_fertilizacion(df, 'Trigo'))
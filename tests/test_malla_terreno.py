@@ -0,0 +1,25 @@
+"""Decimación quadtree de la malla 3D: el presupuesto de triángulos es un tope estricto."""
+import numpy as np
+import pytest
+
+
+def _dem(mascara=False):
+    rng = np.random.default_rng(1)
+    yy, xx = np.mgrid[0:300, 0:340]
+    Z = 50 * np.sin(xx / 30) * np.cos(yy / 45) + rng.normal(0, 2, xx.shape)
+    if mascara:
+        Z[(xx - 170) ** 2 / 150 ** 2 + (yy - 150) ** 2 / 130 ** 2 > 1] = np.nan
+    return Z
+
+
+@pytest.mark.parametrize("mascara", [False, True])
+@pytest.mark.parametrize("max_triangulos", [1000, 5000, 20000])
+def test_no_supera_el_presupuesto(app, mascara, max_triangulos):
+    filas, columnas, z, tri = app.decimar_malla_quadtree(_dem(mascara), 1.0, max_triangulos)
+    assert 0 < len(tri) <= max_triangulos
+    assert np.isfinite(z).all()
+
+
+def test_terreno_plano_usa_pocos_triangulos(app):
+    filas, columnas, z, tri = app.decimar_malla_quadtree(np.full((129, 129), 100.0), 1.0, 20000)
+    assert len(tri) == 2
@@ -0,0 +1,50 @@
+"""Muestras de laboratorio: validación, LOO e integración en el mapa de fertilidad."""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+
+def test_validar_muestras(app):
+    df = pd.DataFrame({
+        'x': [-63.0, -63.0, -63.001, -63.002, 'n/d', -63.003],
+        'y': [-33.0, -33.0, -33.001, -33.002, -33.0, -33.003],
+        'N_kg_ha': [100, 120, 900, np.nan, 80, 60],      # 900 fuera de rango
+        'pH': [6.0, 6.4, 5.5, np.nan, 6.0, 2.0],        # 2.0 fuera de rango
+    })
+    datos, resumen = app.validar_muestras(df)
+    assert resumen['fuera_de_rango'] == {'N_kg_ha': 1, 'pH': 1}
+    assert resumen['sin_coordenadas'] == 1
+    assert resumen['sin_variables'] == 1     # la fila sin N ni pH
+    assert resumen['duplicadas'] == 1        # las dos primeras, en el mismo punto
+    assert resumen['validas'] == len(datos) == 3
+    repetida = datos[(datos['x'] == -63.0) & (datos['y'] == -33.0)].iloc[0]
+    assert repetida['N_kg_ha'] == 110 and repetida['pH'] == pytest.approx(6.2)
+
+
+@pytest.mark.parametrize("n, k", [(30, 8), (12, 8), (5, 8)])
+def test_loo_igual_a_reajuste_completo(app, n, k):
+    rng = np.random.default_rng(n)
+    puntos = rng.uniform(0, 500, (n, 2))
+    valores = rng.normal(100, 20, n)
+    rapido = app.validacion_cruzada_loo(puntos, valores, k=k)
+    for i in range(n):
+        otros = np.arange(n) != i
+        reajuste = app.interpolar_idw(puntos[otros], valores[otros], puntos[i:i + 1], k=min(k, n - 1))
+        assert rapido[i] == pytest.approx(reajuste[0], rel=1e-12)
+
+
+def test_fertilidad_con_muestras_se_puede_concatenar(app):
+    campo = gpd.GeoDataFrame(geometry=[shapely.box(-63.01, -33.01, -63.0, -33.0)], crs='EPSG:4326')
+    bloques = app.dividir_plantacion_en_bloques(campo, 25)
+    rng = np.random.default_rng(0)
+    muestras = gpd.GeoDataFrame({'N_kg_ha': rng.uniform(60, 160, 20), 'pH': rng.uniform(5, 7, 20)},
+                                geometry=gpd.points_from_xy(rng.uniform(-63.01, -63.0, 20), rng.uniform(-33.01, -33.0, 20)),
+                                crs='EPSG:4326')
+    df, validacion = app.generar_mapa_fertilidad(bloques, 'Maíz', muestras)
+    assert set(validacion.index) == {'N_kg_ha', 'pH'}
+    assert (validacion['n'] == 20).all()
+    assert df['N_kg_ha'].between(60, 160).all()
+    assert not any(isinstance(v, pd.DataFrame) for v in df.attrs.values())
+    assert len(pd.concat([df, df])) == 2 * len(bloques)
@@ -0,0 +1,82 @@
+"""Prescripciones: el ZIP se vuelve a leer y respeta el presupuesto de vértices."""
+import io
+import xml.etree.ElementTree as ET
+import zipfile
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+
+
+def _lote(app, n_bloques, semilla=0):
+    campo = gpd.GeoDataFrame(geometry=[shapely.box(-66.90, 8.00, -66.89, 8.01)], crs='EPSG:4326')
+    bloques = app.dividir_plantacion_en_bloques(campo, n_bloques)
+    # Dosis con estructura espacial más ruido, como un mapa de fertilidad real
+    c = bloques.geometry.representative_point()
+    x, y = (c.x.values + 66.90) * 100, (c.y.values - 8.00) * 100
+    rng = np.random.default_rng(semilla)
+    bloques['urea_kg_ha'] = 130 + 40 * np.sin(6 * x) * np.cos(4 * y) + rng.normal(0, 10, len(bloques))
+    return campo, bloques
+
+
+def _area_m2(geometrias):
+    geometrias = gpd.GeoSeries(geometrias, crs='EPSG:4326')
+    return geometrias.to_crs(geometrias.estimate_utm_crs()).area.sum()
+
+
+def test_shapefile_se_lee_con_geopandas(app, tmp_path):
+    campo, bloques = _lote(app, 1600)
+    datos, n_zonas, n_vertices = app.exportar_prescripcion(bloques, 'Urea', 'Shapefile')
+    ruta = tmp_path / 'prescripcion.zip'
+    ruta.write_bytes(datos)
+    leido = gpd.read_file(f"zip://{ruta}")
+    assert len(leido) == n_zonas
+    assert int(shapely.get_num_coordinates(leido.geometry.values).sum()) == n_vertices
+    assert leido.geometry.is_valid.all()
+    assert set(leido['DOSIS']) <= set(np.arange(0, 400, app.PASO_DOSIS_KG_HA, dtype=float))
+    # Cobertura sin huecos ni solapes: la superficie total es la del lote
+    assert _area_m2(leido.geometry.values) == pytest.approx(_area_m2(campo.geometry.values), rel=1e-6)
+    assert leido['AREA_HA'].sum() == pytest.approx(_area_m2(campo.geometry.values) / 10000, rel=1e-3)
+
+
+def test_isoxml_se_parsea(app):
+    _, bloques = _lote(app, 1600)
+    datos, n_zonas, n_vertices = app.exportar_prescripcion(bloques, 'Urea', 'ISOXML')
+    with zipfile.ZipFile(io.BytesIO(datos)) as zf:
+        raiz = ET.fromstring(zf.read('TASKDATA/TASKDATA.XML'))
+    assert raiz.tag == 'ISO11783_TaskData'
+    zonas = raiz.findall('TSK/TZN')[1:]  # la primera es "Fuera de zona"
+    dosis = [int(z.find('PDV').get('B')) for z in zonas]
+    assert dosis == sorted(set(dosis))
+    assert all(d % (app.PASO_DOSIS_KG_HA * 100) == 0 for d in dosis)
+    poligonos = [p for z in zonas for p in z.findall('PLN')]
+    assert len(poligonos) == n_zonas
+    puntos = sum(len(p.findall('LSG/PNT')) for p in poligonos)
+    assert puntos == n_vertices
+    lat = [float(p.get('C')) for p in raiz.iter('PNT')]
+    assert 8.00 - 1e-9 <= min(lat) and max(lat) <= 8.01 + 1e-9
+
+
+def test_mapa_ruidoso_respeta_el_presupuesto(app):
+    # Ruido puro bloque a bloque: miles de zonas de un bloque antes de fundir
+    campo, bloques = _lote(app, 6400)
+    bloques['urea_kg_ha'] = np.random.default_rng(1).uniform(80, 180, len(bloques))
+    datos, n_zonas, n_vertices = app.exportar_prescripcion(bloques, 'Urea', 'Shapefile', max_vertices=3000)
+    assert n_zonas <= 3000 // app.VERTICES_POR_ZONA
+    assert n_vertices <= 3000
+    zonas = app.zonas_prescripcion(bloques, 'urea_kg_ha', max_zonas=300)
+    assert len(zonas) <= 300
+    assert _area_m2(zonas.geometry.values) == pytest.approx(_area_m2(campo.geometry.values), rel=1e-6)
+
+
+def test_sin_fusion_zonas_son_bloques_contiguos(app):
+    _, bloques = _lote(app, 400)
+    bloques['urea_kg_ha'] = np.where(bloques.geometry.representative_point().x < -66.895, 100.0, 150.0)
+    zonas = app.zonas_prescripcion(bloques, 'urea_kg_ha')
+    assert sorted(zonas['dosis']) == [100.0, 150.0]
+
+
+def test_presupuesto_imposible_se_rechaza(app):
+    _, bloques = _lote(app, 400)
+    assert app.exportar_prescripcion(bloques, 'Urea', 'Shapefile', max_vertices=3) is None
@@ -0,0 +1,132 @@
+"""Pronóstico Open-Meteo contra un servidor local de reemplazo y puntaje de ventanas de aplicación."""
+import json
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import box
+
+
+def _respuesta_open_meteo(dias):
+    horas = dias * 24
+    return {
+        "hourly": {
+            "time": [f"2026-01-{1 + h // 24:02d}T{h % 24:02d}:00" for h in range(horas)],
+            "precipitation": [0.0] * horas,
+            "wind_speed_10m": [8.0] * horas,
+            "temperature_2m": [20.0] * horas,
+        }
+    }
+
+
+@pytest.fixture
+def servidor():
+    """Servidor HTTP local que responde JSON con el formato de Open-Meteo y registra las consultas."""
+    consultas = []
+
+    class Manejador(BaseHTTPRequestHandler):
+        def do_GET(self):
+            params = parse_qs(urlparse(self.path).query)
+            consultas.append((params["latitude"][0], params["longitude"][0]))
+            cuerpo = json.dumps(_respuesta_open_meteo(int(params["forecast_days"][0]))).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Manejador)
+    hilo = threading.Thread(target=httpd.serve_forever, daemon=True)
+    hilo.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/v1/forecast", consultas
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def bloques():
+    # Cuatro bloques en una celda de 0.1° y dos en otra
+    geometrias = [box(-63.01 + 0.002 * i, -33.01, -63.009 + 0.002 * i, -33.009) for i in range(4)]
+    geometrias += [box(-62.51 + 0.002 * i, -33.01, -62.509 + 0.002 * i, -33.009) for i in range(2)]
+    return gpd.GeoDataFrame({"id_bloque": range(1, 7)}, geometry=geometrias, crs="EPSG:4326")
+
+
+def test_una_descarga_por_celda_y_corrida(app, servidor, bloques, monkeypatch):
+    url, consultas = servidor
+    app._descargar_pronostico_celda.clear()
+    monkeypatch.setattr(app, "ciclo_modelo_actual", lambda ahora=None: "2026-01-01T00Z")
+
+    pronostico = app.obtener_pronostico_bloques(bloques, dias=2, url=url)
+    assert pronostico["viento"].shape == (6, 48)
+    assert len(consultas) == 2
+
+    app.obtener_pronostico_bloques(bloques, dias=2, url=url)
+    assert len(consultas) == 2  # misma corrida: todo desde la caché
+
+    monkeypatch.setattr(app, "ciclo_modelo_actual", lambda ahora=None: "2026-01-01T06Z")
+    app.obtener_pronostico_bloques(bloques, dias=2, url=url)
+    assert len(consultas) == 4  # corrida nueva: una descarga más por celda
+
+
+@pytest.mark.parametrize("ahora, esperado", [
+    (datetime(2026, 1, 1, 5, 0), "2026-01-01T00Z"),
+    (datetime(2026, 1, 1, 10, 30), "2026-01-01T06Z"),
+    (datetime(2026, 1, 1, 2, 0), "2025-12-31T18Z"),
+])
+def test_ciclo_modelo_considera_latencia(app, ahora, esperado):
+    assert app.ciclo_modelo_actual(ahora) == esperado
+
+
+def _pronostico(horas=72, lluvia=0.0, viento=5.0, temperatura=18.0):
+    return {
+        "precipitacion": np.full((1, horas), lluvia, dtype=np.float64),
+        "viento": np.full((1, horas), viento, dtype=np.float64),
+        "temperatura": np.full((1, horas), temperatura, dtype=np.float64),
+    }
+
+
+def test_puntaje_condiciones_ideales_con_lluvia_de_incorporacion(app):
+    p = _pronostico()
+    p["precipitacion"][0, 10] = 6.0  # lluvia suficiente dentro de las 48 h siguientes
+    puntaje = app.calcular_ventanas_aplicacion(p)
+    assert puntaje[0, 5] == pytest.approx(1.0)
+    assert puntaje[0, 10] == 0.0  # llueve en la hora de aplicación
+
+
+def test_puntaje_sin_lluvia_posterior_penaliza_incorporacion(app):
+    puntaje = app.calcular_ventanas_aplicacion(_pronostico())
+    assert puntaje[0, 0] == pytest.approx(0.4)
+
+
+def test_puntaje_lavado_por_exceso_de_lluvia(app):
+    p = _pronostico()
+    p["precipitacion"][0, 12:20] = 5.0  # 40 mm > lluvia_lavado_max
+    assert app.calcular_ventanas_aplicacion(p)[0, 5] == 0.0
+
+
+@pytest.mark.parametrize("viento, esperado", [(5.0, 1.0), (15.0, 0.5), (20.0, 0.0), (35.0, 0.0)])
+def test_puntaje_umbral_de_viento(app, viento, esperado):
+    p = _pronostico(viento=viento)
+    p["precipitacion"][0, 10] = 6.0
+    assert app.calcular_ventanas_aplicacion(p)[0, 5] == pytest.approx(esperado)
+
+
+@pytest.mark.parametrize("temperatura, esperado", [(18.0, 1.0), (27.0, 0.5), (32.0, 0.0), (38.0, 0.0)])
+def test_puntaje_umbral_de_temperatura(app, temperatura, esperado):
+    p = _pronostico(temperatura=temperatura)
+    p["precipitacion"][0, 10] = 6.0
+    assert app.calcular_ventanas_aplicacion(p)[0, 5] == pytest.approx(esperado)
+
+
+def test_viento_faltante_no_produce_nan(app):
+    p = _pronostico()
+    p["viento"][0, 3] = np.nan
+    puntaje = app.calcular_ventanas_aplicacion(p)
+    assert np.isfinite(puntaje).all() and puntaje[0, 3] == 0.0
@@ -0,0 +1,88 @@
+"""Limpieza del registro de cosecha sobre un recorrido en serpentina simulado."""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+LAT0, LON0 = -33.0, -63.0
+M_X = 111320 * np.cos(np.radians(LAT0))
+M_Y = 110540
+N_PASADAS, LARGO_M, ANCHO_M = 40, 300.0, 9.0
+
+
+def _serpentina(n_pasadas=N_PASADAS, paso_m=1.67, radio_m=4.5):
+    """Pasadas rectas a 6 km/h unidas por vueltas en U de ~18° por registro (1 Hz)."""
+    puntos = []
+    for p in range(n_pasadas):
+        x = p * ANCHO_M
+        ys = np.arange(0, LARGO_M, paso_m)
+        puntos += [(x, y, 6.0) for y in (ys[::-1] if p % 2 else ys)]
+        borde, signo = (LARGO_M, 1) if p % 2 == 0 else (0.0, -1)
+        for t in np.arange(0, np.pi, 1.4 / radio_m):
+            puntos.append((x + radio_m - radio_m * np.cos(t), borde + signo * radio_m * np.sin(t), 5.0))
+    return np.array(puntos)
+
+
+def _registro(xyv, semilla=0):
+    rng = np.random.default_rng(semilla)
+    return pd.DataFrame({'lon': LON0 + xyv[:, 0] / M_X, 'lat': LAT0 + xyv[:, 1] / M_Y,
+                         'speed': xyv[:, 2], 'yield': rng.normal(8, 1, len(xyv))})
+
+
+def _bloques(n=4):
+    campo = shapely.box(LON0 - 1e-4, LAT0 - 1e-4, LON0 + N_PASADAS * ANCHO_M / M_X + 1e-4, LAT0 + LARGO_M / M_Y + 1e-4)
+    xs = np.linspace(campo.bounds[0], campo.bounds[2], n + 1)
+    ys = np.linspace(campo.bounds[1], campo.bounds[3], n + 1)
+    geoms = [shapely.box(xs[i], ys[j], xs[i + 1], ys[j + 1]) for i in range(n) for j in range(n)]
+    return gpd.GeoDataFrame({'id_bloque': range(1, n * n + 1)}, geometry=geoms, crs='EPSG:4326')
+
+
+@pytest.fixture(scope='module')
+def serpentina(tmp_path_factory):
+    ruta = tmp_path_factory.mktemp('rendimiento') / 'serpentina.csv'
+    _registro(_serpentina()).to_csv(ruta, index=False)
+    return ruta
+
+
+def test_cuenta_una_pasada_por_cabecera(app, serpentina):
+    resultado = app.procesar_rendimiento(str(serpentina), _bloques())
+    resumen = resultado.attrs['resumen']
+    # Una al empezar a cosechar y una por cada vuelta en U entre pasadas (la última vuelta
+    # queda en la cola del retardo de flujo)
+    assert resumen['pasadas'] == N_PASADAS
+    assert resumen['inicio_pasada'] == app.REGISTROS_INICIO_PASADA * resumen['pasadas']
+    assert resumen['superposicion'] == 0
+    assert resumen['fuera_de_bloques'] == 0
+    assert resultado['rend_medio'].between(7.5, 8.5).all()
+
+
+@pytest.mark.parametrize("tam", [777, 64, 5])
+def test_resultado_no_depende_del_tamano_de_lote(app, serpentina, tam):
+    bloques = _bloques()
+    completo = app.procesar_rendimiento(str(serpentina), bloques)
+    por_lotes = app.procesar_rendimiento(str(serpentina), bloques, tam=tam)
+    pd.testing.assert_frame_equal(completo, por_lotes)
+    assert completo.attrs['resumen'] == por_lotes.attrs['resumen']
+
+
+def test_descarta_la_repasada(app, tmp_path):
+    recorrido = _serpentina()
+    primera = recorrido[:int(LARGO_M / 1.67)]      # se vuelve a cosechar la primera pasada
+    ruta = tmp_path / 'repasada.csv'
+    _registro(np.vstack((recorrido, primera))).to_csv(ruta, index=False)
+    resumen = app.procesar_rendimiento(str(ruta), _bloques()).attrs['resumen']
+    assert resumen['superposicion'] >= 0.9 * (len(primera) - app.REGISTROS_INICIO_PASADA)
+
+
+def test_puntos_en_el_borde_entre_bloques(app, tmp_path):
+    bloques = _bloques(2)
+    borde = bloques.geometry.values[0].bounds[2]          # x del borde vertical compartido
+    n = 120
+    lat = LAT0 + np.arange(n) * 1.67 / M_Y
+    ruta = tmp_path / 'borde.csv'
+    pd.DataFrame({'lon': np.full(n, borde), 'lat': lat, 'speed': 6.0, 'yield': 8.0}).to_csv(ruta, index=False)
+    resultado = app.procesar_rendimiento(str(ruta), bloques)
+    resumen = resultado.attrs['resumen']
+    assert resumen['fuera_de_bloques'] == 0
+    assert resultado['puntos'].sum() == resumen['validos'] > 0
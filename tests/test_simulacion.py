@@ -0,0 +1,43 @@
+"""Monte Carlo de ganancias: casos sin varianza, invariancia a los lotes y total del campo."""
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+
+
+def grilla(n_bloques, lado_m=100.0):
+    i = np.arange(n_bloques)
+    x, y = 500000.0 + (i % 20) * lado_m, 6300000.0 + (i // 20) * lado_m
+    return gpd.GeoDataFrame({'id_bloque': i + 1, 'area_ha': np.full(n_bloques, lado_m ** 2 / 10000)},
+                            geometry=shapely.box(x, y, x + lado_m, y + lado_m), crs='EPSG:32720')
+
+
+def test_sin_varianza_es_determinista(app):
+    gdf = grilla(50)
+    rend = np.linspace(2, 8, 50)
+    por_bloque, total = app.simular_ganancias(gdf, rend, 250.0, 1000.0, n=200,
+                                              cv_rend=0.0, cv_precio=0.0, cv_costo=0.0)
+    ganancia = rend * 250.0 - 1000.0
+    for columna in ('P10 (USD/ha)', 'P50 (USD/ha)', 'P90 (USD/ha)', 'media (USD/ha)'):
+        np.testing.assert_allclose(por_bloque[columna], np.round(ganancia, 1))
+    np.testing.assert_allclose(por_bloque['prob_perdida'], (ganancia < 0).astype(float))
+    np.testing.assert_allclose(total, (gdf['area_ha'] * ganancia).sum())
+
+
+def test_lotes_no_cambian_el_resultado(app):
+    gdf = grilla(300)
+    rend = np.random.default_rng(1).uniform(3, 9, 300)
+    entero, total = app.simular_ganancias(gdf, rend, 280.0, 1200.0, n=500)
+    en_lotes, total_lotes = app.simular_ganancias(gdf, rend, 280.0, 1200.0, n=500, max_elementos=500 * 7)
+    np.testing.assert_array_equal(en_lotes.to_numpy(), entero.to_numpy())
+    np.testing.assert_allclose(total_lotes, total, rtol=1e-12)
+
+
+def test_riesgo_crece_con_la_dispersion(app):
+    gdf = grilla(100)
+    rend = np.full(100, 5.0)                      # margen esperado 5*280 - 1200 = 200 USD/ha
+    bajo, _ = app.simular_ganancias(gdf, rend, 280.0, 1200.0, n=2000, cv_rend=0.05)
+    alto, _ = app.simular_ganancias(gdf, rend, 280.0, 1200.0, n=2000, cv_rend=0.30)
+    assert alto['prob_perdida'].mean() > bajo['prob_perdida'].mean()
+    assert bajo['media (USD/ha)'].mean() == pytest.approx(200, abs=15)
+    assert (alto['P10 (USD/ha)'] < alto['P50 (USD/ha)']).all() and (alto['P50 (USD/ha)'] < alto['P90 (USD/ha)']).all()
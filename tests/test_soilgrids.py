@@ -0,0 +1,104 @@
+"""Almacén SoilGrids local: lectura por ventana, media zonal y textura por bloque."""
+import functools
+import os
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+
+rasterio = pytest.importorskip('rasterio')
+from rasterio.transform import from_origin
+
+X0, Y0, CELDA, LADO = -63.0, 9.01, 0.001, 10
+NODATA = -32768
+
+
+def _escribir_geotiff(ruta, valores):
+    with rasterio.open(ruta, 'w', driver='GTiff', width=LADO, height=LADO, count=1, dtype='int16',
+                       crs='EPSG:4326', transform=from_origin(X0, Y0, CELDA, CELDA), nodata=NODATA) as dst:
+        dst.write(valores.astype(np.int16), 1)
+
+
+def _celdas(c0, f0, c1, f1):
+    """Caja que cubre las columnas c0..c1-1 y filas f0..f1-1 del raster."""
+    return shapely.box(X0 + c0 * CELDA, Y0 - f1 * CELDA, X0 + c1 * CELDA, Y0 - f0 * CELDA)
+
+
+@pytest.fixture
+def gradiente(tmp_path):
+    valores = np.arange(LADO * LADO).reshape(LADO, LADO)
+    valores[0, 0] = NODATA
+    ruta = str(tmp_path / 'soc_0-5cm_mean.tif')
+    _escribir_geotiff(ruta, valores)
+    return ruta, valores.astype(float)
+
+
+def test_leer_ventana_con_margen(app, gradiente):
+    ruta, valores = gradiente
+    parcela = gpd.GeoDataFrame(geometry=[_celdas(3, 4, 6, 7)], crs='EPSG:4326')
+    datos, transform, gdf_src = app.leer_ventana_soilgrids(ruta, parcela)
+    # Columnas 3-5 y filas 4-6 más una celda de margen por lado
+    fila0 = int(round((Y0 - transform[5]) / CELDA))
+    col0 = int(round((transform[2] - X0) / CELDA))
+    assert (fila0, col0) == (3, 2) and datos.shape == (6, 6)
+    np.testing.assert_array_equal(datos, valores[fila0:fila0 + datos.shape[0], col0:col0 + datos.shape[1]])
+    assert gdf_src.crs == parcela.crs
+    
+    esquina = gpd.GeoDataFrame(geometry=[_celdas(0, 0, 2, 2)], crs='EPSG:4326')
+    datos, _, _ = app.leer_ventana_soilgrids(ruta, esquina)
+    assert np.isnan(datos[0, 0]) and np.isfinite(datos[1:, 1:]).all()
+    
+    fuera = gpd.GeoDataFrame(geometry=[shapely.box(-62.0, 9.0, -61.99, 9.01)], crs='EPSG:4326')
+    assert app.leer_ventana_soilgrids(ruta, fuera) is None
+
+
+def test_media_por_bloque(app, gradiente):
+    ruta, valores = gradiente
+    centro = shapely.Point(X0 + 7.5 * CELDA, Y0 - 8.5 * CELDA)
+    bloques = gpd.GeoDataFrame(geometry=[
+        _celdas(0, 0, 5, 5),                 # incluye la celda sin dato
+        _celdas(5, 0, 10, 5),
+        _celdas(2, 6, 6, 9),
+        centro.buffer(CELDA / 10),           # más chico que una celda
+    ], crs='EPSG:4326')
+    datos, transform, gdf_src = app.leer_ventana_soilgrids(ruta, bloques)
+    media = app.media_por_bloque(datos, transform, gdf_src)
+    esperado = [
+        np.nanmean(np.where(valores == NODATA, np.nan, valores)[0:5, 0:5]),
+        valores[0:5, 5:10].mean(),
+        valores[6:9, 2:6].mean(),
+        valores[8, 7],
+    ]
+    np.testing.assert_allclose(media, esperado)
+
+
+def test_textura_medida_usa_nombre_local(app, tmp_path, monkeypatch):
+    # 60 % arena, 25 % limo, 15 % arcilla: USDA 'Franco Arenoso', suelo local 'Arenoso Franco'
+    for variable, g_kg in (('sand', 600), ('silt', 250), ('clay', 150)):
+        for profundidad, _ in app.PROFUNDIDADES_SOILGRIDS:
+            _escribir_geotiff(str(tmp_path / f'{variable}_{profundidad}_mean.tif'), np.full((LADO, LADO), g_kg))
+    monkeypatch.setattr(app, 'propiedades_suelo_por_bloque',
+                        functools.partial(app.propiedades_suelo_por_bloque, directorio=str(tmp_path)))
+    bloques = gpd.GeoDataFrame({'id_bloque': [1, 2]}, geometry=[_celdas(1, 1, 4, 4), _celdas(4, 1, 8, 4)],
+                               crs='EPSG:4326')
+    
+    df = app.analizar_textura_suelo_venezuela_por_bloque(bloques)
+    
+    assert (df['fuente'] == 'SoilGrids').all()
+    assert (df['clase_usda'] == 'Franco Arenoso').all()
+    assert (df['tipo_suelo'] == 'Arenoso Franco').all()
+    assert set(df['tipo_suelo']) <= set(app.CARACTERISTICAS_SUELO)
+    assert df[['arena', 'limo', 'arcilla']].iloc[0].tolist() == [60.0, 25.0, 15.0]
+    assert (df['drenaje'] == app.CARACTERISTICAS_SUELO['Arenoso Franco']['drenaje']).all()
+
+
+def test_textura_estimada_tiene_clase_usda(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'propiedades_suelo_por_bloque',
+                        functools.partial(app.propiedades_suelo_por_bloque, directorio=str(tmp_path / 'vacio')))
+    bloques = gpd.GeoDataFrame(geometry=[_celdas(i, 0, i + 1, 1) for i in range(LADO)], crs='EPSG:4326')
+    df = app.analizar_textura_suelo_venezuela_por_bloque(bloques)
+    assert (df['fuente'] == 'Estimado').all()
+    assert set(df['tipo_suelo']) <= set(app.CARACTERISTICAS_SUELO)
+    esperado = app.clasificar_textura_usda(df['arena'], df['limo'], df['arcilla'])
+    assert (df['clase_usda'].to_numpy() == esperado).all()
@@ -0,0 +1,42 @@
+"""Análisis del terreno: D8 y acumulación de flujo sobre superficies con solución exacta."""
+import numpy as np
+import pytest
+
+TRANSFORM_10M = (10.0, 0.0, 500000.0, 0.0, -10.0, 1000000.0)
+
+
+def test_plano_inclinado_hacia_el_sur(app):
+    filas, columnas = 40, 25
+    dem = np.repeat(np.arange(filas, 0, -1, dtype=float)[:, None], columnas, axis=1)   # 1 m por fila
+    resultado = app.analizar_terreno(dem, TRANSFORM_10M)
+    
+    receptor = app.direccion_flujo_d8(dem, 10.0, 10.0).reshape(filas, columnas)
+    ff, cc = np.mgrid[0:filas, 0:columnas]
+    np.testing.assert_array_equal(receptor[:-1], ((ff + 1) * columnas + cc)[:-1])
+    assert (receptor[-1] == -1).all()                       # el borde sur no tiene receptor
+    
+    # Cada celda recibe la columna entera aguas arriba: a = fila + 1 celdas de 100 m²
+    np.testing.assert_allclose(resultado['area_aporte_ha'], (ff + 1) * 100 / 10000.0)
+    np.testing.assert_allclose(resultado['pendiente'], np.degrees(np.arctan(0.1)))
+    np.testing.assert_allclose(resultado['orientacion'], 180.0)
+    np.testing.assert_allclose(resultado['twi'], np.log((ff + 1) * 10.0 / 0.1))
+
+
+def test_plano_diagonal(app):
+    n = 30
+    ff, cc = np.mgrid[0:n, 0:n]
+    dem = -(ff + cc).astype(float)                          # baja hacia el sureste
+    acumulado = app.acumulacion_flujo(app.direccion_flujo_d8(dem, 10.0, 10.0)).reshape(n, n)
+    # Dentro fluye en diagonal; los bordes este y sur conducen todo a la esquina sureste
+    np.testing.assert_array_equal(acumulado[:-1, :-1], (np.minimum(ff, cc) + 1)[:-1, :-1])
+    assert acumulado[-1, -1] == n * n
+
+
+def test_sin_dato_no_aporta(app):
+    dem = np.repeat(np.arange(10, 0, -1, dtype=float)[:, None], 3, axis=1)
+    dem[2, 1] = np.nan
+    acumulado = app.analizar_terreno(dem, TRANSFORM_10M)['area_aporte_ha'] * 100
+    # El hueco corta la columna central: aguas abajo solo cuenta desde la fila 3
+    np.testing.assert_allclose(acumulado[:, 1], [1, 2, 0, 1, 2, 3, 4, 5, 6, 7])
+    np.testing.assert_allclose(acumulado[:, 0], np.arange(1, 11))
+    assert np.isnan(app.analizar_terreno(dem, TRANSFORM_10M)['twi'][2, 1])
@@ -0,0 +1,87 @@
+"""TopoJSON cuantizado: se decodifica de vuelta a los polígonos y reduce el tamaño del mapa."""
+import json
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import MultiPolygon, Polygon
+
+
+def _decodificar(topologia, nombre='bloques'):
+    """Decodificador TopoJSON mínimo (arcos delta, transform, arcos invertidos con ~i)."""
+    escala = np.array(topologia['transform']['scale'])
+    origen = np.array(topologia['transform']['translate'])
+    arcos = [np.cumsum(np.array(a, dtype=float), axis=0) * escala + origen for a in topologia['arcs']]
+
+    def anillo(ids):
+        puntos = []
+        for i in ids:
+            arco = arcos[i] if i >= 0 else arcos[~i][::-1]
+            puntos.extend(arco if not puntos else arco[1:])
+        return puntos
+
+    def poligono(anillos):
+        return Polygon(anillo(anillos[0]), [anillo(a) for a in anillos[1:]])
+
+    salida = []
+    for geom in topologia['objects'][nombre]['geometries']:
+        if geom['type'] == 'Polygon':
+            salida.append(poligono(geom['arcs']))
+        elif geom['type'] == 'MultiPolygon':
+            salida.append(MultiPolygon([poligono(p) for p in geom['arcs']]))
+        else:
+            salida.append(None)
+    return salida
+
+
+def _bloques(app, n):
+    campo = gpd.GeoDataFrame(geometry=[shapely.Point(-63.0, -33.0).buffer(0.01, 32)], crs='EPSG:4326')
+    return app.dividir_plantacion_en_bloques(campo, n)
+
+
+def test_ida_y_vuelta(app):
+    geoms = list(_bloques(app, 400).geometry.values)
+    con_hueco = shapely.box(-62.98, -33.0, -62.97, -32.99).difference(shapely.box(-62.977, -32.997, -62.973, -32.993))
+    dos_partes = MultiPolygon([shapely.box(-62.96, -33.0, -62.955, -32.995), shapely.box(-62.95, -33.0, -62.945, -32.995)])
+    geoms += [con_hueco, dos_partes]
+    registros = [{'i': i} for i in range(len(geoms))]
+    topologia = json.loads(json.dumps(app.codificar_topojson(geoms, registros, precision=6)))
+    decodificadas = _decodificar(topologia)
+    assert len(decodificadas) == len(geoms)
+    # Error de cuantización: medio paso de grilla por eje
+    tolerancia = 0.5e-6 * np.sqrt(2) + 1e-12
+    for original, decodificada in zip(geoms, decodificadas):
+        assert decodificada.is_valid
+        assert decodificada.geom_type == original.geom_type
+        assert shapely.hausdorff_distance(original, decodificada) <= tolerancia
+    assert len(decodificadas[-2].interiors) == 1
+    assert [g['properties'] for g in topologia['objects']['bloques']['geometries']] == registros
+
+
+def test_bordes_compartidos_una_vez(app):
+    geoms = list(_bloques(app, 100).geometry.values)
+    topologia = app.codificar_topojson(geoms, [{}] * len(geoms))
+    referencias = [abs(~i if i < 0 else i) for g in topologia['objects']['bloques']['geometries']
+                   for anillo in g['arcs'] for i in anillo]
+    usos = np.bincount(referencias, minlength=len(topologia['arcs']))
+    # Cada arco lo usan uno (borde exterior) o dos bloques (borde interno), nunca se repite
+    assert set(usos) <= {1, 2}
+    assert (usos == 2).sum() > len(geoms)
+
+
+def test_tamano_mapa_10k_bloques(app):
+    bloques = _bloques(app, 10000)
+    rng = np.random.default_rng(0)
+    bloques['ndvi_modis'] = rng.uniform(0.2, 0.9, len(bloques))
+    fertilidad, _ = app.generar_mapa_fertilidad(bloques, 'Maíz')
+    completo = bloques.join(fertilidad.drop(columns='id_bloque'))
+    # Antes: to_json con todas las columnas y coordenadas float64
+    original = len(completo.to_json())
+    propiedades = ['id_bloque', 'ndvi_modis']
+    compacto = len(json.dumps(app.geojson_compacto(completo, propiedades, zoom=app.ZOOM_DETALLE_MAPA),
+                              separators=(',', ':')))
+    topo = len(json.dumps(app.geojson_compacto(completo, propiedades, zoom=app.ZOOM_DETALLE_MAPA, topojson=True),
+                          separators=(',', ':')))
+    assert topo < 0.8 * compacto
+    # ~3,2x medido: el resto es la estructura por entidad (tipo, arcos, id, propiedades)
+    assert original / topo > 3